@@ -0,0 +1,59 @@
+"""Fixtures shared by the tests."""
+
+import os
+
+
+class FakeConverter:
+    """Returns HTML as is, remembering which notes were converted."""
+
+    def __init__(self):
+        self.converted = []
+
+    def convert(self, html, name=None):
+        self.converted.append(name)
+        return html
+
+
+def message(text, uuid=None, subject=None):
+    """Returns a raw HTML note with `text` as its body."""
+    headers = [
+        'Date: Tue, 2 Jan 2018 10:00:00 +0000',
+        'X-Mail-Created-Date: Mon, 1 Jan 2018 10:00:00 +0000',
+    ]
+    if uuid is not None:
+        headers.append('X-Universally-Unique-Identifier: {}'.format(uuid))
+    if subject is not None:
+        headers.append('Subject: {}'.format(subject))
+    headers.append('Content-Type: text/html')
+    return '{}\r\n\r\n{}\r\n'.format('\r\n'.join(headers), text).encode(
+        'ascii',
+    )
+
+
+def write_note(notes_dir, filename, text, *titles):
+    """Writes a note with title symlinks named `titles`. Returns its path.
+
+    Like backups, symlinks are absolute.
+    """
+    os.makedirs(notes_dir, exist_ok=True)
+    path = os.path.join(notes_dir, filename)
+    with open(path, 'wb') as f:
+        f.write(message(text))
+    for title in titles:
+        os.symlink(path, os.path.join(notes_dir, title + '.eml'))
+    return path
+
+
+def read_tree(root):
+    """Returns {path relative to `root`: stripped text} of all files.
+
+    zzyzx's own state in `.zzyzx` is left out.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != '.zzyzx']
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path) as f:
+                files[os.path.relpath(path, root)] = f.read().strip()
+    return files
@@ -0,0 +1,344 @@
+import asyncio
+import configparser
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from helpers import message
+from zzyzx import aioimap, backup
+
+
+class FakeStream:
+    """Writer of an `IMAPClient` whose server side is `handler`.
+
+    `handler` gets every command line sent and returns the reply, `TAG`
+    in it stands for the command's tag. Replies are held back until
+    `batch` commands are in, then fed to `reader` together, in reverse
+    command order if `reverse` is set. Both can be changed any time.
+    """
+
+    def __init__(self, handler):
+        self.reader = asyncio.StreamReader()
+        self.reader.feed_data(b'* OK ready\r\n')
+        self.handler = handler
+        self.batch = 1
+        self.reverse = False
+        self.received = bytearray()
+        self.replies = []
+        self.closed = False
+
+    def write(self, data):
+        self.received += data
+        while b'\r\n' in self.received:
+            line, _, rest = bytes(self.received).partition(b'\r\n')
+            self.received[:] = rest
+            tag = line.split(b' ', 1)[0]
+            self.replies.append(self.handler(line).replace(b'TAG', tag))
+            if len(self.replies) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        if self.reverse:
+            self.replies.reverse()
+        self.reader.feed_data(b''.join(self.replies))
+        self.replies.clear()
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeServer:
+    """Answers commands about `folders`: {name: [message bodies]}."""
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.selected = None
+        self.commands = []
+
+    def __call__(self, line):
+        _, name, *args = line.split(b' ', 2)
+        args = args[0].decode('ascii') if args else ''
+        self.commands.append((name.decode('ascii'), args))
+        method = getattr(self, name.decode('ascii').lower(), None)
+        if method is None:
+            return b'TAG BAD unknown command\r\n'
+
+        return method(args)
+
+    def capability(self, args):
+        return (
+            b'* CAPABILITY IMAP4rev1 LITERAL+\r\n'
+            b'TAG OK CAPABILITY completed\r\n'
+        )
+
+    def login(self, args):
+        return b'TAG OK LOGIN completed\r\n'
+
+    def list(self, args):
+        return b''.join(
+            '* LIST () "." "{}"\r\n'.format(name).encode('ascii')
+            for name in self.folders
+        ) + b'TAG OK LIST completed\r\n'
+
+    def status(self, args):
+        name = args.split(' ', 1)[0].strip('"')
+        return (
+            '* STATUS "{}" (MESSAGES {})\r\n'
+            'TAG OK STATUS completed\r\n'.format(
+                name, len(self.folders[name]),
+            ).encode('ascii')
+        )
+
+    def examine(self, args):
+        self.selected = self.folders[args.strip('"')]
+        return (
+            '* {} EXISTS\r\n'
+            'TAG OK [READ-ONLY] EXAMINE completed\r\n'.format(
+                len(self.selected),
+            ).encode('ascii')
+        )
+
+    def search(self, args):
+        nums = ''.join(' {}'.format(i + 1) for i in range(len(self.selected)))
+        return '* SEARCH{}\r\nTAG OK SEARCH completed\r\n'.format(
+            nums,
+        ).encode('ascii')
+
+    def fetch(self, args):
+        num, item = args.split(' ', 1)
+        num = int(num)
+        body = self.selected[num - 1]
+        literal = '* {} FETCH ({} {{{}}}\r\n'.format(
+            num, item.strip('()'), len(body),
+        )
+        return (
+            literal.encode('ascii') + body +
+            b')\r\nTAG OK FETCH completed\r\n'
+        )
+
+    def logout(self, args):
+        return b'* BYE logging out\r\nTAG OK LOGOUT completed\r\n'
+
+
+async def connect(stream):
+    async def open_connection(*args, **kwargs):
+        return stream.reader, stream
+
+    client = aioimap.IMAPClient('imap.example.com')
+    with mock.patch('asyncio.open_connection', open_connection):
+        await client.connect()
+    return client
+
+
+FOLDERS = {
+    'Empty': [],
+    'Work': [b'one', b'two\r\nlines', b'three'],
+    'Home': [b'four'],
+}
+
+
+class IMAPClientTest(unittest.TestCase):
+    def test_pipelined_status(self):
+        async def main():
+            stream = FakeStream(FakeServer(FOLDERS))
+            client = await connect(stream)
+            self.assertIn('LITERAL+', client.capabilities)
+            stream.batch = 3
+            results = await asyncio.gather(*(
+                client.status('"{}"'.format(name), '(MESSAGES)')
+                for name in ('Empty', 'Work', 'Home')
+            ))
+            self.assertEqual([
+                ('OK', [b'"Empty" (MESSAGES 0)']),
+                ('OK', [b'"Work" (MESSAGES 3)']),
+                ('OK', [b'"Home" (MESSAGES 1)']),
+            ], results)
+            self.assertEqual({}, client._pending)
+            stream.batch = 1
+            await client.logout()
+
+        asyncio.run(main())
+
+    def test_pipelined_fetch(self):
+        async def main():
+            stream = FakeStream(FakeServer(FOLDERS))
+            client = await connect(stream)
+            typ, data = await client.select('"Work"', readonly=True)
+            self.assertEqual(('OK', [b'3']), (typ, data))
+            # Responses arrive for the last command first.
+            stream.batch = 3
+            stream.reverse = True
+            results = await asyncio.gather(*(
+                client.fetch(str(num), '(BODY[])') for num in (1, 2, 3)
+            ))
+            self.assertEqual([
+                ('OK', [(b'1 (BODY[] {3}', b'one'), b')']),
+                ('OK', [(b'2 (BODY[] {10}', b'two\r\nlines'), b')']),
+                ('OK', [(b'3 (BODY[] {5}', b'three'), b')']),
+            ], results)
+            self.assertEqual({}, client._fetches)
+            stream.batch = 1
+            stream.reverse = False
+            await client.logout()
+
+        asyncio.run(main())
+
+    def test_logout(self):
+        async def main():
+            stream = FakeStream(FakeServer(FOLDERS))
+            client = await connect(stream)
+            task = client._reader_task
+            await client.logout()
+            self.assertTrue(stream.closed)
+            await asyncio.sleep(0)
+            self.assertTrue(task.done())
+
+            # The server hanging up right after BYE is fine, too.
+            stream = FakeStream(FakeServer(FOLDERS))
+            client = await connect(stream)
+            stream.handler = lambda line: b'* BYE logging out\r\n'
+            logout = asyncio.ensure_future(client.logout())
+            await asyncio.sleep(0)
+            stream.reader.feed_eof()
+            await logout
+            self.assertTrue(stream.closed)
+
+        asyncio.run(main())
+
+    def test_unexpected_bye(self):
+        async def main():
+            stream = FakeStream(FakeServer(FOLDERS))
+            client = await connect(stream)
+            stream.handler = lambda line: b'* BYE server shutting down\r\n'
+            with self.assertRaises(aioimap.IMAPClient.abort):
+                await client.status('"Work"', '(MESSAGES)')
+            # The connection is unusable afterwards.
+            with self.assertRaises(aioimap.IMAPClient.abort):
+                await client.status('"Home"', '(MESSAGES)')
+            await client.logout()
+
+        asyncio.run(main())
+
+    def test_bad_command(self):
+        async def main():
+            stream = FakeStream(FakeServer(FOLDERS))
+            client = await connect(stream)
+            with self.assertRaisesRegex(aioimap.IMAPClient.error, 'NOOP'):
+                await client.simple_command('NOOP')
+            self.assertEqual(
+                ('OK', [b'"Home" (MESSAGES 1)']),
+                await client.status('"Home"', '(MESSAGES)'),
+            )
+            await client.logout()
+
+        asyncio.run(main())
+
+
+def note(uuid, subject):
+    return message(subject, uuid, subject)
+
+
+def list_tree(root):
+    files = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != '.zzyzx']
+        reldir = os.path.relpath(dirpath, root)
+        for name in dirnames + filenames:
+            files.add(os.path.normpath(os.path.join(reldir, name)))
+    return files
+
+
+class BackupTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo_path = tmp.name
+        # Left over from an earlier backup.
+        for name in ('Work/.OLD', 'Gone/.GONE'):
+            path = os.path.join(self.repo_path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(note(name, 'old'))
+            os.symlink(path, os.path.join(os.path.dirname(path), 'old.eml'))
+
+    def test_backup_all(self):
+        server = FakeServer({
+            'INBOX.Notes': [note('R', 'top')],
+            'INBOX.Notes.Empty': [],
+            'INBOX.Notes.Work': [note('A', 'one'), note('B', 'two')],
+        })
+        cfg = configparser.RawConfigParser()
+        cfg.read_string('[server]\nhost=imap.example.com\n[backup]\n')
+        metadata = backup.new_metadata()
+
+        async def open_connection(*args, **kwargs):
+            stream = FakeStream(server)
+            return stream.reader, stream
+
+        with mock.patch('asyncio.open_connection', open_connection):
+            asyncio.run(backup.backup_all_async(
+                cfg, self.repo_path, 'INBOX.Notes', metadata,
+                ('user', 'secret'),
+            ))
+        self.assertEqual({
+            '.R', 'top.eml', 'Empty',
+            'Work', 'Work/.A', 'Work/one.eml', 'Work/.B', 'Work/two.eml',
+        }, list_tree(self.repo_path))
+        with open(os.path.join(self.repo_path, 'Work', 'two.eml'), 'rb') as f:
+            self.assertEqual(note('B', 'two'), f.read())
+        # Empty folders are skipped after STATUS.
+        self.assertNotIn(
+            ('EXAMINE', '"INBOX.Notes.Empty"'), server.commands,
+        )
+        self.assertIn(('EXAMINE', '"INBOX.Notes.Work"'), server.commands)
+        self.assertEqual(2, metadata['deleted_files'])
+        self.assertEqual(1, metadata['deleted_dirs'])
+        self.assertEqual(3, metadata['updated_dirs'])
+
+    def test_fetch_window(self):
+        notes = [note(str(i), 'note {}'.format(i)) for i in range(5)]
+        notes_dir = os.path.join(self.repo_path, 'Work')
+
+        async def main():
+            stream = FakeStream(FakeServer({'Work': notes}))
+            client = await connect(stream)
+            fetch = client.fetch
+            in_flight = []
+            peak = 0
+
+            async def counting_fetch(num, parts):
+                nonlocal peak
+                in_flight.append(num)
+                peak = max(peak, len(in_flight))
+                try:
+                    return await fetch(num, parts)
+                finally:
+                    in_flight.remove(num)
+
+            client.fetch = counting_fetch
+            d = types.SimpleNamespace(name_querysafe='"Work"')
+            updated_files = await backup.backup_mailbox_async(
+                client, d, notes_dir, window=2,
+            )
+            await client.logout()
+            return updated_files, peak
+
+        updated_files, peak = asyncio.run(main())
+        self.assertEqual(2, peak)
+        self.assertEqual(
+            {'.{}'.format(i) for i in range(5)} |
+            {'note_{}.eml'.format(i) for i in range(5)},
+            updated_files,
+        )
+        for i, raw in enumerate(notes):
+            with open(os.path.join(notes_dir, '.{}'.format(i)), 'rb') as f:
+                self.assertEqual(raw, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
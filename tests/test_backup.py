@@ -0,0 +1,151 @@
+import configparser
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from zzyzx import backup, util
+
+
+class AccountConfigsTest(unittest.TestCase):
+    def test_account_overrides_and_credentials(self):
+        cfg = configparser.RawConfigParser()
+        cfg.read_string(
+            '[server]\n'
+            'host=mail.example.com\n'
+            'user=default\n'
+            '[backup]\n'
+            'ignore_prefix=INBOX.Notes\n'
+            '[account:alice]\n'
+            'user=alice\n'
+            'pass=secret\n'
+            'repo_path=~/Alice\n'
+            '[account:bob]\n'
+            'host=imap.example.org\n'
+            'compress=no\n'
+            'repo_path=~/Bob\n'
+            'ignore_prefix=\n'
+        )
+        accounts = backup.account_configs(cfg)
+        self.assertEqual(sorted(accounts), ['alice', 'bob'])
+        alice, bob = accounts['alice'], accounts['bob']
+        self.assertEqual(
+            dict(alice['server']),
+            {'host': 'mail.example.com', 'user': 'alice', 'pass': 'secret'},
+        )
+        self.assertEqual(
+            dict(alice['backup']),
+            {'ignore_prefix': 'INBOX.Notes', 'repo_path': '~/Alice'},
+        )
+        self.assertEqual(
+            dict(bob['server']),
+            {'host': 'imap.example.org', 'compress': 'no'},
+        )
+        self.assertEqual(bob['backup']['ignore_prefix'], '')
+        self.assertEqual(dict(cfg['account:alice']), {'repo_path': '~/Alice'})
+
+
+class BackupAccountsTest(unittest.TestCase):
+    def test_failed_account(self):
+        async def backup_all_async(
+            cfg, repo_path, ignore_prefix, metadata, credentials,
+        ):
+            if repo_path.endswith('alice'):
+                raise KeyError('x-universally-unique-identifier')
+
+            metadata['updated_files'] = 2
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = os.path.join(tmp, 'zzyzx.ini')
+            with open(config_path, 'w') as f:
+                f.write(
+                    '[server]\n'
+                    'host=mail.example.com\n'
+                    '[backup]\n'
+                    'hg_path=\n'
+                    '[account:alice]\n'
+                    'user=alice\n'
+                    'pass=secret\n'
+                    'repo_path={0}/alice\n'
+                    '[account:bob]\n'
+                    'user=bob\n'
+                    'pass=secret\n'
+                    'repo_path={0}/bob\n'.format(tmp)
+                )
+            with mock.patch.object(
+                backup, 'backup_all_async', backup_all_async,
+            ):
+                result = CliRunner().invoke(
+                    util.cli,
+                    ['--config-path', config_path, 'backup', '--all'],
+                    obj={},
+                )
+        self.assertEqual(1, result.exit_code, result.output)
+        summary = result.output.split('Summary\n', 1)[1].splitlines()
+        self.assertEqual(
+            "alice: failed (KeyError: 'x-universally-unique-identifier')",
+            summary[0],
+        )
+        self.assertTrue(
+            summary[1].startswith('bob: updated 2 files in 0 directories'),
+        )
+        self.assertEqual('Error: 1 of 2 accounts failed', summary[2])
+
+
+class RepoFoldersTest(unittest.TestCase):
+    def test_top_level_folder(self):
+        with tempfile.TemporaryDirectory() as repo_path:
+            for name in ('.UUID', 'title.eml'):
+                with open(os.path.join(repo_path, name), 'w'):
+                    pass
+            metadata = backup.new_metadata()
+            with backup.RepoFolders(repo_path, metadata) as folders:
+                d = types.SimpleNamespace(name='INBOX.Notes')
+                notes_dir, old_files = folders.open(d, 'INBOX.Notes')
+            self.assertEqual(os.path.normpath(notes_dir), repo_path)
+            self.assertEqual(old_files, {'.UUID', 'title.eml'})
+
+    def test_top_level_stale_files(self):
+        with tempfile.TemporaryDirectory() as repo_path:
+            os.mkdir(os.path.join(repo_path, 'Work'))
+            for name in ('.KEEP', '.STALE', 'Work/.STALE'):
+                with open(os.path.join(repo_path, name), 'w'):
+                    pass
+            metadata = backup.new_metadata()
+            with backup.RepoFolders(repo_path, metadata) as folders:
+                for name in ('INBOX.Notes', 'INBOX.Notes.Work'):
+                    d = types.SimpleNamespace(name=name)
+                    notes_dir, old_files = folders.open(d, 'INBOX.Notes')
+                    backup.finish_folder(
+                        notes_dir, old_files, {'.KEEP'}, metadata,
+                    )
+            self.assertEqual(
+                sorted(os.listdir(repo_path)), ['.KEEP', '.zzyzx', 'Work'],
+            )
+            self.assertEqual(os.listdir(os.path.join(repo_path, 'Work')), [])
+            self.assertEqual(metadata['deleted_files'], 2)
+
+
+class FolderNameTest(unittest.TestCase):
+    def test_inverse_of_create_directories(self):
+        with tempfile.TemporaryDirectory() as repo_path:
+            for name, prefix in [
+                ('INBOX.Notes', 'INBOX.Notes'),
+                ('INBOX.Notes.Work.Été', 'INBOX.Notes'),
+                ('Notes.Home', None),
+            ]:
+                path = backup.create_directories(name, repo_path, prefix)
+                reldir = os.path.relpath(path, repo_path)
+                if reldir == os.curdir:
+                    reldir = ''
+                self.assertEqual(backup.folder_name(reldir, prefix), name)
+
+    def test_nfc(self):
+        self.assertEqual(
+            backup.folder_name('Work/E\u0301te\u0301', 'INBOX.Notes'),
+            'INBOX.Notes.Work.Été',
+        )
+        self.assertIsNone(backup.folder_name(''))
@@ -0,0 +1,73 @@
+import base64
+import io
+import os
+import tempfile
+import unittest
+
+from zzyzx import blobs
+
+
+def message(attachment, text=b'<div>text</div>'):
+    encoded = base64.encodebytes(attachment).replace(b'\n', b'\r\n')
+    return (
+        b'Date: Tue, 2 Jan 2018 10:00:00 +0000\r\n'
+        b'Content-Type: multipart/mixed; boundary="b"\r\n'
+        b'\r\n'
+        b'--b\r\n'
+        b'Content-Type: text/html\r\n'
+        b'\r\n'
+    ) + text + (
+        b'\r\n'
+        b'--b\r\n'
+        b'Content-Type: application/octet-stream\r\n'
+        b'Content-Transfer-Encoding: base64\r\n'
+        b'\r\n'
+    ) + encoded + b'--b--\r\n'
+
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = blobs.BlobStore(tmp.name)
+
+    def test_split_and_reassemble(self):
+        attachment = os.urandom(blobs.MIN_SIZE)
+        raw = message(attachment)
+        split = self.store.split(raw)
+        self.assertTrue(split.startswith(blobs.HEADER))
+        self.assertLess(len(split), 1024)
+        self.assertEqual(self.store.join(split), raw)
+        self.assertEqual(
+            list(self.store.reassemble(io.BytesIO(split))),
+            list(io.BytesIO(raw)),
+        )
+        path = os.path.join(self.store.root, 'note')
+        with open(path, 'wb') as f:
+            f.write(split)
+        digests = self.store.references(path)
+        self.assertEqual(len(digests), 1)
+        digest = digests.pop()
+        self.assertIsNone(self.store.check(digest))
+
+        # An edited text refers to the same blob.
+        edited = message(attachment, b'<div>edited</div>')
+        split = self.store.split(edited)
+        self.assertIn(digest.encode('ascii'), split)
+        self.assertEqual(self.store.join(split), edited)
+
+        with open(self.store.path(digest), 'ab') as f:
+            f.write(b'bitrot')
+        self.assertEqual(self.store.check(digest), 'corrupt')
+        os.unlink(self.store.path(digest))
+        self.assertEqual(self.store.check(digest), 'missing')
+
+    def test_unchanged(self):
+        small = message(b'small')
+        self.assertEqual(self.store.split(small), small)
+        self.assertEqual(self.store.join(small), small)
+        # Couldn't be told apart from a marker when reassembling.
+        marker = b'zzyzx-blob:' + b'0' * 64
+        raw = message(os.urandom(blobs.MIN_SIZE), marker)
+        self.assertEqual(self.store.split(raw), raw)
+        self.assertFalse(os.path.exists(self.store.root))
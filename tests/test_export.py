@@ -0,0 +1,58 @@
+import base64
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+
+from zzyzx import export
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, cls, path):
+        with cls(path) as exporter:
+            with exporter.open_binary('Notes/a1.bin', (1.0, 2.0)) as f:
+                f.write(b'\x00\x01')
+                f.write(b'\x02\x03\x04')
+            exporter.write_text(
+                'Notes/a.md', 'text', (1.0, 2.0), ['Notes/a1.bin'],
+            )
+
+    def test_jsonl(self):
+        path = os.path.join(self.tmp.name, 'out.jsonl')
+        self.write(export.JsonlExport, path)
+        with open(path, 'rb') as f:
+            attachment, note = [json.loads(line) for line in f]
+            f.seek(note['attachments'][0]['offset'])
+            self.assertEqual(json.loads(f.readline()), attachment)
+        self.assertEqual(base64.b64decode(attachment['data']), bytes(range(5)))
+        self.assertEqual(note['text'], 'text')
+        self.assertEqual(note['created'], 1.0)
+        self.assertEqual(note['modified'], 2.0)
+
+    def test_tar(self):
+        path = os.path.join(self.tmp.name, 'out.tar.gz')
+        self.write(export.TarExport, path)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        with tarfile.open(path) as tar:
+            self.assertEqual(tar.getnames(), ['Notes/a1.bin', 'Notes/a.md'])
+            self.assertEqual(
+                tar.extractfile('Notes/a1.bin').read(), bytes(range(5)),
+            )
+            self.assertEqual(tar.getmember('Notes/a.md').mtime, 2.0)
+
+    def test_failed_export_keeps_previous_archive(self):
+        path = os.path.join(self.tmp.name, 'out.zip')
+        with open(path, 'wb') as f:
+            f.write(b'previous')
+        with self.assertRaises(RuntimeError):
+            with export.ZipExport(path) as exporter:
+                exporter.write_text('a.md', 'text', (1.0, 2.0))
+                raise RuntimeError
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'previous')
+        self.assertFalse(os.path.exists(path + '.tmp'))
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from zzyzx import inotify
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'requires Linux')
+class InotifyTest(unittest.TestCase):
+    def test_events(self):
+        with tempfile.TemporaryDirectory() as root:
+            watcher = inotify.Inotify()
+            self.addCleanup(watcher.close)
+            watcher.add_watch(
+                root, inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+                inotify.IN_DELETE,
+            )
+            path = os.path.join(root, 'note')
+            with open(path, 'w'):
+                pass
+            os.mkdir(os.path.join(root, 'dir'))
+            os.unlink(path)
+
+            events = []
+            while len(events) < 4:
+                new = watcher.read(timeout=1)
+                self.assertTrue(new)
+                events.extend(new)
+            self.assertEqual(
+                [
+                    (path, inotify.IN_CREATE),
+                    (path, inotify.IN_CLOSE_WRITE),
+                    (
+                        os.path.join(root, 'dir'),
+                        inotify.IN_CREATE | inotify.IN_ISDIR,
+                    ),
+                    (path, inotify.IN_DELETE),
+                ],
+                events,
+            )
+            self.assertEqual(watcher.read(timeout=0), [])
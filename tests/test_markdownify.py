@@ -160,5 +160,70 @@ class MarkdownifyTest(unittest.TestCase):
         )
 
 
+class FastParserTest(unittest.TestCase):
+    def assertSameAsHtml5lib(self, html):
+        fast = markdownify.MarkdownConverter().convert(html)
+        slow = markdownify.MarkdownConverter(fast_parser=False).convert(html)
+        self.assertEqual(slow, fast)
+
+    def test_simple_notes(self):
+        for html in (
+            'Title<div><br></div><div>One <b>two</b> <i>three</i></div>\r\n',
+            '<div><a href="http://example.com/?a=1">link</a>&amp;</div>',
+            '<ul>\n<li>One<ol><li>Two</li><li></li></ol></li>\n</ul>',
+            '<div><img src="a.png" alt="x"><br/><span>x_y</span></div>',
+        ):
+            with self.subTest(html=html):
+                self.assertIsNotNone(markdownify.FastParser.parse(html))
+                self.assertSameAsHtml5lib(html)
+
+    def test_falls_back_to_html5lib(self):
+        for html in (
+            '<div>unclosed',
+            '<div><b>misnested</div></b>',
+            '<p>para</p>',
+            '<!-- comment -->',
+            '<a href="1"><a href="2">nested</a></a>',
+            '<div><li>no list</li></div>',
+            '<div/>self-closing',
+            '<a href="?a=1&amp">reference</a>',
+            'unfinished <b',
+            '</ b>',
+            'null\x00',
+        ):
+            with self.subTest(html=html):
+                self.assertIsNone(markdownify.FastParser.parse(html))
+                self.assertSameAsHtml5lib(html)
+
+
+class ProfileTest(unittest.TestCase):
+    def test_profile(self):
+        html = (
+            '<div>Title</div>'
+            '<ul><li><i>one</i></li><li><i>two</i></li></ul>'
+            '<div><br></div>'
+        )
+        converter = markdownify.MarkdownConverter(profile=True)
+        self.assertEqual(
+            converter.convert(html, 'note'),
+            markdownify.MarkdownConverter().convert(html),
+        )
+        profile, = converter.profiles
+        self.assertEqual(profile.name, 'note')
+        self.assertEqual(profile.size, len(html))
+        self.assertEqual(profile.parser, 'fast')
+        self.assertEqual(profile.nodes['li'], 2)
+        self.assertEqual(profile.nodes['i'], 2)
+        self.assertEqual(profile.nodes[markdownify.TEXT], 3)
+        self.assertEqual(profile.node_count(), 12)
+        self.assertEqual(
+            profile.dominant(1), [('div', 3, profile.times['div'])],
+        )
+        self.assertGreaterEqual(profile.total_time, profile.parse_time)
+
+        converter.convert('<p>html5lib</p>')
+        self.assertEqual(converter.profiles[-1].parser, 'html5lib')
+
+
 if __name__ == '__main__':
     unittest.main()
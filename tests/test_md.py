@@ -0,0 +1,236 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from helpers import FakeConverter, message, read_tree, write_note
+from zzyzx import inotify, md, util
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'requires Linux')
+class MarkdownWatcherTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo_path = os.path.join(tmp.name, 'repo')
+        self.markdown_path = os.path.join(tmp.name, 'md')
+        work = os.path.join(self.repo_path, 'Work')
+        self.note = write_note(work, '.A', 'a', 'x')
+        self.title = os.path.join(work, 'x.eml')
+        write_note(self.repo_path, '.R', 'r', 'r')
+        self.converter = FakeConverter()
+        self.watcher = md.MarkdownWatcher(
+            self.repo_path, self.markdown_path, '.txt', self.converter,
+            use_tags=False,
+        )
+        self.addCleanup(self.watcher.inotify.close)
+        self.watcher.resync()
+        self.assertEqual(
+            {'Work/x.txt': 'a', 'r.txt': 'r'}, read_tree(self.markdown_path),
+        )
+        self.converter.converted.clear()
+
+    def process(self, *events):
+        self.watcher.process([
+            (os.path.join(self.repo_path, path) if path else None, mask)
+            for path, mask in events
+        ])
+        converted = [
+            os.path.relpath(p, self.repo_path)
+            for p in self.converter.converted
+        ]
+        self.converter.converted.clear()
+        return converted
+
+    def test_changed_note(self):
+        with open(self.note, 'wb') as f:
+            f.write(message('b'))
+        converted = self.process(('Work/.A', inotify.IN_CLOSE_WRITE))
+        self.assertEqual(['Work/x.eml'], converted)
+        self.assertEqual('b', read_tree(self.markdown_path)['Work/x.txt'])
+
+        # Backups rewrite notes, unchanged ones aren't converted again.
+        with open(self.note, 'wb') as f:
+            f.write(message('b'))
+        os.unlink(self.title)
+        os.symlink(self.note, self.title)
+        converted = self.process(
+            ('Work/.A', inotify.IN_CLOSE_WRITE),
+            ('Work/x.eml', inotify.IN_DELETE),
+            ('Work/x.eml', inotify.IN_CREATE),
+        )
+        self.assertEqual([], converted)
+
+    def test_renamed_note(self):
+        os.unlink(self.title)
+        os.symlink(self.note, os.path.join(self.repo_path, 'Work', 'y.eml'))
+        converted = self.process(
+            ('Work/x.eml', inotify.IN_DELETE),
+            ('Work/y.eml', inotify.IN_CREATE),
+        )
+        self.assertEqual(['Work/y.eml'], converted)
+        self.assertEqual(
+            {'Work/y.txt': 'a', 'r.txt': 'r'}, read_tree(self.markdown_path),
+        )
+
+    def test_created_and_deleted_directory(self):
+        write_note(os.path.join(self.repo_path, 'Home'), '.H', 'h', 'h')
+        converted = self.process(
+            ('Home', inotify.IN_CREATE | inotify.IN_ISDIR),
+        )
+        self.assertEqual(['Home/h.eml'], converted)
+        self.assertIn(
+            os.path.join(self.repo_path, 'Home'),
+            self.watcher.inotify.watches.values(),
+        )
+        self.assertEqual('h', read_tree(self.markdown_path)['Home/h.txt'])
+
+        shutil.rmtree(os.path.join(self.repo_path, 'Home'))
+        converted = self.process(
+            ('Home/h.eml', inotify.IN_DELETE),
+            ('Home', inotify.IN_DELETE | inotify.IN_ISDIR),
+        )
+        self.assertEqual([], converted)
+        self.assertEqual(
+            {'Work/x.txt': 'a', 'r.txt': 'r'}, read_tree(self.markdown_path),
+        )
+
+    def test_moved_directory(self):
+        office = os.path.join(self.repo_path, 'Office')
+        os.rename(os.path.join(self.repo_path, 'Work'), office)
+        # Title symlinks are absolute.
+        os.unlink(os.path.join(office, 'x.eml'))
+        os.symlink(os.path.join(office, '.A'), os.path.join(office, 'x.eml'))
+        # Watches now have stale paths, everything is converted again.
+        converted = self.process(
+            ('Work', inotify.IN_MOVED_FROM | inotify.IN_ISDIR),
+            ('Office', inotify.IN_MOVED_TO | inotify.IN_ISDIR),
+        )
+        self.assertEqual(['Office/x.eml', 'r.eml'], sorted(converted))
+        self.assertEqual(
+            {'Office/x.txt': 'a', 'r.txt': 'r'},
+            read_tree(self.markdown_path),
+        )
+
+        # A folder moved into the repository is picked up without that.
+        outside = os.path.join(os.path.dirname(self.repo_path), 'Home')
+        home = os.path.join(self.repo_path, 'Home')
+        write_note(outside, '.H', 'h', 'h')
+        os.rename(outside, home)
+        os.unlink(os.path.join(home, 'h.eml'))
+        os.symlink(os.path.join(home, '.H'), os.path.join(home, 'h.eml'))
+        converted = self.process(
+            ('Home', inotify.IN_MOVED_TO | inotify.IN_ISDIR),
+        )
+        self.assertEqual(['Home/h.eml'], converted)
+
+    def test_lost_events(self):
+        converted = self.process((None, inotify.IN_Q_OVERFLOW))
+        self.assertEqual(['Work/x.eml', 'r.eml'], sorted(converted))
+
+    def test_ignored_dirs(self):
+        os.mkdir(os.path.join(self.repo_path, '.hg'))
+        converted = self.process(
+            ('.hg', inotify.IN_CREATE | inotify.IN_ISDIR),
+        )
+        self.assertEqual([], converted)
+
+
+@unittest.skipUnless(shutil.which('hg'), 'requires Mercurial')
+class RevisionTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.repo_path = os.path.join(tmp.name, 'repo')
+        self.markdown_path = os.path.join(tmp.name, 'md')
+        write_note(self.repo_path, '.R', 'r', 'r')
+        write_note(os.path.join(self.repo_path, 'Work', 'Sub'), '.S', 's', 's')
+        # A sharded note with two titles.
+        work = os.path.join(self.repo_path, 'Work')
+        shard = os.path.join(work, util.shard_name('.A'))
+        note = write_note(shard, '.A', 'a')
+        os.symlink(note, os.path.join(work, 'x.eml'))
+        os.symlink(note, os.path.join(work, 'y.eml'))
+        self.hg('init')
+        self.hg('commit', '-A', '-m', 'first')
+        with open(os.path.join(self.repo_path, '.R'), 'wb') as f:
+            f.write(message('changed'))
+        shutil.rmtree(os.path.join(work, 'Sub'))
+        self.hg('commit', '-A', '-m', 'second')
+
+    def hg(self, *args):
+        subprocess.run(
+            ['hg', '--config', 'ui.username=test'] + list(args),
+            check=True,
+            stdout=subprocess.DEVNULL,
+            cwd=self.repo_path,
+        )
+
+    def invoke(self, *args):
+        config_path = os.path.join(self.tmp, 'zzyzx.ini')
+        with open(config_path, 'w') as f:
+            f.write(
+                '[backup]\nrepo_path={}\n[markdown]\npath={}\n'.format(
+                    self.repo_path, self.markdown_path,
+                ),
+            )
+        return CliRunner().invoke(
+            util.cli, ['--config-path', config_path, 'md'] + list(args),
+            obj={},
+        )
+
+    def test_gen_revision_notes(self):
+        notes = {}
+        for eml, src in md.gen_revision_notes('hg', self.repo_path, '0'):
+            notes[eml] = src if isinstance(src, bytes) else src.read()
+        self.assertEqual({
+            'r.eml': message('r'),
+            'Work/x.eml': message('a'),
+            'Work/y.eml': message('a'),
+            'Work/Sub/s.eml': message('s'),
+        }, notes)
+
+        notes = md.gen_revision_notes('hg', self.repo_path, '1')
+        self.assertEqual(
+            ['Work/x.eml', 'Work/y.eml', 'r.eml'],
+            sorted(eml for eml, _ in notes),
+        )
+
+    def test_export(self):
+        result = self.invoke()
+        self.assertEqual(0, result.exit_code, result.output)
+        current = read_tree(self.markdown_path)
+        self.assertEqual('changed', current['r.txt'])
+
+        # The current export is left alone.
+        result = self.invoke('--rev', '0')
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn('--rev needs --path', result.output)
+        result = self.invoke('--rev', '0', '--path', self.markdown_path)
+        self.assertNotEqual(0, result.exit_code)
+        old_path = os.path.join(self.tmp, 'old')
+        result = self.invoke('--rev', '0', '--path', old_path)
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual(current, read_tree(self.markdown_path))
+        self.assertEqual({
+            'r.txt': 'r',
+            'Work/x.txt': 'a',
+            'Work/y.txt': 'a',
+            'Work/Sub/s.txt': 's',
+        }, read_tree(old_path))
+
+    def test_no_repository(self):
+        shutil.rmtree(os.path.join(self.repo_path, '.hg'))
+        result = self.invoke('--rev', '0', '--path', self.tmp)
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIn('--rev needs Mercurial', result.output)
+        self.assertFalse(os.path.exists(os.path.join(self.repo_path, '.hg')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from helpers import message, write_note
+from zzyzx import migrate, util
+
+
+def read_titles(repo_path):
+    """Returns {title symlink: (target relative to repo, content)}."""
+    titles = {}
+    for dirpath, dirnames, filenames in os.walk(repo_path):
+        dirnames[:] = [d for d in dirnames if d not in util.IGNORED_DIRS]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path):
+                continue
+
+            with open(path, 'rb') as f:
+                titles[os.path.relpath(path, repo_path)] = (
+                    os.path.relpath(os.readlink(path), repo_path),
+                    f.read(),
+                )
+    return titles
+
+
+def sharded(reldir, filename):
+    return os.path.join(reldir, util.shard_name(filename), filename)
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.repo_path = os.path.join(tmp.name, 'repo')
+        self.work = os.path.join(self.repo_path, 'Work')
+        write_note(self.work, '.A', 'a', 'x', 'y')
+        write_note(self.work, '.B', 'b', 'z')
+        write_note(os.path.join(self.work, 'Sub'), '.S', 's', 's')
+        write_note(self.repo_path, '.R', 'r', 'r')
+        a, b, s, r = map(message, 'absr')
+        self.flat = {
+            'Work/x.eml': ('Work/.A', a),
+            'Work/y.eml': ('Work/.A', a),
+            'Work/z.eml': ('Work/.B', b),
+            'Work/Sub/s.eml': ('Work/Sub/.S', s),
+            'r.eml': ('.R', r),
+        }
+        self.sharded = {
+            'Work/x.eml': (sharded('Work', '.A'), a),
+            'Work/y.eml': (sharded('Work', '.A'), a),
+            'Work/z.eml': (sharded('Work', '.B'), b),
+            'Work/Sub/s.eml': (sharded('Work/Sub', '.S'), s),
+            'r.eml': (sharded('', '.R'), r),
+        }
+        self.assertEqual(self.flat, read_titles(self.repo_path))
+
+    def invoke(self, layout):
+        config_path = os.path.join(self.tmp, 'zzyzx.ini')
+        with open(config_path, 'w') as f:
+            f.write('[backup]\nrepo_path={}\nlayout={}\n'.format(
+                self.repo_path, layout,
+            ))
+        result = CliRunner().invoke(
+            util.cli, ['--config-path', config_path, 'migrate'], obj={},
+        )
+        self.assertEqual(0, result.exit_code, result.output)
+        return result.output
+
+    def hg(self, *args):
+        return subprocess.run(
+            ['hg'] + list(args),
+            check=True,
+            stdout=subprocess.PIPE,
+            cwd=self.repo_path,
+        ).stdout.decode('utf8')
+
+    def test_migrate_folder(self):
+        moves = migrate.migrate_folder(self.work, sharded=True)
+        self.assertEqual({
+            '.A': os.path.join(util.shard_name('.A'), '.A'),
+            '.B': os.path.join(util.shard_name('.B'), '.B'),
+        }, moves)
+        self.assertEqual({}, migrate.migrate_folder(self.work, sharded=True))
+
+        moves = migrate.migrate_folder(self.work, sharded=False)
+        self.assertEqual({
+            os.path.join(util.shard_name('.A'), '.A'): '.A',
+            os.path.join(util.shard_name('.B'), '.B'): '.B',
+        }, moves)
+        self.assertEqual({}, migrate.migrate_folder(self.work, sharded=False))
+        self.assertEqual(self.flat, read_titles(self.repo_path))
+        # Emptied shards are deleted.
+        self.assertEqual(
+            ['.A', '.B', 'Sub', 'x.eml', 'y.eml', 'z.eml'],
+            sorted(os.listdir(self.work)),
+        )
+
+    @unittest.skipUnless(shutil.which('hg'), 'requires Mercurial')
+    def test_migrate(self):
+        manifest = util.Manifest(self.repo_path)
+        manifest.update_dir(self.repo_path, ['.R'])
+        manifest.update_dir(self.work, ['.A', '.B'])
+        manifest.update_dir(os.path.join(self.work, 'Sub'), ['.S'])
+        manifest.save()
+        entries = manifest.entries
+        self.hg('init')
+        self.hg('commit', '-A', '-u', 'test', '-m', 'backup')
+
+        output = self.invoke('sharded')
+        self.assertIn('Moved 2 notes', output)
+        self.assertEqual(self.sharded, read_titles(self.repo_path))
+        manifest = util.Manifest(self.repo_path)
+        self.assertEqual({
+            sharded(os.path.dirname(path), os.path.basename(path)): entry
+            for path, entry in entries.items()
+        }, manifest.entries)
+        self.assertEqual('', self.hg('status'))
+        self.assertIn(
+            sharded('Work', '.A') + ' <- Work/.A',
+            self.hg(
+                'log', '-r', '.',
+                '-T', '{file_copies % "{name} <- {source}\\n"}',
+            ),
+        )
+
+        # Nothing left to move.
+        output = self.invoke('sharded')
+        self.assertEqual('All notes already use the sharded layout.\n', output)
+        self.assertEqual('1\n', self.hg('log', '-r', '.', '-T', '{rev}\n'))
+
+        self.invoke('flat')
+        self.assertEqual(self.flat, read_titles(self.repo_path))
+        self.assertEqual(entries, util.Manifest(self.repo_path).entries)
+        self.assertEqual('', self.hg('status'))
+        output = self.invoke('flat')
+        self.assertEqual('All notes already use the flat layout.\n', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import base64
+import unittest
+
+from zzyzx import mime
+
+
+def lines(raw):
+    return raw.splitlines(keepends=True)
+
+
+class MessageReaderTest(unittest.TestCase):
+    def test_nested_multipart(self):
+        attachment = bytes(range(256)) * 10
+        encoded = base64.encodebytes(attachment).replace(b'\n', b'\r\n')
+        raw = (
+            b'Date: Tue, 2 Jan 2018 10:00:00 +0000\r\n'
+            b'Content-Type: multipart/mixed; boundary="outer"\r\n'
+            b'\r\n'
+            b'preamble\r\n'
+            b'--outer\r\n'
+            b'Content-Type: multipart/alternative; boundary="inner"\r\n'
+            b'\r\n'
+            b'--inner\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'Content-Transfer-Encoding: quoted-printable\r\n'
+            b'\r\n'
+            b'soft=\r\n'
+            b'break =C5=BC\r\n'
+            b'--inner\r\n'
+            b'Content-Type: text/html\r\n'
+            b'\r\n'
+            b'<div>html</div>\r\n'
+            b'--inner--\r\n'
+            b'--outer\r\n'
+            b'Content-Type: application/octet-stream\r\n'
+            b'Content-Transfer-Encoding: base64\r\n'
+            b'\r\n'
+        ) + encoded + (
+            b'--outer--\r\n'
+            b'epilogue\r\n'
+        )
+        reader = mime.MessageReader(lines(raw))
+        self.assertEqual(
+            'Tue, 2 Jan 2018 10:00:00 +0000', reader.headers['date'],
+        )
+        parts = [
+            (part.headers.get_content_type(), part.read())
+            for part in reader.parts()
+        ]
+        self.assertEqual(
+            [
+                ('text/plain', 'softbreak ż'.encode('utf8')),
+                ('text/html', b'<div>html</div>'),
+                ('application/octet-stream', attachment),
+            ],
+            parts,
+        )
+
+    def test_single_part(self):
+        raw = b'Subject: x\n\nline 1\nline 2\n'
+        reader = mime.MessageReader(lines(raw))
+        parts = [part.read() for part in reader.parts()]
+        self.assertEqual([b'line 1\nline 2\n'], parts)
+
+    def test_unconsumed_parts_are_skipped(self):
+        raw = (
+            b'Content-Type: multipart/mixed; boundary=b\n\n'
+            b'--b\n\nfirst\n--b\n\nsecond\n--b--\n'
+        )
+        reader = mime.MessageReader(lines(raw))
+        parts = list(reader.parts())
+        self.assertEqual(2, len(parts))
+        self.assertEqual(b'', parts[0].read())
+
+    def test_decode_base64_chunks(self):
+        data = b'zzyzx' * 100
+        encoded = base64.encodebytes(data)
+        # Split at odd positions so quanta span chunks.
+        chunks = [encoded[i:i + 7] for i in range(0, len(encoded), 7)]
+        self.assertEqual(data, b''.join(mime.decode_base64(chunks)))
+
+
+if __name__ == '__main__':
+    unittest.main()
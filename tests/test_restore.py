@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import click
+from click.testing import CliRunner
+
+from helpers import message
+from zzyzx import restore, util
+
+
+def note(uuid, text='text'):
+    return message(text, uuid)
+
+
+class FakeConnection:
+    def __init__(self, capabilities=('IMAP4REV1', 'MULTIAPPEND')):
+        self.capabilities = capabilities
+        self.created = []
+        self.commands = []  # (mailbox, number of messages)
+        self.fail = False
+
+    def create(self, mailbox):
+        self.created.append(mailbox)
+        return 'OK', [b'CREATE completed']
+
+    def multiappend(self, mailbox, messages):
+        self.commands.append((mailbox, len(messages)))
+        return ('NO' if self.fail else 'OK'), [b'APPEND completed']
+
+    def append(self, mailbox, flags, date_time, message):
+        return self.multiappend(mailbox, [(flags, date_time, message)])
+
+
+class UploaderTest(unittest.TestCase):
+    def test_multiappend_batches(self):
+        conn = FakeConnection()
+        uploader = restore.Uploader(conn, {'INBOX.Notes': '"INBOX.Notes"'})
+        uploader.uuids.add('ON-SERVER')
+        with mock.patch.object(restore, 'BATCH_SIZE', 2):
+            for uuid in ('A', 'B', 'C', 'ON-SERVER', 'A'):
+                uploader.add('INBOX.Notes', note(uuid))
+            uploader.add('INBOX.Notes', b'Subject: not a note\r\n\r\n')
+            uploader.add('INBOX.Notes.Été', note('D'))
+            uploader.flush_all()
+        self.assertEqual(['"INBOX.Notes.&AMk-t&AOk-"'], conn.created)
+        self.assertEqual([
+            ('"INBOX.Notes"', 2),
+            ('"INBOX.Notes"', 1),
+            ('"INBOX.Notes.&AMk-t&AOk-"', 1),
+        ], conn.commands)
+        self.assertEqual(4, uploader.uploaded)
+        self.assertEqual(2, uploader.skipped)
+
+    def test_batch_bytes(self):
+        conn = FakeConnection()
+        uploader = restore.Uploader(conn, {'INBOX.Notes': '"INBOX.Notes"'})
+        with mock.patch.object(restore, 'BATCH_BYTES', 300):
+            uploader.add('INBOX.Notes', note('A', 'x' * 300))
+            self.assertEqual([('"INBOX.Notes"', 1)], conn.commands)
+            uploader.add('INBOX.Notes', note('B'))
+        self.assertEqual(1, len(conn.commands))
+        uploader.flush_all()
+        self.assertEqual(2, len(conn.commands))
+
+    def test_single_appends(self):
+        conn = FakeConnection(capabilities=('IMAP4REV1',))
+        conn.multiappend = mock.Mock(side_effect=AssertionError)
+        appended = []
+
+        def append(mailbox, flags, date_time, message):
+            appended.append((mailbox, flags, date_time.year, message))
+            return 'OK', [b'APPEND completed']
+
+        conn.append = append
+        uploader = restore.Uploader(conn, {'INBOX.Notes': '"INBOX.Notes"'})
+        uploader.add('INBOX.Notes', note('A'))
+        uploader.add('INBOX.Notes', note('B'))
+        uploader.flush_all()
+        self.assertEqual([
+            ('"INBOX.Notes"', restore.FLAGS, 2018, note('A')),
+            ('"INBOX.Notes"', restore.FLAGS, 2018, note('B')),
+        ], appended)
+        self.assertEqual(2, uploader.uploaded)
+
+    def test_failure(self):
+        for capabilities in (('MULTIAPPEND',), ()):
+            with self.subTest(capabilities=capabilities):
+                conn = FakeConnection(capabilities)
+                conn.fail = True
+                uploader = restore.Uploader(conn, {})
+                uploader.add('INBOX.Notes', note('A'))
+                with self.assertRaises(click.ClickException):
+                    uploader.flush_all()
+                self.assertEqual(0, uploader.uploaded)
+
+
+class RestoreTest(unittest.TestCase):
+    def test_rev_without_repository(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config_path = os.path.join(tmp, 'zzyzx.ini')
+            with open(config_path, 'w') as f:
+                f.write('[backup]\nrepo_path={}\n'.format(tmp))
+            result = CliRunner().invoke(
+                util.cli,
+                ['--config-path', config_path, 'restore', '--rev', 'tip'],
+                obj={},
+            )
+            self.assertEqual(1, result.exit_code, result.output)
+            self.assertIn('--rev needs Mercurial', result.output)
+            # The repository is only read from, nothing is initialized.
+            self.assertEqual(['zzyzx.ini'], os.listdir(tmp))
+
+
+if __name__ == '__main__':
+    unittest.main()
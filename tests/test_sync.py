@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import unittest
+
+from helpers import FakeConverter, message, read_tree
+from zzyzx import sync
+
+
+class MarkdownSyncTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo_path = os.path.join(tmp.name, 'repo')
+        self.markdown_path = os.path.join(tmp.name, 'md')
+        self.notes_dir = os.path.join(self.repo_path, 'Work')
+        os.makedirs(self.notes_dir)
+
+    def backup(self, notes):
+        """Saves `notes`: {filename: (title, text)}, like a backup would."""
+        listener = sync.MarkdownSync(
+            self.repo_path, self.markdown_path, '.md', FakeConverter(),
+            use_tags=False,
+        )
+        for name in os.listdir(self.notes_dir):
+            os.unlink(os.path.join(self.notes_dir, name))
+        updated_files = {}
+        for filename, (title, text) in sorted(notes.items()):
+            path = os.path.join(self.notes_dir, filename)
+            raw = message(text)
+            with open(path, 'wb') as f:
+                f.write(raw)
+            os.symlink(path, os.path.join(self.notes_dir, title + '.eml'))
+            listener.message_saved(self.notes_dir, filename, raw)
+            updated_files[filename] = None
+            updated_files[title + '.eml'] = None
+        # Only paths of changed notes are kept until the folder is saved.
+        self.assertTrue(all(isinstance(n, str) for n in listener.changed))
+        listener.folder_saved(self.notes_dir, updated_files)
+        listener.finish()
+
+    def exported(self):
+        return read_tree(self.markdown_path)
+
+    def state(self):
+        with open(os.path.join(self.markdown_path, sync.EXPORTED_PATH)) as f:
+            return {
+                name: entry['files'] for name, entry in json.load(f).items()
+            }
+
+    def test_rename(self):
+        self.backup({'.A': ('x', 'a'), '.B': ('z', 'b')})
+        self.assertEqual(
+            {'Work/x.md': 'a', 'Work/z.md': 'b'}, self.exported(),
+        )
+        self.backup({'.A': ('y', 'a'), '.B': ('z', 'b')})
+        self.assertEqual(
+            {'Work/y.md': 'a', 'Work/z.md': 'b'}, self.exported(),
+        )
+        self.assertEqual(
+            {'Work/.A': ['Work/y.md'], 'Work/.B': ['Work/z.md']},
+            self.state(),
+        )
+
+    def test_title_collision(self):
+        self.backup({'.A': ('x', 'a')})
+        # A new note takes over the old title of a renamed one.
+        self.backup({'.A': ('y', 'a'), '.C': ('x', 'c')})
+        self.assertEqual(
+            {'Work/x.md': 'c', 'Work/y.md': 'a'}, self.exported(),
+        )
+        self.assertEqual(
+            {'Work/.A': ['Work/y.md'], 'Work/.C': ['Work/x.md']},
+            self.state(),
+        )
+        # Titles swapped.
+        self.backup({'.A': ('x', 'a'), '.C': ('y', 'c')})
+        self.assertEqual(
+            {'Work/x.md': 'a', 'Work/y.md': 'c'}, self.exported(),
+        )
+
+    def test_removal(self):
+        self.backup({'.A': ('x', 'a'), '.B': ('z', 'b')})
+        self.backup({'.A': ('x', 'a')})
+        self.assertEqual({'Work/x.md': 'a'}, self.exported())
+        self.assertEqual({'Work/.A': ['Work/x.md']}, self.state())
+
+        # A deleted note's title taken over by a moved note is kept.
+        self.backup({'.D': ('x', 'a')})
+        self.assertEqual({'Work/x.md': 'a'}, self.exported())
+        self.assertEqual({'Work/.D': ['Work/x.md']}, self.state())
+
+
+if __name__ == '__main__':
+    unittest.main()
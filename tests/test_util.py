@@ -0,0 +1,454 @@
+import datetime
+import hashlib
+import os
+import re
+import socket
+import tempfile
+import unicodedata
+import unittest
+
+from zzyzx import util
+
+
+class ScanTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.addCleanup(self.tmp.cleanup)
+
+    def touch(self, *parts):
+        path = os.path.join(self.root, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w'):
+            pass
+        return path
+
+    def test_files_dirs_and_symlinks(self):
+        note = self.touch('Work', '.ABCD')
+        os.symlink(note, os.path.join(self.root, 'Work', 'title.eml'))
+        os.symlink(
+            os.path.join(self.root, 'missing'),
+            os.path.join(self.root, 'broken.eml'),
+        )
+        self.touch('.hg', 'dirstate')
+
+        scan = util.scan_tree(self.root)
+        work = os.path.join(self.root, 'Work')
+        self.assertEqual({work}, scan.dirs)
+        self.assertEqual({'.ABCD', 'title.eml'}, scan.files[work])
+        self.assertEqual({'broken.eml'}, scan.files[self.root])
+        self.assertEqual(
+            {
+                os.path.join(work, 'title.eml'),
+                os.path.join(self.root, 'broken.eml'),
+            },
+            scan.symlinks,
+        )
+
+    def test_nfd_normalization(self):
+        name = unicodedata.normalize('NFC', 'zażółć')
+        self.touch(name, 'gęślą.eml')
+
+        scan = util.scan_tree(self.root)
+        expected_dir = os.path.join(
+            self.root, unicodedata.normalize('NFD', name),
+        )
+        self.assertEqual({expected_dir}, scan.dirs)
+        self.assertEqual(
+            {unicodedata.normalize('NFD', 'gęślą.eml')},
+            scan.files[expected_dir],
+        )
+
+    def test_normalize_nfd_ascii(self):
+        self.assertEqual('plain', util.normalize_nfd('plain'))
+        self.assertEqual(
+            unicodedata.normalize('NFD', 'ą'), util.normalize_nfd('ą'),
+        )
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, *parts, data=b'note'):
+        path = os.path.join(self.root, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_update_retain_and_save(self):
+        self.write('.ROOT')
+        self.write('Work', '.A', data=b'')
+        note = self.write('Work', '.B')
+        os.symlink(note, os.path.join(self.root, 'Work', 'title.eml'))
+        self.write('Gone', '.C')
+
+        manifest = util.Manifest(self.root)
+        self.assertFalse(manifest.exists())
+        manifest.update_dir(self.root, {'.ROOT'})
+        manifest.update_dir(os.path.join(self.root, 'Gone'), {'.C'})
+        manifest.update_dir(
+            os.path.join(self.root, 'Work'), {'.A', '.B', 'title.eml'},
+        )
+        manifest.update_dir(os.path.join(self.root, 'Work'), {'.B'})
+        manifest.retain_dirs([self.root, os.path.join(self.root, 'Work')])
+        manifest.save()
+
+        loaded = util.Manifest(self.root)
+        self.assertTrue(loaded.exists())
+        self.assertEqual(['.ROOT', 'Work/.B'], sorted(loaded.entries))
+        entry = loaded.entries['Work/.B']
+        self.assertEqual(hashlib.sha256(b'note').hexdigest(), entry.digest)
+        self.assertEqual(4, entry.size)
+        self.assertEqual(os.stat(note).st_mtime_ns, entry.mtime_ns)
+        self.assertEqual({'': {'.ROOT'}, 'Work': {'Work/.B'}}, loaded.dirs)
+
+    def test_recorded_digests(self):
+        note = self.write('Work', '.A')
+        self.write('Work', '.B')
+        manifest = util.Manifest(self.root)
+        # Recorded digests are trusted, the file isn't read again.
+        manifest.record(note, 'recorded')
+        manifest.update_dir(os.path.join(self.root, 'Work'), {'.A', '.B'})
+        st = os.stat(note)
+        self.assertEqual(
+            util.manifest_entry('recorded', st.st_size, st.st_mtime_ns),
+            manifest.entries['Work/.A'],
+        )
+        self.assertEqual(
+            hashlib.sha256(b'note').hexdigest(),
+            manifest.entries['Work/.B'].digest,
+        )
+        self.assertEqual({}, manifest.written)
+
+    def test_shards_and_rename(self):
+        self.write('Work', '.A')
+        self.write('Work', '.ab', '.B')
+        manifest = util.Manifest(self.root)
+        manifest.update_dir(os.path.join(self.root, 'Work'), {'.A', '.ab/.B'})
+        manifest.rename('Work/.A', 'Work/.cd/.A')
+        manifest.rename('Work/.missing', 'Work/.ef/.missing')
+        self.assertEqual(
+            ['Work/.ab/.B', 'Work/.cd/.A'], sorted(manifest.entries),
+        )
+        self.assertEqual(
+            {'Work': {'Work/.ab/.B', 'Work/.cd/.A'}}, manifest.dirs,
+        )
+        manifest.update_dir(os.path.join(self.root, 'Work'), {'.A'})
+        self.assertEqual(['Work/.A'], sorted(manifest.entries))
+        manifest.retain_dirs([self.root])
+        self.assertEqual({}, manifest.entries)
+        self.assertEqual({}, manifest.dirs)
+
+
+class ParseHeadersTest(unittest.TestCase):
+    def test_header_block_only(self):
+        raw = (
+            b'Subject: =?utf-8?Q?Zak=C5=82adki?= i\r\n'
+            b' =?utf-8?B?xbzDs8WCdw==?=\r\n'
+            b'X-Universally-Unique-Identifier: 1234-ABCD\r\n'
+            b'Date: Tue, 2 Jan 2018 10:00:00 +0000\r\n'
+            b'Date: Wed, 3 Jan 2018 10:00:00 +0000\r\n'
+            b'\r\n'
+            b'Not-A-Header: body\r\n'
+        )
+        headers = util.parse_headers(raw)
+        self.assertEqual('1234-ABCD', headers['x-universally-unique-identifier'])
+        self.assertEqual('Tue, 2 Jan 2018 10:00:00 +0000', headers['date'])
+        self.assertNotIn('not-a-header', headers)
+        self.assertEqual(
+            'Zakładki i żółw', util.decode_header(headers['subject']),
+        )
+
+    def test_bare_newlines(self):
+        headers = util.parse_headers(b'Subject: plain\n\nbody: text\n')
+        self.assertEqual({'subject': 'plain'}, headers)
+        self.assertEqual('plain', util.decode_header(headers['subject']))
+
+
+class MailboxNameTest(unittest.TestCase):
+    def test_round_trip(self):
+        for name, encoded in [
+            ('INBOX.Notes', '"INBOX.Notes"'),
+            ('Été & co', '"&AMk-t&AOk- &- co"'),
+            ('日本語', '"&ZeVnLIqe-"'),
+            ('say "hi"', r'"say \"hi\""'),
+        ]:
+            with self.subTest(name=name):
+                self.assertEqual(util.encode_mailbox_name(name), encoded)
+                self.assertEqual(
+                    util.decode_mailbox_name(encoded.encode('ascii')), name,
+                )
+
+
+class ShardTest(unittest.TestCase):
+    def test_paths(self):
+        shard = util.shard_name('.UUID-1')
+        self.assertIn(shard, util.SHARDS)
+        self.assertEqual(shard, util.shard_name('.UUID-1'))
+        self.assertEqual('Work', util.folder_dir(os.path.join('Work', shard)))
+        self.assertEqual('', util.folder_dir(shard))
+        self.assertEqual('Work/.git', util.folder_dir('Work/.git'))
+        self.assertEqual(
+            os.path.join(shard, '.UUID-1'),
+            util.note_relpath(os.path.join('/repo/Work', shard, '.UUID-1')),
+        )
+        self.assertEqual('.UUID-1', util.note_relpath('/repo/Work/.UUID-1'))
+
+    def test_list_note_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, '.ab'))
+            for name in ('.A', os.path.join('.ab', '.B'), 'title.eml'):
+                with open(os.path.join(root, name), 'wb') as f:
+                    f.write(b'note')
+            self.assertEqual(
+                {'.A', '.ab/.B', 'title.eml'}, util.list_note_files(root),
+            )
+            util.delete_empty_shards(root, {'.ab/.B'})
+            self.assertTrue(os.path.isdir(os.path.join(root, '.ab')))
+            os.unlink(os.path.join(root, '.ab', '.B'))
+            util.delete_empty_shards(root, {'.ab/.B'})
+            self.assertFalse(os.path.isdir(os.path.join(root, '.ab')))
+
+
+class FakeSocket:
+    """Replies to each chunk the client sends with the next of `replies`.
+
+    The server greets with PREAUTH and answers CAPABILITY with
+    `capabilities` first. `TAG` in a reply stands for the tag of the last
+    command sent. Received data comes in chunks of at most `chunk_size`
+    bytes. Reading with nothing left to receive times out. Traffic is
+    compressed after the reply to COMPRESS DEFLATE, `sent` holds it
+    decompressed.
+    """
+
+    tag_re = re.compile(br'([A-Z]+\d+) ')
+
+    def __init__(self, replies, capabilities=b'IDLE', chunk_size=5):
+        self.incoming = bytearray(b'* PREAUTH ready\r\n')
+        self.replies = [
+            b'* CAPABILITY IMAP4rev1 ' + capabilities + b'\r\n'
+            b'TAG OK CAPABILITY completed\r\n',
+        ] + list(replies)
+        self.chunk_size = chunk_size
+        self.sent = []
+        self.tag = b''
+        self.timeout = None
+        self.deflate = None
+
+    def makefile(self, mode):
+        return None
+
+    def gettimeout(self):
+        return self.timeout
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, data):
+        if self.deflate:
+            data = self.deflate.decompress(data)
+        self.sent.append(data)
+        m = self.tag_re.match(data)
+        if m:
+            self.tag = m.group(1)
+        if self.replies:
+            reply = self.replies.pop(0).replace(b'TAG', self.tag)
+            if self.deflate:
+                reply = self.deflate.compress(reply)
+            self.incoming += reply
+        if data.endswith(b' COMPRESS DEFLATE\r\n'):
+            self.deflate = util.Deflate()
+
+    def recv(self, size):
+        if not self.incoming:
+            raise socket.timeout('timed out')
+
+        data = bytes(self.incoming[:min(size, self.chunk_size)])
+        del self.incoming[:len(data)]
+        return data
+
+
+class FakeIMAP4(util.IMAP4):
+    def __init__(self, sock):
+        self.fake_sock = sock
+        super().__init__('imap.example.com')
+
+    def _create_socket(self, timeout):
+        return self.fake_sock
+
+
+class IdleTest(unittest.TestCase):
+    def test_changes(self):
+        sock = FakeSocket([
+            b'+ idling\r\n* 4 EXISTS\r\n* 1 FETCH (FLAGS (\\Seen))\r\n',
+            b'* 5 EXISTS\r\nTAG OK IDLE terminated\r\n',
+        ])
+        conn = FakeIMAP4(sock)
+        responses = conn.idle(60)
+        self.assertEqual(
+            [b'* 4 EXISTS', b'* 1 FETCH (FLAGS (\\Seen))', b'* 5 EXISTS'],
+            responses,
+        )
+        self.assertEqual(b'DONE\r\n', sock.sent[-1])
+        self.assertEqual({}, conn.tagged_commands)
+        self.assertIsNone(sock.timeout)
+
+    def test_timeout(self):
+        sock = FakeSocket([b'+ idling\r\n', b'TAG OK IDLE terminated\r\n'])
+        conn = FakeIMAP4(sock)
+        self.assertEqual([], conn.idle(60))
+        self.assertEqual(b'DONE\r\n', sock.sent[-1])
+
+    def test_literal(self):
+        sock = FakeSocket([
+            b'+ idling\r\n* 1 FETCH (BODY[] {12}\r\nhello\r\nworld)\r\n',
+            b'TAG OK IDLE terminated\r\n',
+        ])
+        conn = FakeIMAP4(sock)
+        self.assertEqual([b'* 1 FETCH (BODY[] {12}'], conn.idle(60))
+        self.assertEqual(b'', bytes(conn._buffer))
+
+    def test_failure(self):
+        conn = FakeIMAP4(FakeSocket([b'TAG BAD unknown command\r\n']))
+        with self.assertRaises(util.IMAP4.error):
+            conn.idle(60)
+        self.assertEqual({}, conn.tagged_commands)
+
+        sock = FakeSocket([b'+ idling\r\n* BYE shutting down\r\n'])
+        with self.assertRaises(util.IMAP4.abort):
+            FakeIMAP4(sock).idle(60)
+
+    def test_buffered_reads(self):
+        conn = FakeIMAP4(FakeSocket([]))
+        conn.fake_sock.incoming += b'* 1 FETCH {3}\r\nabc)\r\nrest'
+        self.assertEqual(b'* 1 FETCH {3}\r\n', conn.readline())
+        self.assertEqual(b'abc', conn.read(3))
+        self.assertEqual(b')\r\n', conn.readline())
+        # A timeout keeps what was received, unlike socket.makefile().
+        with self.assertRaises(socket.timeout):
+            conn.readline()
+        conn.fake_sock.incoming += b'\r\n'
+        self.assertEqual(b'rest\r\n', conn.readline())
+
+
+class DeflateTest(unittest.TestCase):
+    def test_round_trip(self):
+        client = util.Deflate()
+        server = util.Deflate()
+        message = b'Subject: note\r\n\r\n' + b'<div>text</div>\r\n' * 200
+        command = 'A1 APPEND "INBOX.Notes" {{{}}}\r\n'.format(len(message))
+        # Every chunk is flushed so the server can act on it right away,
+        # like on the command line before sending the literal.
+        for chunk in (command.encode('ascii'), message, b'\r\n'):
+            compressed = client.compress(chunk)
+            self.assertEqual(chunk, server.decompress(compressed))
+        self.assertEqual(len(command) + len(message) + 2, client.sent)
+        self.assertEqual(client.sent, server.received)
+        self.assertEqual(client.sent_compressed, server.received_compressed)
+        self.assertLess(client.sent_compressed, len(message) / 10)
+
+    def test_partial_reads(self):
+        client = util.Deflate()
+        server = util.Deflate()
+        data = b''.join(
+            '* {} FETCH (UID {})\r\n'.format(i, i * 7).encode('ascii')
+            for i in range(1000)
+        ) + os.urandom(1000)
+        compressed = server.compress(data)
+        received = b''.join(
+            client.decompress(compressed[i:i + 7])
+            for i in range(0, len(compressed), 7)
+        )
+        self.assertEqual(data, received)
+        self.assertEqual(
+            'Received {} bytes ({} compressed), sent 0 bytes (0 compressed).'
+            ''.format(len(data), len(compressed)),
+            client.report(),
+        )
+
+    def test_connection(self):
+        sock = FakeSocket(
+            [
+                b'TAG OK DEFLATE active\r\n',
+                b'* 1 EXISTS\r\nTAG OK [READ-ONLY] SELECT completed\r\n',
+                b'* 1 FETCH (BODY[] {11}\r\nhello world)\r\n'
+                b'TAG OK FETCH completed\r\n',
+            ],
+            capabilities=b'COMPRESS=DEFLATE',
+            chunk_size=3,
+        )
+        conn = FakeIMAP4(sock)
+        self.assertEqual('OK', conn.compress()[0])
+        self.assertEqual('OK', conn.select('INBOX.Notes', readonly=True)[0])
+        typ, data = conn.fetch('1', '(BODY[])')
+        self.assertEqual([(b'1 (BODY[] {11}', b'hello world'), b')'], data)
+        self.assertTrue(sock.sent[-1].endswith(b' FETCH 1 (BODY[])\r\n'))
+        self.assertEqual(conn.deflate.sent, sock.deflate.received)
+        self.assertEqual(conn.deflate.received, sock.deflate.sent)
+
+
+class MultiappendTest(unittest.TestCase):
+    date_time = datetime.datetime(
+        2018, 1, 2, 10, 0, tzinfo=datetime.timezone.utc,
+    )
+    messages = [
+        (r'(\Seen)', date_time, b'one\n'),
+        (r'(\Seen)', date_time, b'two\r\n'),
+    ]
+    append = (
+        b' APPEND "INBOX.Notes" (\\Seen) "02-Jan-2018 10:00:00 +0000" {5'
+    )
+
+    def test_literal_plus(self):
+        sock = FakeSocket(
+            [b'', b'', b'', b'', b'TAG OK APPEND completed\r\n'],
+            capabilities=b'MULTIAPPEND LITERAL+',
+        )
+        conn = FakeIMAP4(sock)
+        typ, data = conn.multiappend('"INBOX.Notes"', self.messages)
+        self.assertEqual(('OK', [b'APPEND completed']), (typ, data))
+        tag = sock.tag
+        self.assertEqual([
+            tag + self.append + b'+}\r\n',
+            b'one\r\n',
+            b' (\\Seen) "02-Jan-2018 10:00:00 +0000" {5+}\r\n',
+            b'two\r\n',
+            b'\r\n',
+        ], sock.sent[1:])
+
+    def test_synchronizing_literals(self):
+        sock = FakeSocket(
+            [
+                b'+ go ahead\r\n',
+                b'',
+                b'+ go ahead\r\n',
+                b'',
+                b'TAG OK APPEND completed\r\n',
+            ],
+            capabilities=b'MULTIAPPEND',
+        )
+        conn = FakeIMAP4(sock)
+        typ, data = conn.multiappend('"INBOX.Notes"', self.messages)
+        self.assertEqual('OK', typ)
+        self.assertEqual(sock.tag + self.append + b'}\r\n', sock.sent[1])
+        self.assertEqual(b'two\r\n', sock.sent[4])
+        self.assertEqual({}, conn.tagged_commands)
+
+    def test_rejected_literal(self):
+        sock = FakeSocket(
+            [b'TAG NO [TOOBIG] message too big\r\n'],
+            capabilities=b'MULTIAPPEND',
+        )
+        conn = FakeIMAP4(sock)
+        typ, data = conn.multiappend('"INBOX.Notes"', self.messages)
+        self.assertEqual(('NO', [b'[TOOBIG] message too big']), (typ, data))
+        # The message itself was never sent.
+        self.assertEqual(2, len(sock.sent))
+
+
+if __name__ == '__main__':
+    unittest.main()
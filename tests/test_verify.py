@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from zzyzx import util, verify
+
+
+class CheckFileTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.path = os.path.join(self.root, '.UUID')
+        with open(self.path, 'wb') as f:
+            f.write(b'note')
+        manifest = util.Manifest(self.root)
+        manifest.update_dir(self.root, {'.UUID'})
+        self.entry = manifest.entries['.UUID']
+
+    def check(self):
+        return verify.check_file(self.root, '.UUID', self.entry)
+
+    def test_intact(self):
+        self.assertIsNone(self.check())
+
+    def test_corrupt(self):
+        # Same size and modification time, different contents.
+        with open(self.path, 'r+b') as f:
+            f.write(b'n0te')
+        os.utime(self.path, ns=(self.entry.mtime_ns, self.entry.mtime_ns))
+        self.assertEqual('corrupt', self.check())
+
+    def test_modified(self):
+        with open(self.path, 'ab') as f:
+            f.write(b' edited')
+        self.assertEqual('modified', self.check())
+
+    def test_missing(self):
+        os.unlink(self.path)
+        self.assertEqual('missing', self.check())
+
+
+class VerifyTest(unittest.TestCase):
+    def test_read_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            repo_path = os.path.join(tmp, 'repo')
+            os.mkdir(repo_path)
+            with open(os.path.join(repo_path, '.UUID'), 'wb') as f:
+                f.write(b'note')
+            manifest = util.Manifest(repo_path)
+            manifest.update_dir(repo_path, {'.UUID'})
+            manifest.save()
+            config_path = os.path.join(tmp, 'zzyzx.ini')
+            with open(config_path, 'w') as f:
+                f.write('[backup]\nrepo_path={}\n'.format(repo_path))
+            result = CliRunner().invoke(
+                util.cli, ['--config-path', config_path, 'verify'], obj={},
+            )
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn('Verified 1 notes', result.output)
+            # No Mercurial repository is created.
+            self.assertEqual(['.UUID', '.zzyzx'], sorted(os.listdir(repo_path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
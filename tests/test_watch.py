@@ -0,0 +1,201 @@
+import contextlib
+import imaplib
+import itertools
+import queue
+import threading
+import types
+import unittest
+from unittest import mock
+
+from zzyzx import backup, watch
+
+
+def mailbox(name):
+    return types.SimpleNamespace(name=name, name_querysafe='"' + name + '"')
+
+
+class FakeConnection:
+    def __init__(self, capabilities=(), idle=(), stop=None):
+        self.capabilities = capabilities
+        self.statuses = {}  # quoted name -> status
+        self.idle_responses = list(idle)
+        self.stop = stop  # set once all `idle` responses are returned
+        self.selected = []
+
+    def status(self, name, items):
+        status = self.statuses.get(name)
+        if status is None:
+            return 'NO', [b'no such folder']
+
+        return 'OK', [
+            '* STATUS {} ({})'.format(name, status).encode('ascii'),
+        ]
+
+    def select(self, name, readonly=False):
+        self.selected.append(name)
+        return 'OK', [b'1']
+
+    def xatom(self, name, *args):
+        return 'OK', [None]
+
+    def idle(self, timeout):
+        responses = self.idle_responses.pop(0)
+        if not self.idle_responses:
+            self.stop.set()
+        return responses
+
+
+def fake_watcher(conn=None, max_connections=2):
+    watcher = watch.Watcher.__new__(watch.Watcher)
+    watcher.max_connections = max_connections
+    watcher.idle_timeout = 60
+    watcher.watchers = {}
+    watcher.changes = queue.Queue()
+    watcher.hg_path = None
+    watcher.metadata = backup.new_metadata()
+
+    @contextlib.contextmanager
+    def connection():
+        yield conn
+    watcher.connection = connection
+    return watcher
+
+
+def drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait())
+    return items
+
+
+class BackoffTest(unittest.TestCase):
+    def test_doubles_up_to_maximum(self):
+        delays = list(itertools.islice(watch.backoff(), 11))
+        self.assertEqual(
+            [1, 2, 4, 8, 16, 32, 64, 128, 256, 300, 300], delays,
+        )
+        delays = list(itertools.islice(watch.backoff(3, 10), 4))
+        self.assertEqual([3, 6, 10, 10], delays)
+
+    def test_reset_after_connecting(self):
+        watcher = fake_watcher()
+        attempts = iter([
+            OSError('refused'),
+            OSError('refused'),
+            None,  # connects, then the connection drops
+            OSError('refused'),
+            KeyboardInterrupt(),
+        ])
+
+        @contextlib.contextmanager
+        def connection():
+            error = next(attempts)
+            if error is not None:
+                raise error
+
+            yield FakeConnection()
+
+        def watch_connection(conn):
+            raise imaplib.IMAP4.abort('socket error: EOF')
+
+        watcher.connection = connection
+        watcher.watch_connection = watch_connection
+        with mock.patch('time.sleep') as sleep:
+            watcher.run()
+        self.assertEqual(
+            [1, 2, 1, 2], [c.args[0] for c in sleep.call_args_list],
+        )
+
+
+class StartWatchersTest(unittest.TestCase):
+    def test_notify(self):
+        watcher = fake_watcher()
+        conn = FakeConnection(capabilities=('IMAP4REV1', 'NOTIFY'))
+        with mock.patch.object(watch, 'spawn') as spawn:
+            polled = watcher.start_watchers(conn, [mailbox('INBOX.Notes')])
+            self.assertEqual({}, polled)
+            watcher.start_watchers(conn, [mailbox('INBOX.Notes')])
+        spawn.assert_called_once_with(watch.notify_worker, watcher)
+        self.assertEqual([watch.RESYNC], list(watcher.watchers))
+
+    def test_idle_and_polling(self):
+        watcher = fake_watcher(max_connections=2)
+        conn = FakeConnection(capabilities=('IMAP4REV1', 'IDLE'))
+        mailboxes = [mailbox(n) for n in ('INBOX.Notes', 'Work', 'Home')]
+        with mock.patch.object(
+            watch, 'spawn', side_effect=lambda *a: threading.Event(),
+        ):
+            polled = watcher.start_watchers(conn, mailboxes)
+            self.assertEqual(['Home'], list(polled))
+            self.assertEqual(['INBOX.Notes', 'Work'], list(watcher.watchers))
+
+            # Removed folders stop being watched, freeing a connection.
+            stop = watcher.watchers['Work']
+            polled = watcher.start_watchers(
+                conn, [mailboxes[0], mailboxes[2]],
+            )
+        self.assertTrue(stop.is_set())
+        self.assertEqual({}, polled)
+        self.assertEqual(['INBOX.Notes', 'Home'], list(watcher.watchers))
+
+
+class PollStatusTest(unittest.TestCase):
+    def test_changes(self):
+        polled = {'Work': mailbox('Work'), 'Home': mailbox('Home')}
+        conn = FakeConnection()
+        conn.statuses = {'"Work"': 'MESSAGES 1', '"Home"': 'MESSAGES 2'}
+        statuses = {}
+
+        def poll():
+            return list(watch.poll_status(conn, polled, statuses))
+
+        # The first poll only records statuses.
+        self.assertEqual([], poll())
+        self.assertEqual([], poll())
+        conn.statuses['"Work"'] = 'MESSAGES 2'
+        self.assertEqual(['Work'], poll())
+        # Failed STATUS commands keep the last known status.
+        del conn.statuses['"Home"']
+        self.assertEqual([], poll())
+        conn.statuses['"Home"'] = 'MESSAGES 3'
+        self.assertEqual(['Home'], poll())
+
+
+class WorkerTest(unittest.TestCase):
+    def test_idle_worker(self):
+        stop = threading.Event()
+        conn = FakeConnection(
+            idle=[[b'* 3 EXISTS'], [], [b'* 2 EXPUNGE']], stop=stop,
+        )
+        watcher = fake_watcher(conn)
+        watch.idle_worker(watcher, mailbox('Work'), stop)
+        self.assertEqual(['"Work"'], conn.selected)
+        self.assertEqual(['Work', 'Work'], drain(watcher.changes))
+
+    def test_idle_worker_keepalive(self):
+        stop = threading.Event()
+        conn = FakeConnection(
+            idle=[[b'* OK Still here'], [b'* OK Still here']], stop=stop,
+        )
+        watcher = fake_watcher(conn)
+        watch.idle_worker(watcher, mailbox('Work'), stop)
+        self.assertEqual([], drain(watcher.changes))
+
+    def test_notify_worker(self):
+        stop = threading.Event()
+        conn = FakeConnection(idle=[[
+            b'* STATUS "INBOX.Notes.&AMk-t&AOk-" (MESSAGES 3)',
+            b'* STATUS INBOX.Notes (MESSAGES 1)',
+            b'* LIST () "." INBOX.Notes.New',
+            b'* 3 EXISTS',
+        ]], stop=stop)
+        watcher = fake_watcher(conn)
+        watch.notify_worker(watcher, stop)
+        self.assertEqual(
+            ['INBOX.Notes.Été', 'INBOX.Notes', watch.RESYNC],
+            drain(watcher.changes),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
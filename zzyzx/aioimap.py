@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""A minimal asyncio IMAP client that pipelines commands.
+
+`imaplib` allows one outstanding command per connection. This client tags
+commands the same way but lets any number of them be in flight. Untagged
+responses are attributed to the oldest command still waiting for its
+completion, except FETCH responses which are routed by message number.
+
+Responses use the same shapes as `imaplib` so code processing them can be
+shared between both engines.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+import imaplib
+import re
+import ssl
+
+from zzyzx import util
+
+
+literal_re = re.compile(br'.*\{(?P<size>\d+)\+?\}$', re.ASCII)
+tagged_re = re.compile(
+    br'(?P<tag>A\d+) (?P<type>[A-Z]+) ?(?P<data>.*)', re.ASCII,
+)
+untagged_status_re = re.compile(
+    br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?', re.ASCII,
+)
+untagged_re = re.compile(br'\* (?P<type>[A-Z-]+)( (?P<data>.*))?', re.ASCII)
+
+
+class IMAPClient:
+    """Asyncio IMAP client over SSL. See the module docstring."""
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, host, port=imaplib.IMAP4_SSL_PORT):
+        self.host = host
+        self.port = port
+        self.capabilities = ()
+        self.deflate = None
+        self._buffer = bytearray()
+        self._tagnum = 0
+        self._pending = {}  # tag -> (name, future, untagged responses)
+        self._fetches = {}  # message number -> tag
+        self._reader_task = None
+        self._failure = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context(),
+        )
+        greeting = await self._read_response()
+        if not greeting[-1].startswith(b'* OK'):
+            raise self.error('unexpected greeting: {!r}'.format(greeting))
+
+        self._write_lock = asyncio.Lock()
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        await self.refresh_capabilities()
+
+    async def refresh_capabilities(self):
+        typ, data = await self.simple_command('CAPABILITY')
+        if data:
+            self.capabilities = tuple(data[-1].decode('ascii').upper().split())
+
+    async def login(self, user, password):
+        typ, data = await self.command(
+            'LOGIN', quote(user), quote(password), untagged=None,
+        )
+        if typ != 'OK':
+            raise self.error(data[-1].decode('utf8', 'replace'))
+
+        # Servers usually advertise more capabilities once authenticated.
+        await self.refresh_capabilities()
+        return typ, data
+
+    async def compress(self):
+        """Enables RFC 4978 COMPRESS=DEFLATE. No commands may be in flight."""
+        typ, data = await self.command('COMPRESS', 'DEFLATE', untagged=None)
+        if typ == 'OK':
+            self.deflate = util.Deflate()
+        return typ, data
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT', untagged=None)
+        except self.abort:
+            pass  # the server hung up after BYE
+        finally:
+            self.writer.close()
+            if self._reader_task:
+                self._reader_task.cancel()
+
+    async def select(self, mailbox, readonly=False):
+        name = 'EXAMINE' if readonly else 'SELECT'
+        typ, data = await self.command(name, mailbox, untagged='EXISTS')
+        if typ != 'OK':
+            raise self.error('{} failed: {!r}'.format(name, data))
+
+        return typ, data
+
+    async def list(self, directory='""', pattern='*'):
+        return await self.command('LIST', directory, pattern)
+
+    async def search(self, *criteria):
+        return await self.command('SEARCH', *criteria)
+
+    async def status(self, mailbox, names):
+        return await self.command('STATUS', mailbox, names)
+
+    async def fetch(self, num, parts):
+        """Like `imaplib.IMAP4.fetch` for a single message number."""
+        return await self.command('FETCH', num, parts)
+
+    async def simple_command(self, name, *args):
+        return await self.command(name, *args)
+
+    async def command(self, name, *args, untagged=''):
+        """Sends a command and waits for its completion.
+
+        Returns (typ, data) like `imaplib`: `data` are the untagged
+        responses of type `untagged` (by default, same as the command name)
+        or the tagged response text if there were none.
+        """
+        if untagged == '':
+            untagged = name
+        if self._failure:
+            raise self._failure
+
+        tag = self._new_tag()
+        future = asyncio.get_event_loop().create_future()
+        self._pending[tag] = (name, future, [])
+        args = [arg if isinstance(arg, bytes) else arg.encode('ascii')
+                for arg in args]
+        if name == 'FETCH':
+            self._fetches[args[0]] = tag
+        try:
+            self._send(b' '.join([tag, name.encode('ascii')] + args) + b'\r\n')
+            async with self._write_lock:
+                await self.writer.drain()
+            typ, text, responses = await future
+        finally:
+            self._pending.pop(tag, None)
+            if name == 'FETCH' and self._fetches.get(args[0]) == tag:
+                del self._fetches[args[0]]
+        if typ == 'BAD':
+            raise self.error(
+                '{} command error: {} {!r}'.format(name, typ, text),
+            )
+
+        data = [
+            d for t, response in responses if t == untagged for d in response
+        ]
+        return typ, data or [text]
+
+    def _new_tag(self):
+        self._tagnum += 1
+        return 'A{}'.format(self._tagnum).encode('ascii')
+
+    def _send(self, data):
+        if self.deflate:
+            data = self.deflate.compress(data)
+        self.writer.write(data)
+
+    async def _recv(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                raise self.abort('socket error: EOF')
+
+            if not self.deflate:
+                return data
+
+            # A partial deflate block might not decompress to anything yet.
+            data = self.deflate.decompress(data)
+            if data:
+                return data
+
+    async def _readline(self):
+        start = 0
+        while True:
+            end = self._buffer.find(b'\r\n', start)
+            if end != -1:
+                break
+
+            start = max(0, len(self._buffer) - 1)
+            self._buffer += await self._recv()
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 2]
+        return line
+
+    async def _read(self, size):
+        while len(self._buffer) < size:
+            self._buffer += await self._recv()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def _read_response(self):
+        """Returns a response as a list of lines and (line, literal) tuples."""
+        line = await self._readline()
+        response = []
+        while True:
+            m = literal_re.match(line)
+            if not m:
+                break
+
+            literal = await self._read(int(m.group('size')))
+            response.append((line, literal))
+            line = await self._readline()
+        response.append(line)
+        return response
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._dispatch(await self._read_response())
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            if not isinstance(e, self.error):
+                e = self.abort('socket error: {}'.format(e))
+            self._failure = e
+            for _, future, _ in self._pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._pending.clear()
+
+    def _dispatch(self, response):
+        first = response[0]
+        head = first[0] if isinstance(first, tuple) else first
+        m = tagged_re.match(head)
+        if m and m.group('tag') in self._pending:
+            # Forget the command right away. Its coroutine might only resume
+            # after responses to later commands are dispatched.
+            _, future, responses = self._pending.pop(m.group('tag'))
+            if not future.done():
+                typ = m.group('type').decode('ascii')
+                future.set_result((typ, m.group('data'), responses))
+            return
+
+        if head.startswith(b'+'):
+            return  # we never send synchronizing literals
+
+        m = untagged_status_re.match(head)
+        if m:
+            typ = m.group('type').decode('ascii')
+            data = m.group('data')
+            if m.group('data2'):
+                data += b' ' + m.group('data2')
+        else:
+            m = untagged_re.match(head)
+            if not m:
+                raise self.abort('unexpected response: {!r}'.format(head))
+
+            typ = m.group('type').decode('ascii')
+            data = m.group('data') or b''
+        if typ == 'BYE' and not any(
+            name == 'LOGOUT' for name, _, _ in self._pending.values()
+        ):
+            raise self.abort(data.decode('utf8', 'replace'))
+
+        if isinstance(first, tuple):
+            response[0] = (data, first[1])
+        else:
+            response[0] = data
+
+        tag = None
+        if typ == 'FETCH':
+            tag = self._fetches.get(data.split(b' ', 1)[0])
+        if tag not in self._pending:
+            tag = next(iter(self._pending), None)
+        if tag is not None:
+            self._pending[tag][2].append((typ, response))
+
+
+def quote(arg):
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+@asynccontextmanager
+async def imap_connection(cfg, credentials=None):
+    """Like `util.imap_connection` but yields an `IMAPClient`."""
+    srv = cfg['server']
+    client = IMAPClient(srv['host'])
+    await client.connect()
+    try:
+        if credentials is None:
+            credentials = util.pop_credentials(cfg)
+        await client.login(*credentials)
+        if (
+            srv.getboolean('compress', True) and
+            'COMPRESS=DEFLATE' in client.capabilities
+        ):
+            await client.compress()
+        yield client
+    finally:
+        await client.logout()
@@ -1,22 +1,207 @@
 #!/usr/bin/env python3
 
-import email.policy
-import email.parser
+import asyncio
+import collections
+import concurrent.futures
+import configparser
 import email.utils
+import hashlib
+import imaplib
 import os
+import shutil
+import subprocess
 import time
 import unicodedata
 
 import click
 
-from zzyzx import util
+from zzyzx import aioimap, blobs, util
+
+
+# How many FETCH commands the asyncio engine keeps in flight at once.
+FETCH_WINDOW = 16
+
+
+# Options of [account:NAME] sections that belong in [server].
+SERVER_OPTIONS = frozenset({'host', 'user', 'pass', 'compress'})
+
+# Errors of a failed account that `backup --all` reports by message alone.
+# Any other exception also fails just that account, reported with its type.
+ACCOUNT_ERRORS = (
+    imaplib.IMAP4.error, OSError, subprocess.CalledProcessError,
+    click.ClickException,
+)
 
 
 @util.cli.command()
+@click.option(
+    '--all', 'all_accounts', is_flag=True,
+    help='Back up all [account:NAME] sections concurrently.',
+)
+@click.option(
+    '--max-connections', default=4, show_default=True,
+    help='How many IMAP connections --all keeps open at once.',
+)
+@click.option(
+    '--jobs', default=os.cpu_count() or 1, show_default=True,
+    help='How many threads --all uses for hg and the imaplib engine.',
+)
 @util.pass_cfg
-def backup(cfg):
+def backup(cfg, all_accounts, max_connections, jobs):
     """Backs up remote IMAP notes in a local Mercurial repository."""
 
+    if all_accounts:
+        accounts = account_configs(cfg)
+        if not accounts:
+            raise click.ClickException(
+                'no [account:NAME] sections found in configuration',
+            )
+
+        backup_accounts(accounts, max_connections, jobs)
+        return
+
+    repo_path, hg_path, ignore_prefix = backup_settings(cfg)
+    metadata = new_metadata()
+    run_backup(cfg, repo_path, ignore_prefix, metadata)
+    metadata['duration'] = time.time() - metadata['start_time']
+    if hg_path:
+        util.hg_commit(hg_path, repo_path, metadata)
+
+
+def run_backup(cfg, repo_path, ignore_prefix, metadata, listener=None):
+    """Backs up all folders with the configured engine."""
+    engine = backup_engine(cfg)
+    if engine == 'asyncio':
+        conn = asyncio.run(
+            backup_all_async(
+                cfg, repo_path, ignore_prefix, metadata, listener=listener,
+            ),
+        )
+    else:
+        with util.imap_connection(cfg) as conn:
+            backup_all(
+                conn, repo_path, ignore_prefix, metadata, listener,
+                blob_store(cfg, repo_path), backup_layout(cfg) == 'sharded',
+            )
+
+    if conn.deflate:
+        click.echo(conn.deflate.report())
+
+
+def account_configs(cfg):
+    """Returns {name: config} for every [account:NAME] section in `cfg`.
+
+    Each config has its own [server] and [backup] sections, based on the
+    top-level ones and overridden by the options of the account section.
+    Credentials are moved out of `cfg` so they're only in the account's
+    config, to be scrubbed from there by `util.pop_credentials`.
+    """
+    accounts = {}
+    for section in cfg.sections():
+        if not section.startswith('account:'):
+            continue
+
+        account = configparser.RawConfigParser()
+        for name in ('server', 'backup'):
+            account.add_section(name)
+            if cfg.has_section(name):
+                for key, value in cfg.items(name):
+                    if key not in ('user', 'pass'):
+                        account.set(name, key, value)
+        for key, value in cfg.items(section):
+            name = 'server' if key in SERVER_OPTIONS else 'backup'
+            account.set(name, key, value)
+        cfg.remove_option(section, 'user')
+        cfg.remove_option(section, 'pass')
+        accounts[section[len('account:'):]] = account
+    return accounts
+
+
+def backup_accounts(accounts, max_connections, jobs):
+    """Backs up all `accounts` concurrently, printing a summary at the end.
+
+    At most `max_connections` accounts are connected at once. Mercurial
+    commits and accounts using the imaplib engine run on `jobs` threads.
+    """
+    prepared = []
+    for name, account in sorted(accounts.items()):
+        click.secho('Preparing account {}'.format(name), bold=True)
+        settings = backup_settings(account)
+        engine = backup_engine(account)
+        blob_store(account, settings[0])
+        backup_layout(account)
+        credentials = util.pop_credentials(account)
+        prepared.append((name, account, settings, engine, credentials))
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        results = asyncio.run(
+            backup_accounts_async(prepared, max_connections, executor),
+        )
+
+    click.secho('Summary', bold=True)
+    failed = 0
+    for (name, *_), result in zip(prepared, results):
+        if isinstance(result, Exception):
+            failed += 1
+            if not isinstance(result, ACCOUNT_ERRORS):
+                result = '{}: {}'.format(type(result).__name__, result)
+            click.secho('{}: failed ({})'.format(name, result), fg='red')
+        else:
+            click.echo(
+                '{}: updated {updated_files} files in {updated_dirs} '
+                'directories, deleted {deleted_files} files and '
+                '{deleted_dirs} directories in {duration:.2f} seconds'
+                ''.format(name, **result),
+            )
+    if failed:
+        raise click.ClickException(
+            '{} of {} accounts failed'.format(failed, len(prepared)),
+        )
+
+
+async def backup_accounts_async(prepared, max_connections, executor):
+    """Returns metadata, or the exception it failed with, per account."""
+    loop = asyncio.get_event_loop()
+    connections = asyncio.Semaphore(max_connections)
+
+    async def backup_account(name, account, settings, engine, credentials):
+        repo_path, hg_path, ignore_prefix = settings
+        try:
+            async with connections:
+                metadata = new_metadata()
+                if engine == 'asyncio':
+                    await backup_all_async(
+                        account, repo_path, ignore_prefix, metadata,
+                        credentials,
+                    )
+                else:
+                    await loop.run_in_executor(
+                        executor, backup_all_imaplib,
+                        account, repo_path, ignore_prefix, metadata,
+                        credentials,
+                    )
+            metadata['duration'] = time.time() - metadata['start_time']
+            if hg_path:
+                await loop.run_in_executor(
+                    executor, util.hg_commit, hg_path, repo_path, metadata,
+                )
+        except Exception as e:
+            # One account failing mustn't cancel the others.
+            return e
+
+        return metadata
+
+    return await asyncio.gather(*(
+        backup_account(*account) for account in prepared
+    ))
+
+
+def backup_settings(cfg):
+    """Returns (repo_path, hg_path, ignore_prefix) from the [backup] section.
+
+    Initializes the Mercurial repository if necessary. `hg_path` is None if
+    history will not be stored.
+    """
     repo_path = os.path.realpath(os.path.expanduser(cfg['backup']['repo_path']))
     hg_path = os.path.expanduser(cfg['backup'].get('hg_path', 'hg'))
     if hg_path and util.has_hg(hg_path):
@@ -24,57 +209,234 @@ def backup(cfg):
     else:
         hg_path = None
     ignore_prefix = cfg['backup'].get('ignore_prefix')
-    metadata = {
+    return repo_path, hg_path, ignore_prefix
+
+
+def repo_settings(cfg):
+    """Returns (repo_path, hg_path) from the [backup] section.
+
+    Unlike `backup_settings`, doesn't initialize anything. `hg_path` is None
+    if Mercurial is unavailable or there is no repository in `repo_path`.
+    """
+    repo_path = os.path.realpath(os.path.expanduser(cfg['backup']['repo_path']))
+    hg_path = os.path.expanduser(cfg['backup'].get('hg_path', 'hg'))
+    if (
+        not hg_path or
+        not shutil.which(hg_path) or
+        not os.path.isdir(os.path.join(repo_path, '.hg'))
+    ):
+        hg_path = None
+    return repo_path, hg_path
+
+
+def backup_engine(cfg):
+    engine = cfg['backup'].get('engine', 'asyncio')
+    if engine not in ('asyncio', 'imaplib'):
+        raise click.ClickException('unknown engine: {}'.format(engine))
+
+    return engine
+
+
+def backup_layout(cfg):
+    """Returns how notes are laid out in folders' directories.
+
+    "flat" keeps note files next to their title symlinks, "sharded" spreads
+    them over subdirectories so that huge folders stay fast.
+    """
+    layout = cfg['backup'].get('layout', 'flat')
+    if layout not in ('flat', 'sharded'):
+        raise click.ClickException('unknown layout: {}'.format(layout))
+
+    return layout
+
+
+def blob_store(cfg, repo_path):
+    """Returns a `blobs.BlobStore` with `format=split`, otherwise None."""
+    fmt = cfg['backup'].get('format', 'eml')
+    if fmt not in ('eml', 'split'):
+        raise click.ClickException('unknown format: {}'.format(fmt))
+
+    if fmt == 'split':
+        return blobs.BlobStore(repo_path)
+
+    return None
+
+
+def new_metadata():
+    return {
         'start_time': time.time(),
         'updated_files': 0,
         'updated_dirs': 0,
         'deleted_files': 0,
         'deleted_dirs': 0,
     }
-    with util.imap_connection(cfg) as conn:
-        result, mailboxes = conn.list('INBOX.Notes')
-        if result != 'OK':
-            raise click.ClickException(
-                'searching for INBOX.Notes failed with {}'.format(result),
+
+
+def list_mailboxes(conn):
+    return parse_mailboxes(*conn.list('INBOX.Notes'))
+
+
+def parse_mailboxes(result, mailboxes):
+    if result != 'OK':
+        raise click.ClickException(
+            'searching for INBOX.Notes failed with {}'.format(result),
+        )
+
+    return util.parse_list_responses(mailboxes)
+
+
+def backup_all(
+    conn, repo_path, ignore_prefix, metadata, listener=None, blobs=None,
+    sharded=False,
+):
+    """Backs up all Notes folders, deleting stale ones. Returns the folders.
+
+    If given, `listener` is notified about every saved message with
+    `message_saved(notes_dir, filename, raw)` and about every folder, once
+    its title symlinks are in place, with `folder_saved(notes_dir,
+    updated_files)`. `raw` is the message as stored, large attachments are
+    split off into `blobs` if given. With `sharded`, note files are stored
+    in shards of their folder's directory.
+    """
+    mailboxes = list_mailboxes(conn)
+    with RepoFolders(repo_path, metadata) as folders:
+        for d in mailboxes:
+            notes_dir, old_files = folders.open(d, ignore_prefix)
+            backup_folder(
+                conn, d, notes_dir, old_files, metadata, folders.manifest,
+                listener, blobs, sharded,
             )
+    return mailboxes
+
+
+def backup_all_imaplib(cfg, repo_path, ignore_prefix, metadata, credentials):
+    with util.imap_connection(cfg, credentials) as conn:
+        backup_all(
+            conn, repo_path, ignore_prefix, metadata,
+            blobs=blob_store(cfg, repo_path),
+            sharded=backup_layout(cfg) == 'sharded',
+        )
+
 
-        old_dirs = set(util.gen_existing_dirs(repo_path))
-        updated_dirs = set()
-        for d in util.parse_list_responses(mailboxes):
-            click.secho(d.name, fg='red', bold=True)
-            notes_dir = create_directories(d.name, repo_path, ignore_prefix)
-
-            def symlink_or_file(path):
-                """Like os.path.isfile(path) but returns True for broken symlinks."""
-                p = os.path.join(notes_dir, path)
-                return os.path.islink(p) or os.path.isfile(p)
-
-            old_files = set(
-                map(
-                    lambda fn: unicodedata.normalize('NFD', fn),
-                    filter(symlink_or_file, os.listdir(notes_dir)),
-                ),
+async def backup_all_async(
+    cfg, repo_path, ignore_prefix, metadata, credentials=None, listener=None,
+):
+    """Like `backup_all` over an asyncio connection. Returns the client.
+
+    Message counts for all folders are requested at once with overlapping
+    STATUS commands so that empty folders don't need to be selected.
+    """
+    blobs = blob_store(cfg, repo_path)
+    sharded = backup_layout(cfg) == 'sharded'
+    async with aioimap.imap_connection(cfg, credentials) as client:
+        mailboxes = parse_mailboxes(*await client.list('INBOX.Notes'))
+        statuses = await asyncio.gather(*(
+            client.status(d.name_querysafe, '(MESSAGES)') for d in mailboxes
+        ))
+        with RepoFolders(repo_path, metadata) as folders:
+            for d, (typ, data) in zip(mailboxes, statuses):
+                notes_dir, old_files = folders.open(d, ignore_prefix)
+                click.secho(d.name, fg='red', bold=True)
+                if typ == 'OK' and data[0].endswith(b'(MESSAGES 0)'):
+                    updated_files = set()
+                else:
+                    updated_files = await backup_mailbox_async(
+                        client, d, notes_dir, listener=listener, blobs=blobs,
+                        sharded=sharded, manifest=folders.manifest,
+                    )
+                finish_folder(
+                    notes_dir, old_files, updated_files, metadata,
+                    folders.manifest,
+                )
+                if listener:
+                    listener.folder_saved(notes_dir, updated_files)
+    return client
+
+
+class RepoFolders:
+    """Context manager deleting directories of folders not backed up in it.
+
+    Scans the repository once upon entry. `open()` creates the directory
+    for a folder and returns it along with the names of files already in it,
+    including the ones in shards.
+    The digest `manifest` is saved on exit.
+    """
+
+    def __init__(self, repo_path, metadata):
+        self.repo_path = repo_path
+        self.metadata = metadata
+
+    def __enter__(self):
+        self.scan = util.scan_tree(self.repo_path)
+        self.manifest = util.Manifest(self.repo_path)
+        self.notes_dirs = []
+        self.updated_dirs = set()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            return
+
+        stale_dirs = {
+            d for d in self.scan.dirs - self.updated_dirs
+            if not util.is_shard(os.path.basename(d))
+        }
+        util.delete_directories(stale_dirs)
+        self.metadata['deleted_dirs'] += len(stale_dirs)
+        self.manifest.retain_dirs(self.notes_dirs)
+        self.manifest.save()
+
+    def open(self, d, ignore_prefix):
+        notes_dir = create_directories(d.name, self.repo_path, ignore_prefix)
+        # The top-level folder's directory has a trailing slash.
+        notes_dir_nfd = util.normalize_nfd(os.path.normpath(notes_dir))
+        self.notes_dirs.append(notes_dir)
+        self.updated_dirs.add(notes_dir_nfd)
+        old_files = set(self.scan.files.get(notes_dir_nfd, ()))
+        for shard in util.SHARDS:
+            old_files.update(
+                os.path.join(shard, name)
+                for name in self.scan.files.get(
+                    os.path.join(notes_dir_nfd, shard), (),
+                )
             )
-            updated_files = backup_mailbox(conn, d, notes_dir)
-            util.delete_files(notes_dir, old_files - updated_files)
-            updated_dirs.add(notes_dir)
-            metadata['updated_dirs'] += 1
-            metadata['updated_files'] += len(updated_files)
-            metadata['deleted_files'] += len(old_files - updated_files)
-
-    util.delete_directories(old_dirs - updated_dirs)
-    metadata['deleted_dirs'] = len(old_dirs - updated_dirs)
-    metadata['duration'] = time.time() - metadata['start_time']
-    if hg_path:
-        util.hg_commit(hg_path, repo_path, metadata)
+        return notes_dir, old_files
 
 
+def backup_folder(
+    conn, d, notes_dir, old_files, metadata, manifest=None, listener=None,
+    blobs=None, sharded=False,
+):
+    """Backs up a single Notes folder, deleting notes no longer on the server.
+
+    `old_files` are the names of files currently in `notes_dir`. Digests of
+    the notes are recorded in `manifest` if given. See `backup_all` for the
+    `listener`, `blobs` and `sharded`.
+    """
+    click.secho(d.name, fg='red', bold=True)
+    updated_files = backup_mailbox(
+        conn, d, notes_dir, listener, blobs, sharded, manifest,
+    )
+    finish_folder(notes_dir, old_files, updated_files, metadata, manifest)
+    if listener:
+        listener.folder_saved(notes_dir, updated_files)
+
+
+def finish_folder(
+    notes_dir, old_files, updated_files, metadata, manifest=None,
+):
+    util.delete_files(notes_dir, old_files - updated_files)
+    util.delete_empty_shards(notes_dir, old_files - updated_files)
+    if manifest is not None:
+        manifest.update_dir(notes_dir, updated_files)
+    metadata['updated_dirs'] += 1
+    metadata['updated_files'] += len(updated_files)
+    metadata['deleted_files'] += len(old_files - updated_files)
+
 
 def backup_mailbox(
-    conn,
-    d,
-    notes_dir,
-    email_parser=email.parser.BytesParser(policy=email.policy.default),
+    conn, d, notes_dir, listener=None, blobs=None, sharded=False,
+    manifest=None,
 ):
     updated_files = {}
 
@@ -82,31 +444,89 @@ def backup_mailbox(
     typ, data = conn.search(None, 'ALL')
     for num in data[0].split():
         typ, data = conn.fetch(num, '(RFC822)')
-        msg = email_parser.parsebytes(data[0][1])
-        imap_id = msg['Message-Id']
-        note_uuid = msg['X-Universally-Unique-Identifier']
-        created = email.utils.parsedate_to_datetime(
-            msg['x-mail-created-date'],
+        save_message(
+            num, data[0][1], notes_dir, updated_files, listener, blobs,
+            sharded, manifest,
+        )
+
+    symlink_uuids_to_human_readable_titles(updated_files, notes_dir)
+    return set(updated_files)
+
+
+async def backup_mailbox_async(
+    client, d, notes_dir, window=FETCH_WINDOW, listener=None, blobs=None,
+    sharded=False, manifest=None,
+):
+    """Like `backup_mailbox` but keeps up to `window` FETCHes in flight."""
+    updated_files = {}
+
+    await client.select(d.name_querysafe, readonly=True)
+    typ, data = await client.search('ALL')
+    fetches = collections.deque()
+    for num in data[0].split():
+        fetches.append(
+            (num, asyncio.ensure_future(client.fetch(num, '(RFC822)'))),
         )
-        modified = email.utils.parsedate_to_datetime(
-            msg['date'],
+        if len(fetches) >= window:
+            num, fetch = fetches.popleft()
+            typ, data = await fetch
+            save_message(
+                num, data[0][1], notes_dir, updated_files, listener, blobs,
+                sharded, manifest,
+            )
+    for num, fetch in fetches:
+        typ, data = await fetch
+        save_message(
+            num, data[0][1], notes_dir, updated_files, listener, blobs,
+            sharded, manifest,
         )
-        body = msg.get_body()
-
-        filename = '.' + note_uuid
-        backup_path = os.path.join(notes_dir, filename)
-        with open(backup_path, 'wb') as backup_file:
-            backup_file.write(data[0][1])
-        util.update_timestamps(backup_path, created, modified)
-        updated_files[filename] = msg['subject']
-        click.secho('{}) '.format(num.decode('ascii')), fg='green', nl=False)
-        click.echo(created, nl=False)
-        click.secho(' {}'.format(msg['subject']), bold=True)
 
     symlink_uuids_to_human_readable_titles(updated_files, notes_dir)
     return set(updated_files)
 
 
+def save_message(
+    num, raw, notes_dir, updated_files, listener=None, blobs=None,
+    sharded=False, manifest=None,
+):
+    """Stores message `num` in `notes_dir`, recording its title.
+
+    Large attachments are stored separately in `blobs` if given. With
+    `sharded`, the note is stored in a shard of `notes_dir` and recorded
+    under its path relative to `notes_dir`. The digest of the stored note
+    is passed to `manifest` if given, so it isn't read back to hash it.
+    """
+    headers = util.parse_headers(raw)
+    note_uuid = headers['x-universally-unique-identifier']
+    created = email.utils.parsedate_to_datetime(
+        headers['x-mail-created-date'],
+    )
+    modified = email.utils.parsedate_to_datetime(
+        headers['date'],
+    )
+    subject = util.decode_header(headers.get('subject'))
+
+    if blobs is not None:
+        raw = blobs.split(raw)
+    filename = '.' + note_uuid
+    if sharded:
+        shard = util.shard_name(filename)
+        os.makedirs(os.path.join(notes_dir, shard), mode=0o700, exist_ok=True)
+        filename = os.path.join(shard, filename)
+    backup_path = os.path.join(notes_dir, filename)
+    with open(backup_path, 'wb') as backup_file:
+        backup_file.write(raw)
+    util.update_timestamps(backup_path, created, modified)
+    if manifest is not None:
+        manifest.record(backup_path, hashlib.sha256(raw).hexdigest())
+    updated_files[filename] = subject
+    if listener:
+        listener.message_saved(notes_dir, filename, raw)
+    click.secho('{}) '.format(num.decode('ascii')), fg='green', nl=False)
+    click.echo(created, nl=False)
+    click.secho(' {}'.format(subject), bold=True)
+
+
 def create_directories(d_name, repo_path, ignore_prefix=None):
     if ignore_prefix and d_name.startswith(ignore_prefix):
         d_name = d_name[len(ignore_prefix):]
@@ -121,14 +541,30 @@ def create_directories(d_name, repo_path, ignore_prefix=None):
     return path
 
 
+def folder_name(reldir, ignore_prefix=None):
+    """Returns the IMAP folder name for a directory relative to the repo.
+
+    The inverse of `create_directories`. Returns None for the top-level
+    directory of a repository that doesn't use `ignore_prefix`. The name is
+    NFC-normalized since the filesystem might have stored it in NFD.
+    """
+    name = unicodedata.normalize('NFC', reldir.replace(os.sep, '.'))
+    name = name.strip('.')
+    if ignore_prefix:
+        return ignore_prefix + '.' + name if name else ignore_prefix
+
+    return name or None
+
+
 def symlink_uuids_to_human_readable_titles(updated_files, notes_dir):
     paths = {}
     for uuid, title in updated_files.items():
         title = util.make_filename_safe(title)
+        name = os.path.basename(uuid)  # without the shard
         i = 1
         while title in paths.values():
             try:
-                title += uuid[i]
+                title += name[i]
             except IndexError:
                 break
             else:
@@ -138,8 +574,10 @@ def symlink_uuids_to_human_readable_titles(updated_files, notes_dir):
         title = title + '.eml'
         src = os.path.join(notes_dir, uuid)
         dst = os.path.join(notes_dir, title)
-        if os.path.exists(dst):
+        try:
             os.unlink(dst)
+        except FileNotFoundError:
+            pass
         os.symlink(src, dst)
         updated_files[title] = None
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Content-addressed storage for large attachments of notes.
+
+With `format=split` under the [backup] section, base64-encoded parts of a
+note larger than `MIN_SIZE` are stored once in `.zzyzx/blobs` under their
+SHA-256 digest and replaced in the note file by a marker line. Edits of
+the note's text then only change a small file. Split notes start with
+`HEADER` and `BlobStore.reassemble()` turns them back into the original
+message byte for byte. Blobs are never deleted so that notes from older
+Mercurial revisions can be reassembled, too.
+"""
+
+import hashlib
+import io
+import os
+import re
+
+from zzyzx import mime, util
+
+
+BLOBS_PATH = os.path.join('.zzyzx', 'blobs')
+
+# Encoded parts smaller than this stay in the note.
+MIN_SIZE = 64 * 1024
+
+HEADER = b'X-Zzyzx-Format: split\r\n'
+
+marker_re = re.compile(br'zzyzx-blob:([0-9a-f]{64})(\r?\n)?\Z')
+
+
+class BlobStore:
+    """Blobs of split notes in the repository at `repo_path`."""
+
+    def __init__(self, repo_path):
+        self.root = os.path.join(repo_path, BLOBS_PATH)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data):
+        """Stores `data` unless it's already there. Returns its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def split(self, raw):
+        """Returns message `raw` with large base64 parts stored as blobs.
+
+        Returns `raw` unchanged if no part is large enough, or if it already
+        has lines that look like markers since it couldn't be reassembled.
+        """
+        lines = LineCounter(io.BytesIO(raw))
+        if any(marker_re.match(line) for line in lines.lines):
+            return raw
+
+        reader = mime.MessageReader(lines)
+        replaced = []  # (start, end, marker) in line numbers
+        for part in reader.parts():
+            cte = str(part.headers.get('content-transfer-encoding', ''))
+            if cte.strip().lower() != 'base64':
+                continue
+
+            start = lines.pos
+            part.drain()
+            # The boundary line that ended the part has been read already.
+            end = lines.pos - 1 if part.end is not None else lines.pos
+            data = b''.join(lines.lines[start:end])
+            line_break = data[len(mime.strip_line_break(data)):]
+            if len(data) < MIN_SIZE:
+                continue
+
+            digest = self.put(data[:len(data) - len(line_break)])
+            marker = b'zzyzx-blob:' + digest.encode('ascii') + line_break
+            replaced.append((start, end, marker))
+        if not replaced:
+            return raw
+
+        result = [HEADER]
+        pos = 0
+        for start, end, marker in replaced:
+            result.extend(lines.lines[pos:start])
+            result.append(marker)
+            pos = end
+        result.extend(lines.lines[pos:])
+        return b''.join(result)
+
+    def reassemble(self, lines):
+        """Yields lines of the original message from lines of a note.
+
+        Notes that aren't split are passed through unchanged.
+        """
+        lines = iter(lines)
+        first = next(lines, None)
+        if first != HEADER:
+            if first is not None:
+                yield first
+            yield from lines
+            return
+
+        for line in lines:
+            m = marker_re.match(line)
+            if not m:
+                yield line
+                continue
+
+            line_break = m.group(2) or b''
+            last = b''
+            with open(self.path(m.group(1).decode('ascii')), 'rb') as f:
+                for blob_line in f:
+                    if last:
+                        yield last
+                    last = blob_line
+            if last.endswith(b'\n'):
+                yield last
+                last = b''
+            if last + line_break:
+                yield last + line_break
+
+    def join(self, raw):
+        """Returns the original message for note `raw`."""
+        if not raw.startswith(HEADER):
+            return raw
+
+        return b''.join(self.reassemble(io.BytesIO(raw)))
+
+    def references(self, path):
+        """Returns digests of blobs the note at `path` refers to."""
+        digests = set()
+        with open(path, 'rb') as f:
+            if f.readline() != HEADER:
+                return digests
+
+            for line in f:
+                m = marker_re.match(line)
+                if m:
+                    digests.add(m.group(1).decode('ascii'))
+        return digests
+
+    def check(self, digest):
+        """Returns None if the blob is intact, otherwise the problem."""
+        try:
+            actual, _ = util.file_digest(self.path(digest))
+        except FileNotFoundError:
+            return 'missing'
+
+        return None if actual == digest else 'corrupt'
+
+
+class LineCounter:
+    """Iterates over lines of a file, counting how many were read."""
+
+    def __init__(self, f):
+        self.lines = list(f)
+        self.pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= len(self.lines):
+            raise StopIteration
+
+        self.pos += 1
+        return self.lines[self.pos - 1]
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from zzyzx import backup, md, util
+from zzyzx import backup, md, migrate, restore, sync, util, verify, watch
 
 
 def main():
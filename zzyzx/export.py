@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Destinations for the Markdown export.
+
+Besides a directory tree, the export can be streamed into a single tar or
+zip archive, or a JSON Lines file. Those are written sequentially to a
+temporary file that replaces the destination once the export succeeds.
+
+Every export has `write_text()` for converted notes and `open_binary()` for
+attachments. Names of files are paths under `root`. Timestamps are
+(atime, mtime) pairs as returned by `util.note_timestamps`.
+"""
+
+import base64
+from contextlib import contextmanager
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+
+
+# Attachments bigger than this are spooled to disk before adding to a tar.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class DirectoryExport:
+    """Writes files directly under `path`."""
+
+    def __init__(self, path=''):
+        self.root = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def write_text(self, name, text, times, attachments=()):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'w') as f:
+            f.write(text)
+        os.utime(name, times)
+
+    @contextmanager
+    def open_binary(self, name, times):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, 'wb') as f:
+            yield f
+        os.utime(name, times)
+
+
+class ArchiveExport:
+    """Base class for exports into a single file at `path`.
+
+    Names of files are relative to the root of the archive.
+    """
+
+    root = ''
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.unlink(self.tmp_path)
+
+
+class TarExport(ArchiveExport):
+    """Writes a tar archive, compressed if `path` ends with .gz, .bz2 or .xz.
+
+    Creation time is stored as the PAX access time.
+    """
+
+    compression = {'.gz': 'gz', '.tgz': 'gz', '.bz2': 'bz2', '.xz': 'xz'}
+
+    def open(self):
+        ext = os.path.splitext(self.path)[1]
+        self.tar = tarfile.open(
+            self.tmp_path,
+            'w|' + self.compression.get(ext, ''),
+            format=tarfile.PAX_FORMAT,
+        )
+
+    def close(self):
+        self.tar.close()
+
+    def write_text(self, name, text, times, attachments=()):
+        data = text.encode('utf8')
+        self._add(name, io.BytesIO(data), len(data), times)
+
+    @contextmanager
+    def open_binary(self, name, times):
+        # A tar header needs the size of the file before its contents.
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as f:
+            yield f
+            size = f.tell()
+            f.seek(0)
+            self._add(name, f, size, times)
+
+    def _add(self, name, fileobj, size, times):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = times[1]
+        info.pax_headers = {'atime': repr(times[0])}
+        self.tar.addfile(info, fileobj)
+
+
+class ZipExport(ArchiveExport):
+    """Writes a zip archive. Only modification times are stored."""
+
+    def open(self):
+        self.zip = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED)
+
+    def close(self):
+        self.zip.close()
+
+    def write_text(self, name, text, times, attachments=()):
+        self.zip.writestr(self._info(name, times), text.encode('utf8'))
+
+    @contextmanager
+    def open_binary(self, name, times):
+        with self.zip.open(self._info(name, times), 'w', force_zip64=True) as f:
+            yield f
+
+    def _info(self, name, times):
+        # The zip format can't represent dates before 1980.
+        date_time = max(time.localtime(times[1])[:6], (1980, 1, 1, 0, 0, 0))
+        info = zipfile.ZipInfo(name, date_time=date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        return info
+
+
+class JsonlExport(ArchiveExport):
+    """Writes one JSON object per line.
+
+    Notes are {"type": "note", "path", "created", "modified", "text",
+    "attachments"}. Attachments are {"type": "attachment", "path", "created",
+    "modified", "data"} with base64 `data`. They're written before the note
+    which lists them with their byte offsets in the file.
+    """
+
+    def open(self):
+        self.file = open(self.tmp_path, 'wb')
+        self.offsets = {}
+
+    def close(self):
+        self.file.close()
+
+    def write_text(self, name, text, times, attachments=()):
+        record = self._record('note', name, times)
+        record['text'] = text
+        record['attachments'] = [
+            {'path': a, 'offset': self.offsets[a]}
+            for a in attachments
+            if a in self.offsets
+        ]
+        self.file.write(json.dumps(record).encode('utf8') + b'\n')
+
+    @contextmanager
+    def open_binary(self, name, times):
+        self.offsets[name] = self.file.tell()
+        record = json.dumps(self._record('attachment', name, times))
+        # Stream the data into the last field of the record.
+        self.file.write(record[:-1].encode('utf8') + b', "data": "')
+        writer = Base64Writer(self.file)
+        yield writer
+        writer.flush()
+        self.file.write(b'"}\n')
+
+    def _record(self, type, name, times):
+        return {
+            'type': type,
+            'path': name,
+            'created': times[0],
+            'modified': times[1],
+        }
+
+
+class Base64Writer:
+    """File-like object writing base64 of everything written to `file`."""
+
+    def __init__(self, file):
+        self.file = file
+        self.leftover = b''
+
+    def write(self, data):
+        size = len(data)
+        data = self.leftover + data
+        cut = len(data) - len(data) % 3
+        self.leftover = data[cut:]
+        self.file.write(base64.b64encode(data[:cut]))
+        return size
+
+    def flush(self):
+        self.file.write(base64.b64encode(self.leftover))
+        self.leftover = b''
+
+
+OUTPUTS = {
+    'directory': DirectoryExport,
+    'tar': TarExport,
+    'zip': ZipExport,
+    'jsonl': JsonlExport,
+}
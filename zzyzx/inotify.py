@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""A minimal ctypes binding to Linux inotify(7)."""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+event_header = struct.Struct('iIII')
+
+
+class Inotify:
+    """Watches directories, `read()` returns (path, mask) tuples.
+
+    `path` is None for IN_Q_OVERFLOW, which means events were lost.
+    Raises OSError if inotify is unavailable.
+    """
+
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(name, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available') from None
+
+        self.fd = init(os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        self.watches = {}  # watch descriptor -> path
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask | IN_ONLYDIR,
+        )
+        if wd < 0:
+            self._raise(path)
+        self.watches[wd] = path
+        return wd
+
+    def remove_all(self):
+        for wd in self.watches:
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches.clear()
+
+    def read(self, timeout=None):
+        """Returns events, waiting at most `timeout` seconds for the first."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+            offset += size
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            if path is not None:
+                if name:
+                    path = os.path.join(path, name)
+                events.append((path, mask))
+        return events
+
+    def _raise(self, path=None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import collections
 from functools import partial
+from html.parser import HTMLParser
 import re
+import time
 
 from bs4 import BeautifulSoup, NavigableString
 
@@ -10,6 +13,18 @@ whitespace_re = re.compile(r'[\r\n\t ]+', re.MULTILINE)
 triple_line_re = re.compile(r'\n\n\n', re.MULTILINE)
 FRAGMENT_ID = '__MARKDOWNIFY_WRAPPER__'
 wrapped = '<div id="%s">%%s</div>' % FRAGMENT_ID
+# A "<" that html5lib and html.parser might not agree about.
+unusual_tag_open_re = re.compile(r'<(?!/?[a-zA-Z])')
+
+# Tags that `FastParser` understands. Others need html5lib.
+FAST_TAGS = frozenset({
+    'a', 'b', 'br', 'div', 'em', 'font', 'i', 'img', 'li', 'ol', 'span',
+    'strong', 'u', 'ul',
+})
+VOID_TAGS = frozenset({'br', 'img'})
+
+# What `ConversionProfile` calls text nodes, which have no tag name.
+TEXT = '#text'
 
 
 # Heading styles
@@ -33,6 +48,8 @@ class MarkdownConverter:
     class Options:
         heading_style = ATX
         bullets = '*+-'  # An iterable of bullet types.
+        fast_parser = True  # Parse simple notes without BeautifulSoup.
+        profile = False  # Record a `ConversionProfile` for every note.
 
     def __init__(self, **options):
         self.options = _todict(self.Options)
@@ -46,16 +63,86 @@ class MarkdownConverter:
         self.convert_h7 = partial(self.convert_hn, n=7)
         self.convert_h8 = partial(self.convert_hn, n=8)
         self.convert_h9 = partial(self.convert_hn, n=9)
+        self.profiles = []
+        self._profile = None
+        if self.options['profile']:
+            self.start_profiling()
+
+    def convert(self, html, name=None):
+        """Returns Markdown for `html`.
+
+        When profiling, `name` identifies the note in its profile.
+        """
+        if self._profile is not None:
+            return self._convert_profiled(html, name)
 
-    def convert(self, html):
+        return self.process_tag(self.parse(html), is_main_document=True)
+
+    def parse(self, html):
+        tag = None
         if "<html>" in html or "<body>" in html:
             soup = BeautifulSoup(html, "html5lib")
             tag = soup.find("body")
-        else:
+        elif self.options['fast_parser']:
+            tag = FastParser.parse(html)
+        if tag is None:
             soup = BeautifulSoup(wrapped % html, "html5lib")
             tag = soup.find(id=FRAGMENT_ID)
-
-        return self.process_tag(tag, is_main_document=True)
+        return tag
+
+    def start_profiling(self):
+        """Records a `ConversionProfile` in `profiles` for every conversion.
+
+        Wraps the tag handlers and `process_text` on this instance so that
+        conversions without profiling don't pay for it.
+        """
+        if self._profile is not None:
+            return
+
+        self._profile = ConversionProfile(None, 0)
+        for attr in dir(self):
+            tag = attr[len('convert_'):]
+            if attr.startswith('convert_') and tag not in ('hn', 'list'):
+                setattr(self, attr, self._timed(getattr(self, attr), tag))
+        self.process_text = self._timed(self.process_text, TEXT)
+        process_tag = self.process_tag
+
+        def counting_process_tag(node, is_main_document=False):
+            self._profile.nodes[node.name] += 1
+            return process_tag(node, is_main_document)
+
+        self.process_tag = counting_process_tag
+
+    def _timed(self, fn, key):
+        def timed(*args, **kwargs):
+            profile = self._profile
+            if profile.timing:
+                # Called by another handler, it's counted there.
+                return fn(*args, **kwargs)
+
+            profile.timing = True
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+
+            finally:
+                profile.times[key] += time.perf_counter() - start
+                profile.timing = False
+                if key == TEXT:
+                    profile.nodes[TEXT] += 1
+
+        return timed
+
+    def _convert_profiled(self, html, name):
+        profile = self._profile = ConversionProfile(name, len(html))
+        start = time.perf_counter()
+        tag = self.parse(html)
+        profile.parse_time = time.perf_counter() - start
+        profile.parser = 'fast' if isinstance(tag, Node) else 'html5lib'
+        text = self.process_tag(tag, is_main_document=True)
+        profile.total_time = time.perf_counter() - start
+        self.profiles.append(profile)
+        return text
 
     def process_tag(self, node, is_main_document=False):
         text = ''
@@ -63,7 +150,7 @@ class MarkdownConverter:
 
         # Convert the children first
         for el in node.children:
-            if isinstance(el, NavigableString):
+            if isinstance(el, (NavigableString, Text)):
                 text += self.process_text(str(el))
             else:
                 if is_main_document and text and not title_processed:
@@ -187,3 +274,157 @@ class MarkdownConverter:
         title = el.attrs.get('title', None) or ''
         title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
         return '![%s](%s%s)' % (alt, src, title_part)
+
+
+class ConversionProfile:
+    """Where the time converting a single note went.
+
+    `nodes` counts elements by tag name and text nodes under `TEXT`.
+    `times` are seconds spent in `convert_<tag>` handlers by tag name, not
+    including their children, and in `process_text` under `TEXT`.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.parser = None
+        self.parse_time = 0.0
+        self.total_time = 0.0
+        self.nodes = collections.Counter()
+        self.times = collections.Counter()
+        self.timing = False
+
+    def node_count(self):
+        return sum(self.nodes.values())
+
+    def dominant(self, n=3):
+        """Returns (key, count, seconds) for the `n` most common nodes."""
+        return [
+            (key, count, self.times[key])
+            for key, count in self.nodes.most_common(n)
+        ]
+
+
+class Unsupported(Exception):
+    """Raised by `FastParser` when html5lib is needed to parse a note."""
+
+
+class Text(str):
+    """Text node of a `Node`."""
+
+    name = None
+
+
+class Node:
+    """Element built by `FastParser`, with the bits of a BeautifulSoup `Tag`
+    that `MarkdownConverter` uses."""
+
+    __slots__ = ('name', 'attrs', 'parent', 'children')
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.children = []
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+
+class FastParser(HTMLParser):
+    """Builds a tree of `Node`s for the simple HTML found in most notes.
+
+    It only accepts well-formed markup using `FAST_TAGS`, where the tree is
+    obviously the same as the one html5lib would build. For anything else,
+    including comments, unclosed or misnested tags, it raises `Unsupported`.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.root = Node('div', {'id': FRAGMENT_ID}, None)
+        self.current = self.root
+
+    @classmethod
+    def parse(cls, html):
+        """Returns the root `Node` of `html` or None if it's unsupported."""
+        if '\x00' in html or unusual_tag_open_re.search(html):
+            return None
+
+        # html5lib normalizes newlines before tokenizing.
+        html = html.replace('\r\n', '\n').replace('\r', '\n')
+        parser = cls()
+        try:
+            parser.feed(html)
+            if '<' in parser.rawdata:
+                raise Unsupported('unfinished tag')
+
+            parser.close()
+            if parser.current is not parser.root:
+                raise Unsupported('unclosed tag')
+
+        except Unsupported:
+            return None
+
+        return parser.root
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in FAST_TAGS:
+            raise Unsupported(tag)
+
+        if '&' in self.get_starttag_text():
+            # html5lib leaves some character references in attributes alone.
+            raise Unsupported('character reference in attribute')
+
+        if tag == 'li' and self.current.name not in ('ol', 'ul'):
+            raise Unsupported('li outside of a list')
+
+        if tag == 'a' and self.is_open('a'):
+            raise Unsupported('nested link')
+
+        node_attrs = {}
+        for name, value in attrs:
+            node_attrs.setdefault(name, value or '')
+        node = Node(tag, node_attrs, self.current)
+        self.current.children.append(node)
+        if tag not in VOID_TAGS:
+            self.current = node
+
+    def handle_startendtag(self, tag, attrs):
+        if tag not in VOID_TAGS:
+            raise Unsupported('self-closing ' + tag)
+
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag != self.current.name or self.current is self.root:
+            raise Unsupported('unexpected end tag ' + tag)
+
+        self.current = self.current.parent
+
+    def handle_data(self, data):
+        children = self.current.children
+        if children and isinstance(children[-1], Text):
+            children[-1] = Text(children[-1] + data)
+        else:
+            children.append(Text(data))
+
+    def handle_comment(self, data):
+        raise Unsupported('comment')
+
+    def handle_decl(self, decl):
+        raise Unsupported('declaration')
+
+    def handle_pi(self, data):
+        raise Unsupported('processing instruction')
+
+    def unknown_decl(self, data):
+        raise Unsupported('declaration')
+
+    def is_open(self, tag):
+        node = self.current
+        while node is not None:
+            if node.name == tag:
+                return True
+
+            node = node.parent
+        return False
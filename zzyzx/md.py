@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
 
-import email.policy
-import email.parser
 import email.utils
+import io
 import mimetypes
 import os
 import sys
+import time
 
 import click
 
-from zzyzx import util
+from zzyzx import backup, blobs, export, inotify, mime, util
 
 try:
     import magic
@@ -21,10 +21,382 @@ except ImportError as e:
     markdownify = None
 
 
+# How much of an attachment is given to libmagic to guess its type.
+MAGIC_BUFFER_SIZE = 1024 * 1024
+
+
+@click.option(
+    '--watch', is_flag=True,
+    help='Keep converting notes as they change in the repository.',
+)
+@click.option(
+    '--rev', help='Export notes as they were in this Mercurial revision.',
+)
+@click.option(
+    '--path', type=util.ExpandUserPath(),
+    help='Export here instead of the [markdown] path. Required with --rev.',
+)
+@click.option(
+    '--profile', 'slowest', type=click.IntRange(1), metavar='N',
+    help='Report the N slowest notes to convert and where the time went.',
+)
 @util.pass_cfg
-def md(cfg):
+def md(cfg, watch, rev, path, slowest):
     """Reverse-engineers HTML notes to Markdown."""
 
+    markdown_path, ext, output, converter, use_tags = markdown_settings(cfg)
+    if watch and (rev or slowest):
+        raise click.ClickException(
+            '--watch cannot be combined with --rev or --profile',
+        )
+
+    if rev:
+        # Exporting deletes stale files, that would be most of the current
+        # export for an old revision.
+        if not path or os.path.realpath(path) == markdown_path:
+            raise click.ClickException(
+                '--rev needs --path other than the [markdown] path',
+            )
+
+    if path:
+        markdown_path = os.path.realpath(path)
+    if slowest:
+        converter.start_profiling()
+    if rev:
+        repo_path, hg_path = backup.repo_settings(cfg)
+        if not hg_path:
+            raise click.ClickException(
+                '--rev needs Mercurial and a repository in {}'.format(
+                    repo_path,
+                ),
+            )
+
+        notes = gen_revision_notes(hg_path, repo_path, rev)
+    else:
+        repo_path = os.path.realpath(
+            os.path.expanduser(cfg['backup']['repo_path']),
+        )
+        notes = None
+    if not watch:
+        export_all(
+            repo_path, markdown_path, ext, output, converter, use_tags, notes,
+        )
+        if slowest:
+            report_profiles(converter.profiles, slowest)
+        return
+
+    if output != 'directory':
+        raise click.ClickException(
+            '`md --watch` only supports output=directory under [markdown] '
+            'section',
+        )
+
+    try:
+        watcher = MarkdownWatcher(
+            repo_path, markdown_path, ext, converter, use_tags,
+        )
+    except OSError as e:
+        raise click.ClickException(
+            'cannot watch {}: {}'.format(repo_path, e),
+        ) from None
+
+    watcher.run()
+
+
+def export_all(
+    repo_path, markdown_path, ext, output, converter, use_tags, notes=None,
+):
+    """Converts all notes in `repo_path`, deleting stale files.
+
+    Returns {eml: files} where `eml` is the path of a note's title symlink
+    relative to `repo_path` and `files` are all files written for it.
+    `notes` yields (eml, src) pairs for `extract_files`, by default those
+    in the working directory.
+    """
+    tag = None
+    if output == 'directory':
+        existing_files = set(util.gen_existing_files(markdown_path))
+    else:
+        existing_files = set()  # archives are always written from scratch
+    if notes is None:
+        notes = gen_notes(repo_path)
+    store = blobs.BlobStore(repo_path)
+    saved_files = set()
+    exported = {}
+    with export.OUTPUTS[output](markdown_path) as exporter:
+        for eml, src in notes:
+            txt = eml[:-4] + ext
+            txt_path = os.path.join(exporter.root, txt)
+            if txt_path in saved_files:
+                count = 1
+                while '{}_{}'.format(txt_path, count) in saved_files:
+                    count += 1
+                txt_path = '{}_{}'.format(txt_path, count)
+            if use_tags:
+                tag = os.path.dirname(txt).replace(' ', '-')
+            exported[eml] = extract_files(
+                src, txt_path, converter, tag, exporter, store,
+            )
+            saved_files.update(exported[eml])
+    for f in sorted(existing_files - saved_files):
+        click.echo('Deleting stale file {}'.format(f))
+        os.unlink(f)
+    return exported
+
+
+def report_profiles(profiles, slowest):
+    """Prints the `slowest` notes to convert and totals for all of them."""
+    click.secho('Slowest notes', bold=True)
+    for p in sorted(profiles, key=lambda p: -p.total_time)[:slowest]:
+        click.echo(
+            '{:.3f}s {:.1f} KiB {} nodes parse {:.3f}s ({}) {}: {}'.format(
+                p.total_time,
+                p.size / 1024,
+                p.node_count(),
+                p.parse_time,
+                p.parser,
+                ', '.join(
+                    '{} x{} {:.3f}s'.format(*dominant)
+                    for dominant in p.dominant()
+                ),
+                p.name,
+            ),
+        )
+    total = markdownify.ConversionProfile(None, 0)
+    for p in profiles:
+        total.size += p.size
+        total.parse_time += p.parse_time
+        total.total_time += p.total_time
+        total.nodes.update(p.nodes)
+        total.times.update(p.times)
+    click.secho('Total', bold=True)
+    click.echo(
+        '{:.3f}s {:.1f} KiB {} notes {} nodes parse {:.3f}s: {}'.format(
+            total.total_time,
+            total.size / 1024,
+            len(profiles),
+            total.node_count(),
+            total.parse_time,
+            ', '.join(
+                '{} x{} {:.3f}s'.format(*dominant)
+                for dominant in total.dominant(10)
+            ),
+        ),
+    )
+
+
+def gen_notes(repo_path):
+    """Yields (eml, path) for title symlinks in `repo_path`, sorted."""
+    repo_prefix = len(util.normalize_nfd(repo_path)) + 1
+    eml_files = {
+        os.path.join(dirpath, name)[repo_prefix:]
+        for dirpath, names in util.scan_tree(repo_path).files.items()
+        for name in names
+        if name.endswith('.eml')
+    }
+    for eml in sorted(eml_files):
+        yield eml, os.path.join(repo_path, eml)
+
+
+def gen_revision_notes(hg, repo_path, rev):
+    """Yields (eml, file object) for title symlinks in revision `rev`.
+
+    Notes are streamed out of Mercurial without touching the working
+    directory. Since title symlinks come after the notes they point to in
+    archive order, they are read first from a separate archive that only
+    contains them.
+    """
+    titles = {}  # note -> titles
+    with util.hg_archive(hg, repo_path, rev, ['glob:**.eml']) as tar:
+        for member in tar:
+            if member.issym():
+                note = os.path.join(
+                    os.path.dirname(member.name),
+                    util.note_relpath(member.linkname),
+                )
+                titles.setdefault(note, []).append(member.name)
+    with util.hg_archive(hg, repo_path, rev, ['glob:**/.*']) as tar:
+        for member in tar:
+            if not member.isfile() or member.name not in titles:
+                continue
+
+            emls = sorted(titles[member.name])
+            f = tar.extractfile(member)
+            if len(emls) > 1:
+                f = f.read()
+            for eml in emls:
+                yield eml, f
+
+
+class MarkdownWatcher:
+    """Keeps the Markdown export up to date using inotify.
+
+    Events are coalesced until the repository is quiet for `settle` seconds
+    or for at most `max_delay` seconds. Then, directories with events are
+    listed to find title symlinks that appeared, disappeared or point to
+    notes which changed. Since backups rewrite all notes, a note is only
+    converted again if its digest is different.
+    """
+
+    # Events on the repository that might need converting notes again.
+    mask = (
+        inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+        inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+        inotify.IN_EXCL_UNLINK
+    )
+
+    def __init__(
+        self, repo_path, markdown_path, ext, converter, use_tags,
+        settle=0.1, max_delay=1.0,
+    ):
+        self.repo_path = repo_path
+        self.markdown_path = markdown_path
+        self.ext = ext
+        self.converter = converter
+        self.use_tags = use_tags
+        self.settle = settle
+        self.max_delay = max_delay
+        self.inotify = inotify.Inotify()
+        self.blobs = blobs.BlobStore(repo_path)
+        self.exported = {}
+        self.digests = {}  # eml -> digest of the note when it was converted
+
+    def run(self):
+        try:
+            self.resync()
+            while True:
+                events = self.inotify.read()
+                deadline = time.monotonic() + self.max_delay
+                while time.monotonic() < deadline:
+                    more = self.inotify.read(self.settle)
+                    if not more:
+                        break
+
+                    events.extend(more)
+                self.process(events)
+        except KeyboardInterrupt:
+            click.echo('Stopping.')
+        finally:
+            self.inotify.close()
+
+    def resync(self):
+        """Watches all directories and converts all notes."""
+        self.inotify.remove_all()
+        self.watch(self.repo_path)
+        self.exported = export_all(
+            self.repo_path, self.markdown_path, self.ext, 'directory',
+            self.converter, self.use_tags,
+        )
+        self.digests.clear()
+        for eml in self.exported:
+            try:
+                self.digests[eml] = self.digest(eml)
+            except FileNotFoundError:
+                pass
+
+    def watch(self, path):
+        """Watches `path` and its subdirectories. Returns all of them."""
+        self.inotify.add_watch(path, self.mask)
+        dirs = {path}
+        for d in util.scan_tree(path).dirs:
+            try:
+                self.inotify.add_watch(d, self.mask)
+            except FileNotFoundError:
+                continue
+
+            dirs.add(d)
+        return dirs
+
+    def process(self, events):
+        changed = set()
+        dirs = set()
+        moved_dir = inotify.IN_MOVED_FROM | inotify.IN_ISDIR
+        for path, mask in events:
+            if path is None or mask & moved_dir == moved_dir:
+                # Events were lost or watched paths are wrong now.
+                self.resync()
+                return
+
+            if os.path.basename(path) in util.IGNORED_DIRS:
+                continue
+
+            changed.add(path)
+            dirs.add(os.path.dirname(path))
+            if mask & inotify.IN_ISDIR and mask & (
+                inotify.IN_CREATE | inotify.IN_MOVED_TO
+            ):
+                dirs.update(self.watch(path))
+            elif mask & inotify.IN_ISDIR and mask & inotify.IN_DELETE:
+                dirs.add(path)
+        for d in sorted(dirs):
+            self.update_dir(d, changed)
+
+    def update_dir(self, d, changed):
+        """Converts notes in `d` again if needed, deletes stale ones."""
+        reldir = os.path.relpath(d, self.repo_path)
+        reldir = '' if reldir == os.curdir else reldir
+        if os.path.isdir(d):
+            known = {
+                eml for eml in self.exported if os.path.dirname(eml) == reldir
+            }
+        else:
+            prefix = reldir + os.sep
+            known = {eml for eml in self.exported if eml.startswith(prefix)}
+        current = {
+            os.path.join(reldir, name)
+            for name in util.list_files(d)
+            if name.endswith('.eml')
+        }
+        for eml in sorted(known - current):
+            self.delete(self.exported.pop(eml))
+            self.digests.pop(eml, None)
+        for eml in sorted(current):
+            eml_path = os.path.join(self.repo_path, eml)
+            if (
+                eml not in self.exported or
+                eml_path in changed or
+                os.path.realpath(eml_path) in changed
+            ):
+                self.convert(eml)
+
+    def convert(self, eml):
+        try:
+            digest = self.digest(eml)
+        except FileNotFoundError:
+            return  # a broken symlink, the note is being replaced
+
+        if eml in self.exported and self.digests.get(eml) == digest:
+            return
+
+        eml_path = os.path.join(self.repo_path, eml)
+        tag = None
+        if self.use_tags:
+            tag = os.path.dirname(eml).replace(' ', '-')
+        files = extract_files(
+            eml_path,
+            os.path.join(self.markdown_path, eml[:-4] + self.ext),
+            self.converter,
+            tag,
+            blobs=self.blobs,
+        )
+        self.delete(self.exported.get(eml, set()) - files)
+        self.exported[eml] = files
+        self.digests[eml] = digest
+
+    def digest(self, eml):
+        return util.file_digest(os.path.join(self.repo_path, eml))[0]
+
+    def delete(self, files):
+        for f in sorted(files):
+            click.echo('Deleting stale file {}'.format(f))
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+
+
+def markdown_settings(cfg):
+    """Returns (path, ext, output, converter, use_tags) from [markdown]."""
     if 'markdown' not in cfg or 'path' not in cfg['markdown']:
         raise RuntimeError("Add a [markdown] section to your configuration.")
 
@@ -33,9 +405,6 @@ def md(cfg):
         heading_style=cfg['markdown'].get('headings', 'atx'),
     )
     use_tags = cfg['markdown'].getboolean('use_tags')
-    tag = None
-
-    repo_path = os.path.realpath(os.path.expanduser(cfg['backup']['repo_path']))
     try:
         markdown_path = os.path.realpath(
             os.path.expanduser(cfg['markdown']['path'])
@@ -45,108 +414,109 @@ def md(cfg):
             '`path` not found under [markdown] section in configuration',
         ) from None
 
-    existing_files = set(util.gen_existing_files(markdown_path))
-    eml_files = set(
-        map(
-            lambda fn: fn[len(repo_path) + 1:],
-            filter(
-                lambda fn: fn.endswith('.eml'),
-                util.gen_existing_files(repo_path),
-            ),
-        ),
-    )
-    saved_files = set()
-    for eml in eml_files:
-        txt = eml[:-4] + ext
-        eml_path = os.path.join(repo_path, eml)
-        txt_path = os.path.join(markdown_path, txt)
-        if txt_path in saved_files:
-            count = 1
-            while '{}_{}'.format(txt_path, count) in saved_files:
-                count += 1
-            txt_path = '{}_{}'.format(txt_path, count)
-        if use_tags:
-            tag = os.path.dirname(txt).replace(' ', '-')
-        saved_files.update(
-            extract_files(eml_path, txt_path, converter, tag=tag)
+    output = cfg['markdown'].get('output', 'directory')
+    if output not in export.OUTPUTS:
+        raise click.ClickException(
+            'unknown output `{}` under [markdown] section, use one of: {}'
+            ''.format(output, ', '.join(sorted(export.OUTPUTS))),
         )
-    for f in sorted(existing_files - saved_files):
-        click.echo('Deleting stale file {}'.format(f))
-        os.unlink(f)
 
+    return markdown_path, ext, output, converter, use_tags
 
-def extract_files(
-    src,
-    dst,
-    converter,
-    tag=None,
-    email_parser=email.parser.BytesParser(policy=email.policy.default),
-):
+
+def extract_files(src, dst, converter, tag=None, exporter=None, blobs=None):
+    """Converts note `src` into `dst`, extracting attachments next to it.
+
+    `src` is the path of the note, the raw message as bytes, or a binary
+    file object. Returns names of all written files. By default, writes to
+    the filesystem but any of the `export.OUTPUTS` can be passed as
+    `exporter`. Split notes are reassembled from `blobs` if given.
+    """
+    if isinstance(src, str):
+        eml = open(src, 'rb')
+    elif isinstance(src, (bytes, bytearray)):
+        eml = io.BytesIO(src)
+        src = 'message'
+    else:
+        eml = src
+        src = getattr(src, 'name', 'message')
     click.echo('{} -> {}'.format(src, dst))
-    files = set()
+    if exporter is None:
+        exporter = export.DirectoryExport()
+    attachments = []
     basename, _ = os.path.splitext(dst)
-    with open(src, 'rb') as eml:
-        msg = email_parser.parse(eml)
-    created = email.utils.parsedate_to_datetime(
-        msg['x-mail-created-date'],
-    )
-    modified = email.utils.parsedate_to_datetime(
-        msg['date'],
-    )
     text_parts = {}
-    counter = 0
-    for part in msg.walk():
-        if part.get_content_maintype() == 'multipart':
-            continue  # just metadata, give me the meat
-
-        data = part.get_payload(decode=True)
-        if part.get_content_maintype() == 'text':
-            subtype = part.get_content_subtype()
-            text_parts[subtype] = data.decode(part.get_content_charset())
-        else:
-            counter += 1
-            content_type = magic.from_buffer(data, mime=True)
-            ext = guess_extension(content_type)
-            filename = ''.join((basename, str(counter), ext))
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            with open(filename, 'wb') as f:
-                f.write(data)
-                files.add(filename)
+    with eml:
+        reader = mime.MessageReader(blobs.reassemble(eml) if blobs else eml)
+        created = email.utils.parsedate_to_datetime(
+            reader.headers['x-mail-created-date'],
+        )
+        modified = email.utils.parsedate_to_datetime(
+            reader.headers['date'],
+        )
+        for part in reader.parts():
+            if part.headers.get_content_maintype() == 'text':
+                # Only text is kept in memory, it needs converting anyway.
+                subtype = part.headers.get_content_subtype()
+                charset = part.headers.get_content_charset('utf8')
+                text_parts[subtype] = part.read().decode(charset, 'replace')
+            else:
+                attachments.append(
+                    save_attachment(
+                        part,
+                        basename + str(len(attachments) + 1),
+                        exporter,
+                        created,
+                        modified,
+                    ),
+                )
+    files = set(attachments)
+
+    def write_text(filename, text):
+        if tag:
+            text += '\n#{}\n'.format(tag)
+        times = util.note_timestamps(filename, created, modified)
+        exporter.write_text(filename, text, times, attachments)
+        files.add(filename)
+
     html = text_parts.pop('html', None)
     txt = text_parts.pop('plain', None)
     if html:
-        html = converter.convert(html)
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        with open(dst, 'w') as f:
-            f.write(html)
-            if tag:
-                f.write('\n#{}\n'.format(tag))
-            files.add(dst)
+        write_text(dst, converter.convert(html, src))
     elif txt:
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        with open(dst, 'w') as f:
-            f.write(txt)
-            if tag:
-                f.write('\n#{}\n'.format(tag))
-            files.add(dst)
+        write_text(dst, txt)
     for filetype, data in text_parts.items():
         click.secho(
             'warning: unknown text subtype for `{}`: {}'
             ''.format(src, filetype),
             fg='yellow',
         )
-        filename = '.'.join((dst, filetype))
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, 'w') as f:
-            f.write(data)
-            if tag:
-                f.write('\n#{}\n'.format(tag))
-            files.add(filename)
-    for f in files:
-        util.update_timestamps(f, created, modified)
+        write_text('.'.join((dst, filetype)), data)
     return files
 
 
+def save_attachment(part, basename, exporter, created, modified):
+    """Decodes `part` into a file named after its type, chunk by chunk.
+
+    Only the beginning of the data is held in memory for libmagic to look
+    at. Returns the name of the created file.
+    """
+    chunks = part.decoded_chunks()
+    head = bytearray()
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= MAGIC_BUFFER_SIZE:
+            break
+    content_type = magic.from_buffer(bytes(head), mime=True)
+    filename = basename + guess_extension(content_type)
+    times = util.note_timestamps(filename, created, modified)
+    with exporter.open_binary(filename, times) as f:
+        f.write(head)
+        for chunk in chunks:
+            f.write(chunk)
+    return filename
+
+
 def guess_extension(content_type):
     """Like mimetypes.guess_extension but deterministic across executions."""
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+
+import click
+
+from zzyzx import backup, util
+
+
+@util.cli.command()
+@util.pass_cfg
+def migrate(cfg):
+    """Moves notes in the backup repository to the configured layout.
+
+    Title symlinks are updated to point to the moved notes. With Mercurial,
+    the moves are committed as renames so that history follows the notes.
+    """
+
+    repo_path, hg_path, _ = backup.backup_settings(cfg)
+    layout = backup.backup_layout(cfg)
+    manifest = util.Manifest(repo_path)
+    moved = 0
+    for dirpath, dirnames, _ in os.walk(repo_path):
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if d not in util.IGNORED_DIRS and not util.is_shard(d)
+        )
+        moves = migrate_folder(dirpath, layout == 'sharded')
+        if not moves:
+            continue
+
+        click.secho(os.path.relpath(dirpath, repo_path), fg='red', bold=True)
+        click.echo('Moved {} notes'.format(len(moves)))
+        reldir = os.path.relpath(dirpath, repo_path)
+        reldir = '' if reldir == os.curdir else reldir
+        for old, new in moves.items():
+            manifest.rename(
+                os.path.join(reldir, old), os.path.join(reldir, new),
+            )
+        moved += len(moves)
+
+    if not moved:
+        click.echo('All notes already use the {} layout.'.format(layout))
+        return
+
+    if manifest.exists():
+        manifest.save()
+    if hg_path:
+        util.hg_commit_moves(
+            hg_path, repo_path,
+            'Moved {} notes to the {} layout.'.format(moved, layout),
+        )
+
+
+def migrate_folder(notes_dir, sharded):
+    """Moves notes that title symlinks in `notes_dir` point to.
+
+    Returns {old: new} paths of moved notes, relative to `notes_dir`.
+    """
+    titles = {}
+    with os.scandir(notes_dir) as entries:
+        for entry in entries:
+            if entry.is_symlink() and entry.name.endswith('.eml'):
+                titles[entry.name] = util.note_relpath(os.readlink(entry.path))
+    moves = {}
+    for title, old in sorted(titles.items()):
+        name = os.path.basename(old)
+        new = os.path.join(util.shard_name(name), name) if sharded else name
+        if old == new:
+            continue
+
+        if old not in moves:
+            try:
+                os.makedirs(
+                    os.path.join(notes_dir, os.path.dirname(new)),
+                    mode=0o700,
+                    exist_ok=True,
+                )
+                os.replace(
+                    os.path.join(notes_dir, old), os.path.join(notes_dir, new),
+                )
+            except FileNotFoundError:
+                continue  # a broken symlink, the next backup fixes it
+
+            moves[old] = new
+        title_path = os.path.join(notes_dir, title)
+        os.unlink(title_path)
+        os.symlink(os.path.join(notes_dir, new), title_path)
+    util.delete_empty_shards(notes_dir, moves)
+    return moves
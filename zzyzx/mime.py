@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Streaming access to MIME messages, one line at a time.
+
+`email.parser` keeps whole messages in memory and decoding a part with
+`get_payload(decode=True)` holds both the encoded and the decoded copy.
+This module walks a message as an iterable of byte lines instead, so
+arbitrarily large attachments can be decoded in bounded memory.
+"""
+
+import binascii
+import email.parser
+import email.policy
+
+
+header_parser = email.parser.BytesHeaderParser(policy=email.policy.compat32)
+
+
+class MessageReader:
+    """Reads a message from an iterable of byte lines with line endings.
+
+    `headers` are the top-level headers as a compat32 `email.message.Message`.
+    Iterate over `parts()` to get the non-multipart parts.
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._pushback = None
+        self.headers = self._read_headers()
+
+    def parts(self):
+        """Yields a `Part` for every non-multipart part of the message.
+
+        Each part's body must be consumed before advancing to the next one,
+        otherwise it's skipped.
+        """
+        yield from self._walk(self.headers, [])
+
+    def _next_line(self):
+        if self._pushback is not None:
+            line, self._pushback = self._pushback, None
+            return line
+
+        return next(self._lines, None)
+
+    def _read_headers(self):
+        header_lines = []
+        while True:
+            line = self._next_line()
+            if line is None or not line.strip(b'\r\n'):
+                break
+
+            if line.startswith(b'--') and header_lines == []:
+                # A boundary right away, the part has no headers at all.
+                self._pushback = line
+                break
+
+            header_lines.append(line)
+        return header_parser.parsebytes(b''.join(header_lines))
+
+    def _walk(self, headers, boundaries):
+        """Yields parts, returns how the enclosing multipart should proceed.
+
+        The return value is None on EOF, otherwise a (level, is_close) tuple
+        of the boundary line that ended this part.
+        """
+        if headers.get_content_maintype() != 'multipart':
+            part = Part(headers, self, boundaries)
+            yield part
+            part.drain()
+            return part.end
+
+        boundary = headers.get_boundary()
+        if not boundary:
+            part = Part(headers, self, boundaries)
+            yield part
+            part.drain()
+            return part.end
+
+        level = len(boundaries)
+        boundaries = boundaries + [b'--' + boundary.encode('ascii', 'replace')]
+        end = self._skip(boundaries)  # the preamble
+        while end == (level, False):
+            end = yield from self._walk(self._read_headers(), boundaries)
+        if end == (level, True):
+            end = self._skip(boundaries[:level])  # the epilogue
+        return end
+
+    def _skip(self, boundaries):
+        while True:
+            line = self._next_line()
+            if line is None:
+                return None
+
+            end = match_boundary(line, boundaries)
+            if end is not None:
+                return end
+
+
+class Part:
+    """A non-multipart part of a message being read.
+
+    `headers` is a compat32 `email.message.Message` without a payload.
+    """
+
+    def __init__(self, headers, reader, boundaries):
+        self.headers = headers
+        self.end = None
+        self._reader = reader
+        self._boundaries = boundaries
+        self._consumed = False
+
+    def raw_lines(self):
+        """Yields lines of the body as they appear in the message.
+
+        The line break before the closing boundary belongs to the boundary
+        so it's stripped from the last line.
+        """
+        if self._consumed:
+            return
+
+        self._consumed = True
+        previous = None
+        while True:
+            line = self._reader._next_line()
+            if line is None:
+                break
+
+            end = match_boundary(line, self._boundaries)
+            if end is not None:
+                self.end = end
+                if previous is not None:
+                    previous = strip_line_break(previous)
+                break
+
+            if previous is not None:
+                yield previous
+            previous = line
+        if previous:
+            yield previous
+
+    def decoded_chunks(self):
+        """Yields the body decoded from its Content-Transfer-Encoding."""
+        cte = str(self.headers.get('content-transfer-encoding', '')).lower()
+        cte = cte.strip()
+        if cte == 'base64':
+            yield from decode_base64(self.raw_lines())
+        elif cte == 'quoted-printable':
+            for line in self.raw_lines():
+                yield binascii.a2b_qp(line)
+        else:
+            yield from self.raw_lines()
+
+    def read(self):
+        """Returns the entire decoded body. Only use for small parts."""
+        return b''.join(self.decoded_chunks())
+
+    def drain(self):
+        for _ in self.raw_lines():
+            pass
+
+
+def strip_line_break(line):
+    if line.endswith(b'\r\n'):
+        return line[:-2]
+
+    if line.endswith(b'\n'):
+        return line[:-1]
+
+    return line
+
+
+def match_boundary(line, boundaries):
+    """Returns (level, is_close) if `line` is one of the `boundaries`."""
+    if not line.startswith(b'--'):
+        return None
+
+    line = line.rstrip()
+    for level in range(len(boundaries) - 1, -1, -1):
+        boundary = boundaries[level]
+        if line == boundary:
+            return level, False
+
+        if line == boundary + b'--':
+            return level, True
+
+    return None
+
+
+def decode_base64(lines):
+    """Decodes base64 `lines` incrementally, tolerating broken padding."""
+    leftover = b''
+    for line in lines:
+        data = leftover + b''.join(line.split())
+        cut = len(data) - len(data) % 4
+        leftover = data[cut:]
+        if cut:
+            try:
+                yield binascii.a2b_base64(data[:cut])
+            except binascii.Error:
+                pass
+    if leftover.strip(b'='):
+        try:
+            yield binascii.a2b_base64(leftover + b'=' * (-len(leftover) % 4))
+        except binascii.Error:
+            pass
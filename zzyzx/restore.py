@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import email.utils
+import os
+import time
+
+import click
+
+from zzyzx import backup, blobs, util
+
+
+# Limits of a single APPEND command uploading many notes with MULTIAPPEND.
+BATCH_SIZE = 100
+BATCH_BYTES = 16 * 1024 * 1024
+
+# Flags of restored notes.
+FLAGS = r'(\Seen)'
+
+
+@util.cli.command()
+@click.option(
+    '--rev', help='Restore notes as they were in this Mercurial revision.',
+)
+@click.option(
+    '--folder', 'folders', multiple=True, metavar='NAME',
+    help='Only restore this IMAP folder and its subfolders. Repeatable.',
+)
+@util.pass_cfg
+def restore(cfg, rev, folders):
+    """Uploads notes from the backup repository back to the IMAP server.
+
+    Notes that are already on the server are skipped.
+    """
+
+    repo_path, hg_path = backup.repo_settings(cfg)
+    ignore_prefix = cfg['backup'].get('ignore_prefix')
+    if rev and not hg_path:
+        raise click.ClickException('--rev needs Mercurial')
+
+    store = blobs.BlobStore(repo_path)
+    start = time.time()
+    with util.imap_connection(cfg) as conn:
+        mailboxes = backup.list_mailboxes(conn)
+        uploader = Uploader(
+            conn, {d.name: d.name_querysafe for d in mailboxes},
+        )
+        for d in mailboxes:
+            uploader.uuids.update(fetch_uuids(conn, d))
+        for reldir, raw in gen_notes(repo_path, hg_path, rev):
+            name = backup.folder_name(util.folder_dir(reldir), ignore_prefix)
+            if name is None:
+                continue
+
+            if folders and not any(
+                name == f or name.startswith(f + '.') for f in folders
+            ):
+                continue
+
+            uploader.add(name, store.join(raw))
+        uploader.flush_all()
+    click.echo(
+        'Restored {} notes in {:.2f} seconds, skipped {} already on the '
+        'server.'.format(
+            uploader.uploaded, time.time() - start, uploader.skipped,
+        ),
+    )
+
+
+def fetch_uuids(conn, d):
+    """Returns UUIDs of notes in folder `d`, only fetching that header."""
+    typ, data = conn.select(d.name_querysafe, readonly=True)
+    if typ != 'OK' or data[0] in (None, b'0'):
+        return set()
+
+    typ, data = conn.fetch(
+        '1:*', '(BODY.PEEK[HEADER.FIELDS (X-Universally-Unique-Identifier)])',
+    )
+    uuids = set()
+    for item in data:
+        if isinstance(item, tuple):
+            headers = util.parse_headers(item[1])
+            if 'x-universally-unique-identifier' in headers:
+                uuids.add(headers['x-universally-unique-identifier'])
+    return uuids
+
+
+def gen_notes(repo_path, hg_path=None, rev=None):
+    """Yields (reldir, raw message) for notes in the repository.
+
+    `reldir` is the directory of the note relative to `repo_path`. With
+    `rev`, notes come from that Mercurial revision instead of the working
+    directory.
+    """
+    if rev:
+        with util.hg_archive(hg_path, repo_path, rev) as tar:
+            for member in tar:
+                reldir, name = os.path.split(member.name)
+                top = reldir.split('/', 1)[0]
+                if (
+                    member.isfile() and name.startswith('.') and
+                    top not in util.IGNORED_DIRS
+                ):
+                    yield reldir, tar.extractfile(member).read()
+        return
+
+    for dirpath, dirnames, filenames in os.walk(repo_path):
+        dirnames[:] = sorted(
+            d for d in dirnames if d not in util.IGNORED_DIRS
+        )
+        reldir = os.path.relpath(dirpath, repo_path)
+        if reldir == os.curdir:
+            reldir = ''
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if name.startswith('.') and not os.path.islink(path):
+                with open(path, 'rb') as f:
+                    yield reldir, f.read()
+
+
+class Uploader:
+    """Appends notes to folders in batches, creating missing folders.
+
+    `folders` maps names of existing folders to their quoted names. Notes
+    with UUIDs in `uuids` are skipped.
+    """
+
+    def __init__(self, conn, folders):
+        self.conn = conn
+        self.folders = folders
+        self.uuids = set()
+        self.multiappend = 'MULTIAPPEND' in conn.capabilities
+        self.pending = {}  # folder name -> [(flags, date_time, message)]
+        self.pending_bytes = {}
+        self.uploaded = 0
+        self.skipped = 0
+
+    def add(self, name, raw):
+        headers = util.parse_headers(raw)
+        uuid = headers.get('x-universally-unique-identifier')
+        if not uuid:
+            return  # not a note
+
+        if uuid in self.uuids:
+            self.skipped += 1
+            return
+
+        self.uuids.add(uuid)
+        date_time = email.utils.parsedate_to_datetime(headers['date'])
+        batch = self.pending.setdefault(name, [])
+        batch.append((FLAGS, date_time, raw))
+        size = self.pending_bytes.get(name, 0) + len(raw)
+        self.pending_bytes[name] = size
+        if len(batch) >= BATCH_SIZE or size >= BATCH_BYTES:
+            self.flush(name)
+
+    def flush(self, name):
+        messages = self.pending.pop(name, [])
+        self.pending_bytes.pop(name, None)
+        if not messages:
+            return
+
+        mailbox = self.mailbox(name)
+        click.secho(name, fg='red', bold=True, nl=False)
+        click.echo(': uploading {} notes'.format(len(messages)))
+        if self.multiappend:
+            typ, data = self.conn.multiappend(mailbox, messages)
+        else:
+            for message in messages:
+                typ, data = self.conn.append(mailbox, *message)
+                if typ != 'OK':
+                    break
+        if typ != 'OK':
+            raise click.ClickException(
+                'uploading to {} failed: {!r}'.format(name, data),
+            )
+
+        self.uploaded += len(messages)
+
+    def flush_all(self):
+        for name in sorted(self.pending):
+            self.flush(name)
+
+    def mailbox(self, name):
+        """Returns the quoted name of folder `name`, creating it if needed."""
+        if name not in self.folders:
+            quoted = util.encode_mailbox_name(name)
+            typ, data = self.conn.create(quoted)
+            if typ != 'OK':
+                raise click.ClickException(
+                    'creating folder {} failed: {!r}'.format(name, data),
+                )
+
+            click.echo('Created folder {}'.format(name))
+            self.folders[name] = quoted
+        return self.folders[name]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import time
+
+import click
+
+from zzyzx import backup, blobs, md, util
+
+
+# Where `MarkdownSync` records files written for every note, relative to
+# the Markdown path.
+EXPORTED_PATH = os.path.join('.zzyzx', 'exported')
+
+
+@util.pass_cfg
+def sync(cfg):
+    """Backs up notes and converts the changed ones to Markdown."""
+
+    markdown_path, ext, output, converter, use_tags = md.markdown_settings(cfg)
+    if output != 'directory':
+        raise click.ClickException(
+            '`sync` only supports output=directory under [markdown] section',
+        )
+
+    repo_path, hg_path, ignore_prefix = backup.backup_settings(cfg)
+    metadata = backup.new_metadata()
+    listener = MarkdownSync(repo_path, markdown_path, ext, converter, use_tags)
+    backup.run_backup(cfg, repo_path, ignore_prefix, metadata, listener)
+    listener.finish()
+    metadata['duration'] = time.time() - metadata['start_time']
+    if hg_path:
+        util.hg_commit(hg_path, repo_path, metadata)
+
+
+class MarkdownSync:
+    """Converts notes to Markdown as they're backed up, if they changed.
+
+    A note changed if its digest differs from the one recorded by the last
+    backup or if its title changed. Once their folder is saved, changed
+    notes are converted from the files written by the backup, so messages
+    aren't kept in memory meanwhile. Files written for every note are
+    recorded so that they can be deleted when the note is renamed or
+    deleted, unless another note wrote them since. Without that record, all
+    notes are converted.
+    """
+
+    def __init__(self, repo_path, markdown_path, ext, converter, use_tags):
+        self.repo_path = repo_path
+        self.markdown_path = markdown_path
+        self.ext = ext
+        self.converter = converter
+        self.use_tags = use_tags
+        self.manifest = util.Manifest(repo_path)
+        self.blobs = blobs.BlobStore(repo_path)
+        self.state_path = os.path.join(markdown_path, EXPORTED_PATH)
+        try:
+            with open(self.state_path) as f:
+                self.exported = json.load(f)
+        except FileNotFoundError:
+            self.exported = {}
+            self.convert_all = True
+        else:
+            self.convert_all = False
+        self.owners = {}  # exported file -> path of the note that wrote it
+        for name, entry in self.exported.items():
+            for f in entry['files']:
+                self.owners[f] = name
+        self.changed = set()  # paths of notes to convert
+
+    def message_saved(self, notes_dir, filename, raw):
+        name = os.path.relpath(
+            os.path.join(notes_dir, filename), self.repo_path,
+        )
+        entry = self.manifest.entries.get(name)
+        if (
+            self.convert_all or entry is None or
+            entry.digest != hashlib.sha256(raw).hexdigest()
+        ):
+            self.changed.add(name)
+
+    def folder_saved(self, notes_dir, updated_files):
+        for title in sorted(updated_files):
+            if not title.endswith('.eml'):
+                continue
+
+            note_path = os.readlink(os.path.join(notes_dir, title))
+            name = os.path.relpath(note_path, self.repo_path)
+            txt = os.path.relpath(
+                os.path.join(notes_dir, title[:-4] + self.ext),
+                self.repo_path,
+            )
+            previous = self.exported.get(name)
+            if (
+                name not in self.changed and
+                previous and previous['text'] == txt
+            ):
+                continue
+
+            self.convert(name, txt, note_path)
+        self.changed.clear()
+
+    def convert(self, name, txt, note_path):
+        tag = None
+        if self.use_tags:
+            tag = os.path.dirname(txt).replace(' ', '-')
+        files = md.extract_files(
+            note_path, os.path.join(self.markdown_path, txt), self.converter, tag,
+            blobs=self.blobs,
+        )
+        files = sorted(os.path.relpath(f, self.markdown_path) for f in files)
+        previous = self.exported.get(name)
+        self.exported[name] = {'text': txt, 'files': files}
+        for f in files:
+            self.owners[f] = name
+        if previous:
+            self.release(name, set(previous['files']) - set(files))
+
+    def finish(self):
+        """Deletes files of notes deleted from the repository, saves state."""
+        for name in sorted(self.exported):
+            if not os.path.exists(os.path.join(self.repo_path, name)):
+                self.release(name, self.exported.pop(name)['files'])
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.exported, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def release(self, name, files):
+        """Deletes `files` of note `name` unless another note wrote them.
+
+        That happens when a note takes over the title of a renamed one or
+        when a note moves within the repository.
+        """
+        stale = {f for f in files if self.owners.get(f) == name}
+        for f in stale:
+            del self.owners[f]
+        self.delete(stale)
+
+    def delete(self, files):
+        for f in sorted(files):
+            click.echo('Deleting stale file {}'.format(f))
+            try:
+                os.unlink(os.path.join(self.markdown_path, f))
+            except FileNotFoundError:
+                pass
+
+
+if md.markdownify:
+    sync = util.cli.command()(sync)
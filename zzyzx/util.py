@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 
+import base64
 from collections import namedtuple
 import configparser
 from contextlib import contextmanager
 from datetime import datetime
+import email.header
 from functools import cmp_to_key
 from functools import update_wrapper
 import getpass
+import hashlib
 import imaplib
 import locale
+import mmap
 import os
 import re
 import shutil
+import socket
 import subprocess
+import tarfile
 from tempfile import NamedTemporaryFile
+import time
 import unicodedata
+import zlib
 
 import click
 import pkg_resources
@@ -58,21 +66,242 @@ def get_user():
     return input().strip()
 
 
-@contextmanager
-def imap_connection(cfg):
+def pop_credentials(cfg):
+    """Returns (user, password) for the [server], scrubbing them from `cfg`.
+
+    Asks interactively for whatever is missing.
+    """
     srv = cfg['server']
-    conn = imaplib.IMAP4_SSL(srv['host'])
     try:
-        if not srv.get('user'):
-            srv['user'] = get_user()
-        if not srv.get('pass'):
-            srv['pass'] = getpass.getpass()
+        user = srv.get('user') or get_user()
+        password = srv.get('pass') or getpass.getpass()
+    finally:
+        # don't snoop my password, man.
+        srv.pop('user', None)
+        srv.pop('pass', None)
+    return user, password
+
+
+class Deflate:
+    """Stream state for RFC 4978 COMPRESS=DEFLATE, with traffic counters."""
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        # Negative window bits mean raw deflate without the zlib header.
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.sent = 0
+        self.sent_compressed = 0
+        self.received = 0
+        self.received_compressed = 0
+
+    def compress(self, data):
+        result = self.compressor.compress(data)
+        result += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.sent += len(data)
+        self.sent_compressed += len(result)
+        return result
+
+    def decompress(self, data):
+        result = self.decompressor.decompress(data)
+        self.received += len(result)
+        self.received_compressed += len(data)
+        return result
+
+    def report(self):
+        return (
+            'Received {} bytes ({} compressed), sent {} bytes ({} compressed).'
+            ''.format(
+                self.received,
+                self.received_compressed,
+                self.sent,
+                self.sent_compressed,
+            )
+        )
+
+
+class IMAP4(imaplib.IMAP4_SSL):
+    """IMAP4_SSL with a read buffer that survives socket timeouts.
+
+    The stock implementation reads through `socket.makefile()` which can't
+    be read from anymore after a timeout. We need timeouts to IDLE.
+    """
+
+    def open(self, *args, **kwargs):
+        self._buffer = bytearray()
+        self.deflate = None
+        super().open(*args, **kwargs)
+
+    def login(self, user, password):
+        typ, dat = super().login(user, password)
+        # Servers usually advertise more capabilities once authenticated.
+        typ, capabilities = self.capability()
+        if typ == 'OK' and capabilities[-1]:
+            self.capabilities = tuple(
+                capabilities[-1].decode('ascii').upper().split(),
+            )
+        return 'OK', dat
+
+    def compress(self):
+        """Enables RFC 4978 COMPRESS=DEFLATE for the rest of the session."""
+        typ, dat = self.xatom('COMPRESS', 'DEFLATE')
+        if typ == 'OK':
+            # Nothing else can be buffered, the server waits for a command.
+            self.deflate = Deflate()
+        return typ, dat
+
+    def send(self, data):
+        if self.deflate:
+            data = self.deflate.compress(data)
+        super().send(data)
+
+    def _recv(self):
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                raise self.abort('socket error: EOF')
+
+            if not self.deflate:
+                return data
+
+            # A partial deflate block might not decompress to anything yet.
+            data = self.deflate.decompress(data)
+            if data:
+                return data
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            self._buffer += self._recv()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self):
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end != -1:
+                break
+
+            start = len(self._buffer)
+            if start > imaplib._MAXLINE:
+                raise self.error('got more than {} bytes'.format(start))
+
+            self._buffer += self._recv()
+        line = bytes(self._buffer[:end + 1])
+        del self._buffer[:end + 1]
+        return line
+
+    def idle(self, timeout, settle=1.0):
+        """Waits up to `timeout` seconds for the server to report changes.
+
+        Implements RFC 2177 IDLE. Once something is reported, waits `settle`
+        more seconds to gather a burst of responses. Returns the list of
+        untagged responses received, empty if nothing happened.
+        """
+        tag = self._new_tag()
+        self.send(tag + b' IDLE' + imaplib.CRLF)
+        responses = []
+        line = self._get_line()
+        while not line.startswith(b'+'):
+            if line.startswith(tag + b' '):
+                del self.tagged_commands[tag]
+                raise self.error('IDLE failed: {!r}'.format(line))
+
+            responses.append(self._read_idle_response(line))
+            line = self._get_line()
+
+        deadline = time.monotonic() + timeout
+        old_timeout = self.sock.gettimeout()
         try:
-            conn.login(srv['user'], srv['pass'])
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self.sock.settimeout(remaining)
+                try:
+                    line = self._get_line()
+                except socket.timeout:
+                    break
+
+                responses.append(self._read_idle_response(line))
+                deadline = min(deadline, time.monotonic() + settle)
         finally:
-            # don't snoop my password, man.
-            del srv['user']
-            del srv['pass']
+            self.sock.settimeout(old_timeout)
+
+        self.send(b'DONE' + imaplib.CRLF)
+        line = self._get_line()
+        while not line.startswith(tag + b' '):
+            responses.append(self._read_idle_response(line))
+            line = self._get_line()
+        del self.tagged_commands[tag]
+        if not line[len(tag) + 1:].startswith(b'OK'):
+            raise self.error('IDLE failed: {!r}'.format(line))
+
+        return responses
+
+    def multiappend(self, mailbox, messages):
+        """Appends (flags, date_time, message) `messages` in one command.
+
+        Implements RFC 3502 MULTIAPPEND, arguments are like in `append()`
+        but `mailbox` must already be quoted. With LITERAL+, messages are
+        sent without waiting for the server to ask for each of them.
+        """
+        literal_plus = 'LITERAL+' in self.capabilities
+        tag = self._new_tag()
+        data = tag + b' APPEND ' + os.fsencode(mailbox)
+        for flags, date_time, message in messages:
+            message = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+            data += ' {} {} {{{}{}}}'.format(
+                flags,
+                imaplib.Time2Internaldate(date_time),
+                len(message),
+                '+' if literal_plus else '',
+            ).encode('ascii')
+            self.send(data + imaplib.CRLF)
+            if not literal_plus:
+                while self._get_response():
+                    if self.tagged_commands[tag]:  # BAD/NO?
+                        return self._command_complete('APPEND', tag)
+
+            self.send(message)
+            data = b''
+        self.send(imaplib.CRLF)
+        return self._command_complete('APPEND', tag)
+
+    def _read_idle_response(self, line):
+        if line.startswith(b'* BYE'):
+            raise self.abort(line.decode('utf8', 'replace'))
+
+        # Skip over literals, we only care about the response being there.
+        response = line
+        while self._match(self.Literal, line):
+            self.read(int(self.mo.group('size')))
+            line = self._get_line()
+        return response
+
+
+@contextmanager
+def imap_connection(cfg, credentials=None):
+    """Yields a logged in IMAP connection to the configured [server].
+
+    Compression is negotiated if the server supports it, unless disabled
+    with `compress=no`.
+
+    Without explicit `credentials`, they are taken from the configuration
+    (and scrubbed from it) or asked for interactively.
+    """
+    srv = cfg['server']
+    conn = IMAP4(srv['host'])
+    try:
+        if credentials is None:
+            credentials = pop_credentials(cfg)
+        conn.login(*credentials)
+        if (
+            srv.getboolean('compress', True) and
+            'COMPRESS=DEFLATE' in conn.capabilities
+        ):
+            conn.compress()
         yield conn
     finally:
         try:
@@ -104,13 +333,45 @@ list_response = namedtuple(
 )
 
 
+modified_utf7_re = re.compile(r'&([^-]*)-')
+non_ascii_re = re.compile(r'[^ -~]+')
+
+
+def decode_mailbox_name(name):
+    """Decodes a mailbox name in modified UTF-7, stripping quotes if any."""
+    if name.startswith(b'"') and name.endswith(b'"'):
+        name = name[1:-1].replace(b'\\"', b'"').replace(b'\\\\', b'\\')
+
+    def decode(m):
+        if not m.group(1):
+            return '&'
+
+        chunk = m.group(1).replace(',', '/')
+        chunk += '=' * (-len(chunk) % 4)
+        return base64.b64decode(chunk).decode('utf-16-be')
+
+    return modified_utf7_re.sub(decode, name.decode('utf8'))
+
+
+def encode_mailbox_name(name):
+    """Encodes a mailbox name in modified UTF-7 and quotes it."""
+
+    def encode(m):
+        chunk = base64.b64encode(m.group().encode('utf-16-be'))
+        chunk = chunk.rstrip(b'=').replace(b'/', b',')
+        return '&' + chunk.decode('ascii') + '-'
+
+    name = non_ascii_re.sub(encode, name.replace('&', '&-'))
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
 def parse_list_response(line):
     m = list_response_pattern.match(line)
     if not m:
         return None
 
     return list_response(
-        m.group('name').replace(b'&', b'+').decode('utf7'),
+        decode_mailbox_name(m.group('name')),
         m.group('delimiter').decode('ascii'),
         m.group('flags').decode('ascii').split(),
         m.group('name_querysafe'),
@@ -136,25 +397,132 @@ def parse_list_responses(lines):
     return result
 
 
+IGNORED_DIRS = frozenset({'CVS', '.git', '.hg', '.svn', '.zzyzx'})
+
+# With `layout=sharded`, note files are spread over these subdirectories of
+# their folder's directory. IMAP folder names can't produce them since a
+# dot separates folders.
+SHARDS = tuple('.{:02x}'.format(i) for i in range(256))
+shard_re = re.compile(r'\.[0-9a-f]{2}\Z')
+
+
+tree_scan = namedtuple('tree_scan', 'files dirs symlinks')
+
+
+def normalize_nfd(name):
+    """Like unicodedata.normalize('NFD', name) but free for ASCII names."""
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        return unicodedata.normalize('NFD', name)
+
+    return name
+
+
+def scan_tree(path, ignored_dirs=IGNORED_DIRS):
+    """Walks `path` once, returning a `tree_scan`.
+
+    `files` maps every NFD-normalized directory path (including `path`
+    itself) to the set of file and symlink names directly inside it. `dirs`
+    and `symlinks` are sets of NFD-normalized paths. Version control
+    directories are not recursed into.
+    """
+    files = {}
+    dirs = set()
+    symlinks = set()
+    # Pairs of (real path, normalized path). We can't use the latter to
+    # access the filesystem since it might store names in NFC.
+    stack = [(path, normalize_nfd(path))]
+    while stack:
+        top, top_nfd = stack.pop()
+        try:
+            entries = os.scandir(top)
+        except FileNotFoundError:
+            continue
+
+        names = files[top_nfd] = set()
+        with entries:
+            for entry in entries:
+                name = normalize_nfd(entry.name)
+                if entry.is_symlink():
+                    names.add(name)
+                    symlinks.add(os.path.join(top_nfd, name))
+                elif entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignored_dirs:
+                        dirs.add(os.path.join(top_nfd, name))
+                        stack.append(
+                            (entry.path, os.path.join(top_nfd, name)),
+                        )
+                else:
+                    names.add(name)
+    return tree_scan(files, dirs, symlinks)
+
+
+def list_files(path):
+    """Returns NFD-normalized names of files and symlinks directly in `path`."""
+    try:
+        entries = os.scandir(path)
+    except FileNotFoundError:
+        return set()
+
+    with entries:
+        return {
+            normalize_nfd(entry.name)
+            for entry in entries
+            if not entry.is_dir(follow_symlinks=False)
+        }
+
+
+def shard_name(filename):
+    """Returns the shard directory for note file `filename`."""
+    return '.' + hashlib.sha1(filename.encode('utf8')).hexdigest()[:2]
+
+
+def is_shard(name):
+    return bool(shard_re.match(name))
+
+
+def folder_dir(reldir):
+    """Returns the directory of a folder given the directory of a note."""
+    head, tail = os.path.split(reldir)
+    return head if is_shard(tail) else reldir
+
+
+def note_relpath(target):
+    """Returns the target of a title symlink relative to its directory."""
+    shard_path, name = os.path.split(target)
+    shard = os.path.basename(shard_path)
+    return os.path.join(shard, name) if is_shard(shard) else name
+
+
+def list_note_files(path):
+    """Like `list_files` but includes files in shards as relative paths."""
+    files = list_files(path)
+    for shard in SHARDS:
+        files.update(
+            os.path.join(shard, name)
+            for name in list_files(os.path.join(path, shard))
+        )
+    return files
+
+
+def delete_empty_shards(notes_dir, files):
+    """Removes shards of deleted `files` from `notes_dir` if empty."""
+    for shard in sorted({os.path.dirname(f) for f in files} - {''}):
+        try:
+            os.rmdir(os.path.join(notes_dir, shard))
+        except OSError:
+            pass
+
+
 def gen_existing_files(path):
-    ignored_dirs = ['CVS', '.git', '.hg', '.svn']
-    for root, dirs, files in os.walk(path):
-        for ignored in ignored_dirs:
-            if ignored in dirs:
-                dirs.remove(ignored)
-        for file in files:
-            yield unicodedata.normalize('NFD', os.path.join(root, file))
+    for dirpath, names in scan_tree(path).files.items():
+        for name in names:
+            yield os.path.join(dirpath, name)
 
 
 def gen_existing_dirs(path):
-    for dirpath, dirnames, filenames in os.walk(path):
-        for dirname in {'.hg', '.git'}:
-            # don't recurse into version-control directories
-            if dirname in dirnames:
-                dirnames.remove(dirname)
-
-        for dirname in dirnames:
-            yield unicodedata.normalize('NFD', os.path.join(dirpath, dirname))
+    yield from scan_tree(path).dirs
 
 
 def delete_directories(dirs_to_delete):
@@ -182,6 +550,153 @@ def delete_files(notes_dir, files_to_delete):
             )
 
 
+# Where `Manifest` is stored, relative to the repository.
+MANIFEST_PATH = os.path.join('.zzyzx', 'digests')
+
+
+manifest_entry = namedtuple('manifest_entry', 'digest size mtime_ns')
+
+
+class Manifest:
+    """SHA-256 digests of note files recorded during backups.
+
+    Stored in the repository as lines of "<digest> <size> <mtime_ns> <path>"
+    where the path is relative to the repository. `entries` maps those paths
+    to `manifest_entry` tuples, `dirs` maps directories of folders to the
+    paths of their entries. Only change them through the methods below.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.path = os.path.join(repo_path, MANIFEST_PATH)
+        self.entries = {}
+        self.dirs = {}
+        self.written = {}  # path -> entry of a file written by this backup
+        try:
+            f = open(self.path, encoding='utf8', errors='surrogateescape')
+        except FileNotFoundError:
+            return
+
+        with f:
+            for line in f:
+                digest, size, mtime_ns, name = line.rstrip('\n').split(' ', 3)
+                self._add(name, manifest_entry(
+                    digest, int(size), int(mtime_ns),
+                ))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def record(self, path, digest):
+        """Remembers the `digest` of the file just written to `path`.
+
+        `update_dir` uses it instead of reading the file again.
+        """
+        st = os.stat(path)
+        self.written[path] = manifest_entry(
+            digest, st.st_size, st.st_mtime_ns,
+        )
+
+    def update_dir(self, notes_dir, names):
+        """Records digests of `names` in `notes_dir`, forgetting other files.
+
+        `names` may be in shards. Symlinks among them are skipped. Files
+        not passed to `record` are hashed.
+        """
+        reldir = self._reldir(notes_dir)
+        for name in self.dirs.pop(reldir, ()):
+            del self.entries[name]
+        for name in names:
+            path = os.path.join(notes_dir, name)
+            entry = self.written.pop(path, None)
+            if entry is None:
+                if os.path.islink(path):
+                    continue
+
+                digest, st = file_digest(path)
+                entry = manifest_entry(digest, st.st_size, st.st_mtime_ns)
+            self._add(os.path.join(reldir, name), entry)
+
+    def retain_dirs(self, notes_dirs):
+        """Forgets files outside of `notes_dirs`."""
+        reldirs = {self._reldir(d) for d in notes_dirs}
+        for reldir in set(self.dirs) - reldirs:
+            for name in self.dirs.pop(reldir):
+                del self.entries[name]
+
+    def rename(self, old, new):
+        """Moves the entry for path `old`, if any, to path `new`."""
+        entry = self.entries.pop(old, None)
+        if entry is not None:
+            self.dirs[folder_dir(os.path.dirname(old))].discard(old)
+            self._add(new, entry)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(
+            tmp_path, 'w', encoding='utf8', errors='surrogateescape',
+        ) as f:
+            for name, entry in sorted(self.entries.items()):
+                f.write('{} {} {} {}\n'.format(*entry, name))
+        os.replace(tmp_path, self.path)
+
+    def _add(self, name, entry):
+        self.entries[name] = entry
+        reldir = folder_dir(os.path.dirname(name))
+        self.dirs.setdefault(reldir, set()).add(name)
+
+    def _reldir(self, notes_dir):
+        reldir = os.path.relpath(notes_dir, self.repo_path)
+        return '' if reldir == os.curdir else reldir
+
+
+def file_digest(path):
+    """Returns (SHA-256 hex digest, os.stat_result) of the file at `path`.
+
+    The file is memory-mapped so hashing doesn't copy it and releases the
+    GIL, which lets threads hash several files at once.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                digest.update(m)
+    return digest.hexdigest(), st
+
+
+header_block_end_re = re.compile(br'\r?\n\r?\n')
+header_folding_re = re.compile(br'\r?\n(?=[ \t])')
+header_re = re.compile(br'^([^:\s]+):[ \t]*(.*?)\r?$', re.M)
+
+
+def parse_headers(raw):
+    """Returns {lowercase name: value} for the header block of message `raw`.
+
+    Much cheaper than `email.parser` as the body is never looked at and no
+    header objects are built. The first occurrence of a header wins. Values
+    are unfolded but RFC 2047 encoded words are left for `decode_header`.
+    """
+    m = header_block_end_re.search(raw)
+    block = raw[:m.start()] if m else raw
+    block = header_folding_re.sub(b'', block)
+    headers = {}
+    for name, value in header_re.findall(block):
+        name = name.decode('ascii', 'replace').lower()
+        if name not in headers:
+            headers[name] = value.decode('utf8', 'replace')
+    return headers
+
+
+def decode_header(value):
+    """Decodes RFC 2047 encoded words in a raw header `value`."""
+    if value is None or '=?' not in value:
+        return value
+
+    return str(email.header.make_header(email.header.decode_header(value)))
+
+
 def make_filename_safe(name):
     name = name[:64]
 
@@ -228,31 +743,97 @@ def hg_init(hg, repo_path):
     if os.path.exists(os.path.join(repo_path, '.hg')):
         return
 
-    old_cwd = os.getcwd()
     try:
-        os.chdir(repo_path)
         subprocess.run(
             [hg, 'init'],
             check=True,
             stdout=subprocess.DEVNULL,
+            cwd=repo_path,
         )
     except (OSError, subprocess.CalledProcessError):
         click.secho(
             'warning: hg init failed, history will not be stored',
             fg='yellow',
         )
+
+
+def hg_manifest(hg, repo_path):
+    """Returns paths tracked in the working directory's parent revision.
+
+    Returns None if Mercurial failed.
+    """
+    try:
+        proc = subprocess.run(
+            [hg, 'manifest'],
+            check=True,
+            stdout=subprocess.PIPE,
+            cwd=repo_path,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        click.secho('warning: hg manifest failed', fg='yellow')
+        return None
+
+    return {
+        os.path.normpath(os.fsdecode(line))
+        for line in proc.stdout.splitlines()
+    }
+
+
+@contextmanager
+def hg_archive(hg, repo_path, rev, include=()):
+    """Yields the repository at revision `rev` as a streamed tar archive.
+
+    Members are named relative to the repository. Extract them with
+    `extractfile()` in archive order, the stream can't be rewound. Only
+    files matching `include` patterns are archived if any are given.
+    """
+    args = [hg, 'archive', '-t', 'tar', '-p', 'zzyzx', '-r', rev]
+    for pattern in include:
+        args += ['-I', pattern]
+    proc = subprocess.Popen(
+        args + ['-'],
+        stdout=subprocess.PIPE,
+        cwd=repo_path,
+    )
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield ArchiveMembers(tar)
+    except tarfile.ReadError:
+        raise click.ClickException(
+            'hg archive failed for revision {}'.format(rev),
+        ) from None
+
     finally:
-        os.chdir(old_cwd)
+        proc.stdout.close()
+        proc.wait()
+
+
+class ArchiveMembers:
+    """Wraps a `tarfile.TarFile` from `hg archive`, stripping the prefix."""
+
+    def __init__(self, tar):
+        self.tar = tar
+
+    def __iter__(self):
+        for member in self.tar:
+            member.name = member.name.split('/', 1)[-1]
+            yield member
+
+    def extractfile(self, member):
+        """Returns a file object for `member`, named after it."""
+        f = self.tar.extractfile(member)
+        f.raw.name = member.name
+        return f
 
 
 def hg_commit(hg, repo_path, metadata):
-    old_cwd = os.getcwd()
+    # Not changing the current directory since accounts commit in threads.
     try:
-        os.chdir(repo_path)
         proc = subprocess.run(
             [hg, 'status'],
             check=True,
             stdout=subprocess.PIPE,
+            cwd=repo_path,
         )
     except (OSError, subprocess.CalledProcessError):
         click.secho(
@@ -261,9 +842,6 @@ def hg_commit(hg, repo_path, metadata):
         )
         return
 
-    finally:
-        os.chdir(old_cwd)
-
     if not proc.stdout:
         click.echo('Nothing to commit.')
         return
@@ -276,12 +854,11 @@ def hg_commit(hg, repo_path, metadata):
         click.echo('Committing changes...')
         click.echo(template)
 
-        old_cwd = os.getcwd()
         try:
-            os.chdir(repo_path)
             proc = subprocess.run(
                 [hg, 'commit', '-A', '-u', 'zzyzx', '-l', commit_msg.name],
                 check=True,
+                cwd=repo_path,
             )
         except (OSError, subprocess.CalledProcessError):
             click.secho(
@@ -290,8 +867,27 @@ def hg_commit(hg, repo_path, metadata):
             )
             return
 
-        finally:
-            os.chdir(old_cwd)
+
+def hg_commit_moves(hg, repo_path, message):
+    """Commits files moved in the repository as renames."""
+    try:
+        subprocess.run(
+            [hg, 'addremove', '-s', '100'],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            cwd=repo_path,
+        )
+        subprocess.run(
+            [hg, 'commit', '-u', 'zzyzx', '-m', message],
+            check=True,
+            cwd=repo_path,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        click.secho(
+            'warning: hg commit failed, run `hg addremove -s 100` and commit '
+            'to keep history of moved notes',
+            fg='yellow',
+        )
 
 
 def convert_to_timestamp(text):
@@ -309,7 +905,11 @@ def convert_to_timestamp(text):
     return dt.timestamp()
 
 
-def update_timestamps(path, created, modified):
+def note_timestamps(path, created, modified):
+    """Returns the (atime, mtime) pair that `path` should have.
+
+    Note: we're cheating, putting creation time as access time. Thanks POSIX.
+    """
     base, ext = os.path.splitext(path)
     basename = os.path.basename(base)
 
@@ -320,9 +920,11 @@ def update_timestamps(path, created, modified):
         pass
     else:
         if modified.timestamp() - timestamp > 24 * 60 * 60:
-            os.utime(path, (timestamp, timestamp))
-            return
+            return timestamp, timestamp
 
     # Didn't work out, let's use the provided datetime objects.
-    # Note: we're cheating, putting creation time as access time. Thanks POSIX.
-    os.utime(path, (created.timestamp(), modified.timestamp()))
+    return created.timestamp(), modified.timestamp()
+
+
+def update_timestamps(path, created, modified):
+    os.utime(path, note_timestamps(path, created, modified))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import math
+import os
+import random
+import time
+
+import click
+
+from zzyzx import backup, blobs, util
+
+
+@util.cli.command()
+@click.option(
+    '--sample', default=100.0, type=click.FloatRange(0, 100),
+    help='Percentage of notes to check, picked at random.',
+)
+@click.option(
+    '--since', metavar='YYYY-MM-DD',
+    help='Only check notes modified since the given date.',
+)
+@click.option(
+    '--workers', default=os.cpu_count() or 1, show_default=True,
+    help='How many files to hash at once.',
+)
+@util.pass_cfg
+def verify(cfg, sample, since, workers):
+    """Checks notes in the backup repository for bitrot.
+
+    Compares notes against digests recorded by the last backup and makes
+    sure files tracked by Mercurial are still there. Attachments split off
+    from checked notes must match their digests, too.
+    """
+
+    repo_path, hg_path = backup.repo_settings(cfg)
+    manifest = util.Manifest(repo_path)
+    if not manifest.exists():
+        raise click.ClickException(
+            'no digests found in {}, run `zzyzx backup` first'
+            ''.format(repo_path),
+        )
+
+    start = time.time()
+    entries = sorted(manifest.entries.items())
+    if since:
+        since_ns = int(util.convert_to_timestamp(since) * 1e9)
+        entries = [e for e in entries if e[1].mtime_ns >= since_ns]
+    if sample < 100:
+        entries = random.sample(
+            entries, math.ceil(len(entries) * sample / 100),
+        )
+    problems = {'corrupt': 0, 'modified': 0, 'missing': 0}
+    size = 0
+    store = blobs.BlobStore(repo_path)
+    referenced = set()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        results = executor.map(
+            lambda e: check_file(repo_path, *e), entries,
+        )
+        for (name, entry), problem in zip(entries, results):
+            if problem:
+                report(problem, name)
+                problems[problem] += 1
+            else:
+                size += entry.size
+                referenced |= store.references(os.path.join(repo_path, name))
+
+        digests = sorted(referenced)
+        results = executor.map(store.check, digests)
+        for digest, problem in zip(digests, results):
+            name = os.path.relpath(store.path(digest), repo_path)
+            if problem:
+                report(problem, name)
+                problems[problem] += 1
+            else:
+                size += os.path.getsize(store.path(digest))
+
+    if hg_path:
+        tracked = util.hg_manifest(hg_path, repo_path) or set()
+        for name in sorted(tracked - set(manifest.entries)):
+            if name.startswith('.zzyzx' + os.sep):
+                continue
+
+            if not os.path.lexists(os.path.join(repo_path, name)):
+                report('missing', name)
+                problems['missing'] += 1
+
+    click.echo(
+        'Verified {} notes ({:.1f} MiB) in {:.2f} seconds: {corrupt} '
+        'corrupt, {modified} modified, {missing} missing.'
+        ''.format(
+            len(entries), size / 2 ** 20, time.time() - start, **problems
+        ),
+    )
+    if any(problems.values()):
+        raise click.ClickException('the repository has problems')
+
+
+def check_file(repo_path, name, entry):
+    """Returns None if the file matches its `entry`, otherwise the problem.
+
+    A file whose contents changed but whose size and modification time
+    didn't is assumed to be corrupt. Otherwise something other than zzyzx
+    modified it.
+    """
+    try:
+        digest, st = util.file_digest(os.path.join(repo_path, name))
+    except FileNotFoundError:
+        return 'missing'
+
+    if digest == entry.digest:
+        return None
+
+    if st.st_size == entry.size and st.st_mtime_ns == entry.mtime_ns:
+        return 'corrupt'
+
+    return 'modified'
+
+
+def report(problem, name):
+    color = 'yellow' if problem == 'modified' else 'red'
+    click.secho('{}: {}'.format(problem, name), fg=color)
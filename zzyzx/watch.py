@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import imaplib
+import queue
+import re
+import threading
+import time
+
+import click
+
+from zzyzx import backup, util
+
+
+# Errors after which it makes sense to reconnect.
+CONNECTION_ERRORS = (imaplib.IMAP4.error, OSError)
+
+
+# Put on the changes queue when the entire folder list needs refreshing.
+RESYNC = object()
+
+
+status_response_pattern = re.compile(
+    br'\* STATUS (?P<name>"(?:[^"\\]|\\.)*"|\S+) ',
+)
+
+
+# Untagged IDLE responses that mean the selected folder changed. Others, like
+# "* OK Still here" keepalives, don't.
+change_response_pattern = re.compile(
+    br'\* \d+ (?:EXISTS|EXPUNGE|FETCH|RECENT)\b', re.I,
+)
+
+
+@util.cli.command()
+@util.pass_cfg
+def watch(cfg):
+    """Keeps backing up notes as the IMAP server reports changes."""
+
+    Watcher(cfg).run()
+
+
+class Watcher:
+    """Backs up folders reported as changed by IDLE or NOTIFY connections.
+
+    Configured by the optional [watch] section, all intervals in seconds.
+    """
+
+    def __init__(self, cfg):
+        section = cfg['watch'] if cfg.has_section('watch') else {}
+        self.idle_timeout = float(section.get('idle_timeout', 25 * 60))
+        self.poll_interval = float(section.get('poll_interval', 60))
+        self.commit_interval = float(section.get('commit_interval', 5 * 60))
+        self.resync_interval = float(section.get('resync_interval', 60 * 60))
+        self.max_connections = int(section.get('max_connections', 8))
+
+        self.cfg = cfg
+        self.repo_path, self.hg_path, self.ignore_prefix = (
+            backup.backup_settings(cfg)
+        )
+        self.blobs = backup.blob_store(cfg, self.repo_path)
+        self.sharded = backup.backup_layout(cfg) == 'sharded'
+        self.credentials = util.pop_credentials(cfg)
+        self.changes = queue.Queue()
+        self.watchers = {}  # folder name (or RESYNC for NOTIFY) -> stop event
+        self.metadata = backup.new_metadata()
+        self.metadata['duration'] = 0
+        self.last_commit = time.monotonic()
+
+    def run(self):
+        delays = backoff()
+        try:
+            while True:
+                try:
+                    with self.connection() as conn:
+                        delays = backoff()
+                        self.watch_connection(conn)
+                except CONNECTION_ERRORS as e:
+                    delay = next(delays)
+                    click.secho(
+                        'warning: connection lost ({}), reconnecting in {}s'
+                        ''.format(e, delay),
+                        fg='yellow',
+                    )
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            click.echo('Stopping.')
+        finally:
+            for stop in self.watchers.values():
+                stop.set()
+            if self.hg_path and self.metadata['updated_dirs']:
+                self.commit()
+
+    def connection(self):
+        return util.imap_connection(self.cfg, self.credentials)
+
+    def watch_connection(self, conn):
+        """Backs up changed folders over `conn` until the connection fails."""
+        folders = {}
+        polled = {}
+        statuses = {}
+        last_resync = last_poll = float('-inf')
+        pending = {RESYNC}
+        while True:
+            if time.monotonic() - last_resync >= self.resync_interval:
+                pending.add(RESYNC)
+            if RESYNC in pending:
+                pending.clear()
+                start = time.time()
+                mailboxes = backup.backup_all(
+                    conn, self.repo_path, self.ignore_prefix, self.metadata,
+                    blobs=self.blobs, sharded=self.sharded,
+                )
+                self.metadata['duration'] += time.time() - start
+                folders = {d.name: d for d in mailboxes}
+                polled = self.start_watchers(conn, mailboxes)
+                statuses.clear()
+                list(poll_status(conn, polled, statuses))
+                last_resync = last_poll = time.monotonic()
+
+            for name in sorted(pending):
+                if name in folders:
+                    self.backup_folder(conn, folders[name])
+                # otherwise the folder's gone, the next resync cleans it up
+            pending.clear()
+
+            if (
+                self.hg_path and self.metadata['updated_dirs'] and
+                time.monotonic() - self.last_commit >= self.commit_interval
+            ):
+                self.commit()
+
+            if polled and time.monotonic() - last_poll >= self.poll_interval:
+                pending.update(poll_status(conn, polled, statuses))
+                last_poll = time.monotonic()
+
+            try:
+                pending.add(
+                    self.changes.get(
+                        timeout=min(self.commit_interval, self.poll_interval),
+                    ),
+                )
+            except queue.Empty:
+                conn.noop()  # keep the connection alive
+            while True:
+                try:
+                    pending.add(self.changes.get_nowait())
+                except queue.Empty:
+                    break
+
+    def backup_folder(self, conn, d):
+        start = time.time()
+        notes_dir = backup.create_directories(
+            d.name, self.repo_path, self.ignore_prefix,
+        )
+        old_files = util.list_note_files(notes_dir)
+        manifest = util.Manifest(self.repo_path)
+        backup.backup_folder(
+            conn, d, notes_dir, old_files, self.metadata, manifest,
+            blobs=self.blobs, sharded=self.sharded,
+        )
+        manifest.save()
+        self.metadata['duration'] += time.time() - start
+
+    def commit(self):
+        """Commits accumulated changes, resetting metadata counters."""
+        util.hg_commit(self.hg_path, self.repo_path, self.metadata)
+        self.metadata = backup.new_metadata()
+        self.metadata['duration'] = 0
+        self.last_commit = time.monotonic()
+
+    def start_watchers(self, conn, mailboxes):
+        """Makes sure all `mailboxes` are watched, stopping stale watchers.
+
+        Uses a single NOTIFY connection if the server supports RFC 5465.
+        Otherwise, uses an IDLE connection per folder up to `max_connections`.
+        Returns {name: mailbox} of folders that need to be polled instead.
+        """
+        if 'NOTIFY' in conn.capabilities:
+            if RESYNC not in self.watchers:
+                self.watchers[RESYNC] = spawn(notify_worker, self)
+            return {}
+
+        names = {d.name for d in mailboxes}
+        for name in list(self.watchers):
+            if name not in names:
+                self.watchers.pop(name).set()
+
+        polled = {}
+        for d in mailboxes:
+            if d.name in self.watchers:
+                continue
+
+            if len(self.watchers) < self.max_connections:
+                self.watchers[d.name] = spawn(idle_worker, self, d)
+            else:
+                polled[d.name] = d
+        return polled
+
+
+def spawn(worker, *args):
+    stop = threading.Event()
+    thread = threading.Thread(target=worker, args=args + (stop,), daemon=True)
+    thread.start()
+    return stop
+
+
+def idle_worker(watcher, d, stop):
+    """Reports changes in folder `d` until `stop` is set."""
+    delays = backoff()
+    while not stop.is_set():
+        try:
+            with watcher.connection() as conn:
+                conn.select(d.name_querysafe, readonly=True)
+                delays = backoff()
+                while not stop.is_set():
+                    responses = conn.idle(watcher.idle_timeout)
+                    if any(map(change_response_pattern.match, responses)):
+                        watcher.changes.put(d.name)
+        except CONNECTION_ERRORS as e:
+            delay = next(delays)
+            click.secho(
+                'warning: watching {} failed ({}), retrying in {}s'
+                ''.format(d.name, e, delay),
+                fg='yellow',
+            )
+            stop.wait(delay)
+
+
+def notify_worker(watcher, stop):
+    """Reports changes in all Notes folders until `stop` is set."""
+    delays = backoff()
+    while not stop.is_set():
+        try:
+            with watcher.connection() as conn:
+                conn.xatom(
+                    'NOTIFY',
+                    'SET (subtree INBOX.Notes '
+                    '(MessageNew MessageExpunge FlagChange MailboxName))',
+                )
+                delays = backoff()
+                while not stop.is_set():
+                    for line in conn.idle(watcher.idle_timeout):
+                        m = status_response_pattern.match(line)
+                        if m:
+                            name = util.decode_mailbox_name(m.group('name'))
+                            watcher.changes.put(name)
+                        elif line.startswith(b'* LIST'):
+                            watcher.changes.put(RESYNC)
+        except CONNECTION_ERRORS as e:
+            delay = next(delays)
+            click.secho(
+                'warning: watching for changes failed ({}), retrying in {}s'
+                ''.format(e, delay),
+                fg='yellow',
+            )
+            stop.wait(delay)
+
+
+def poll_status(conn, polled, statuses):
+    """Yields names of `polled` folders whose STATUS changed since last time.
+
+    `statuses` stores the last known status per folder name.
+    """
+    for name, d in polled.items():
+        typ, data = conn.status(
+            d.name_querysafe, '(MESSAGES UIDNEXT UIDVALIDITY)',
+        )
+        if typ != 'OK':
+            continue
+
+        status = data[0].rsplit(b'(', 1)[-1]
+        previous = statuses.get(name)
+        statuses[name] = status
+        if previous is not None and previous != status:
+            yield name
+
+
+def backoff(initial=1, maximum=5 * 60):
+    """Yields exponentially growing delays between reconnection attempts."""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)